@@ -15,6 +15,10 @@ learning_function_quantity = 1
 learning_function_order = 3
 sim_func_args = {'method': 'jaccard', 'v_weight': 1, 'j_weight': 1}
 
+# Save the similarity matrix in shards, so that an interrupted run can be
+# resumed (None to disable)
+checkpoint_dir = None
+
 # Analysis options
 file_format = 'png'
 plotting_context = 'notebook'
@@ -9,16 +9,145 @@ import logging
 import os
 import matplotlib; matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+import numpy as np
 import seaborn as sns
 
 from scipy.cluster import hierarchy
+from scipy.sparse import triu
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from scipy.spatial.distance import squareform
 
 from icing.plotting import silhouette
 from icing.utils import extra
 
 
+def _mst_single_linkage(similarity_matrix):
+    """Single linkage of a connected component from its minimum spanning tree.
+
+    Distances are ``1 - similarity``; the tree is computed on distances
+    shifted by 1, so that null distances are not lost as missing entries.
+    """
+    n = similarity_matrix.shape[0]
+    tree = similarity_matrix.copy()
+    tree.data = 2. - tree.data
+    tree = minimum_spanning_tree(tree).tocoo()
+    order = np.argsort(tree.data, kind='mergesort')
+    rows, cols = tree.row[order], tree.col[order]
+    heights = tree.data[order] - 1.
+
+    # union-find, where each root knows its current cluster in the linkage
+    parent = np.arange(n)
+    cluster = np.arange(n)
+    size = np.ones(n, dtype=int)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    Z = np.empty((n - 1, 4))
+    for k in range(n - 1):
+        a, b = find(rows[k]), find(cols[k])
+        Z[k] = (min(cluster[a], cluster[b]), max(cluster[a], cluster[b]),
+                heights[k], size[a] + size[b])
+        parent[b] = a
+        cluster[a] = n + k
+        size[a] += size[b]
+    return Z
+
+
+def sparse_linkage(similarity_matrix, method='complete', max_dense_size=2000):
+    """Hierarchical clustering of a sparse similarity matrix.
+
+    Distances are ``1 - similarity``, where missing entries have distance 1.
+    Linkage is computed separately for each connected component: with
+    `method` for components of at most `max_dense_size` samples, and with
+    single linkage on the minimum spanning tree for larger components, so
+    that a dense matrix is never built for them. Components are then merged
+    at height 1.
+
+    Parameters
+    ----------
+    similarity_matrix : scipy.sparse matrix, shape (n_samples, n_samples)
+        Similarity matrix, symmetric or triangular.
+    method : str, optional, default: 'complete'
+        Linkage method for small components, as in `hierarchy.linkage`.
+        Methods which are not monotonic ('centroid' and 'median') are not
+        supported, as merges are sorted by height.
+    max_dense_size : int, optional, default: 2000
+        Maximum size of components clustered from the dense matrix.
+
+    Returns
+    -------
+    Z : array, shape (n_samples - 1, 4)
+        Linkage matrix, in the format of `hierarchy.linkage`.
+    """
+    if method in ('centroid', 'median'):
+        raise ValueError("Method %r is not monotonic, and cannot be used "
+                         "for sparse linkage." % method)
+    similarity_matrix = extra.symmetric_similarity_matrix(similarity_matrix)
+    n = similarity_matrix.shape[0]
+    n_components, labels = connected_components(
+        similarity_matrix, directed=False)
+
+    Z, roots = [], []
+    n_rows = 0
+    for idxs in np.split(np.argsort(labels, kind='mergesort'),
+                         np.cumsum(np.bincount(labels))[:-1]):
+        m = idxs.shape[0]
+        if m == 1:
+            roots.append(idxs[0])
+            continue
+        component = similarity_matrix[idxs][:, idxs]
+        if m <= max_dense_size:
+            distances = 1. - component.toarray()
+            np.fill_diagonal(distances, 0)
+            Z_component = hierarchy.linkage(
+                squareform(distances, checks=False), method=method)
+        else:
+            Z_component = _mst_single_linkage(component)
+
+        # from component ids to global ids
+        ids = np.concatenate((idxs, n + n_rows + np.arange(m - 1)))
+        Z_component[:, :2] = ids[Z_component[:, :2].astype(int)]
+        Z.append(Z_component)
+        n_rows += m - 1
+        roots.append(n + n_rows - 1)
+
+    # components are at distance 1 from each other
+    for root in roots[1:]:
+        Z.append([[min(roots[0], root), max(roots[0], root), 1.,
+                   0]])
+        roots[0] = n + n_rows
+        n_rows += 1
+    Z = np.vstack(Z) if Z else np.empty((0, 4))
+
+    # sort merges by height, so that truncated dendrograms show the top ones.
+    # A merge is never sorted before its children, even if they are higher
+    # (e.g. with ward linkage, components are joined at height 1)
+    keys = np.empty(n + Z.shape[0])
+    keys[:n] = -np.inf
+    for k in range(Z.shape[0]):
+        keys[n + k] = max(Z[k, 2], keys[int(Z[k, 0])], keys[int(Z[k, 1])])
+    order = np.argsort(keys[n:], kind='mergesort')
+    new_ids = np.empty(n + Z.shape[0], dtype=int)
+    new_ids[:n] = np.arange(n)
+    new_ids[n + order] = n + np.arange(Z.shape[0])
+    Z = Z[order]
+    Z[:, :2] = np.sort(new_ids[Z[:, :2].astype(int)], axis=1)
+
+    # sizes of clusters
+    sizes = np.ones(n + Z.shape[0], dtype=int)
+    for k in range(Z.shape[0]):
+        sizes[n + k] = sizes[int(Z[k, 0])] + sizes[int(Z[k, 1])]
+    Z[:, 3] = sizes[n:]
+    return Z
+
+
 def analyse(sm, labels, root='', plotting_context=None, file_format='pdf',
-            force_silhouette=False, threshold=None):
+            force_silhouette=False, threshold=None, silhouette_sample_size=8000,
+            dendrogram_size=100):
     """Perform analysis.
 
     Parameters
@@ -33,31 +162,42 @@ def analyse(sm, labels, root='', plotting_context=None, file_format='pdf',
         See seaborn.set_context().
     file_format : ('pdf', 'png')
         Choose the extension for output images.
+    force_silhouette : boolean, optional, default: False
+        Compute the silhouette of all the samples, even if they are more than
+        `silhouette_sample_size`.
+    silhouette_sample_size : int, optional, default: 8000
+        With more samples, the average silhouette is estimated on a random
+        subset of this size, with a 95% confidence interval.
+    dendrogram_size : int, optional, default: 100
+        Number of leaves of the truncated dendrogram. The linkage is computed
+        on the sparse matrix by `sparse_linkage`.
     """
     sns.set_context(plotting_context)
 
-    if force_silhouette or sm.shape[0] < 8000:
-        silhouette.plot_clusters_silhouette(1. - sm.toarray(), labels,
-                                            max(labels), root=root,
-                                            file_format=file_format)
+    # silhouette is computed on the sparse matrix, where missing
+    # similarities are distances of 1
+    if force_silhouette or sm.shape[0] <= silhouette_sample_size:
+        silhouette_values = silhouette.sparse_silhouette_samples(sm, labels)
+        silhouette.plot_clusters_silhouette(
+            None, labels, max(labels), root=root, file_format=file_format,
+            sample_silhouette_values=silhouette_values)
     else:
-        logging.warn(
-            "Silhouette analysis is not performed due to the "
-            "matrix dimensions. With a matrix %ix%i, you would need to "
-            "allocate %.2fMB in memory. If you know what you are doing, "
-            "specify 'force_silhouette = True' in the config file in %s, "
-            "then re-execute the analysis.\n", sm.shape[0], sm.shape[0],
-            sm.shape[0]**2 * 8 / (2.**20), root)
-
-    # Generate dendrogram
-    import scipy.spatial.distance as ssd
-    Z = hierarchy.linkage(ssd.squareform(1. - sm.toarray()), method='complete',
-                          metric='euclidean')
+        mean, lower, upper = silhouette.sparse_silhouette_score(
+            sm, labels, sample_size=silhouette_sample_size, random_state=0)
+        logging.info(
+            "Average silhouette_score (estimated on %i of %i samples): %.4f, "
+            "95%% confidence interval [%.4f, %.4f]. To compute the "
+            "silhouette of all samples, specify 'force_silhouette = True' "
+            "in the config file in %s, then re-execute the analysis.",
+            silhouette_sample_size, sm.shape[0], mean, lower, upper, root)
+
+    # Generate dendrogram, without building the dense distance matrix
+    Z = sparse_linkage(sm, method='complete')
 
     plt.close()
     fig, (ax) = plt.subplots(1, 1)
     fig.set_size_inches(20, 15)
-    hierarchy.dendrogram(Z, ax=ax)
+    hierarchy.dendrogram(Z, ax=ax, truncate_mode='lastp', p=dendrogram_size)
     ax.axhline(threshold, color="red", linestyle="--")
     plt.show()
     filename = os.path.join(root, 'dendrogram_{}.{}'
@@ -65,9 +205,11 @@ def analyse(sm, labels, root='', plotting_context=None, file_format='pdf',
     fig.savefig(filename)
     logging.info('Figured saved %s', filename)
 
+    # histogram of the stored distances (missing ones are 1)
     plt.close()
     fig, (ax) = plt.subplots(1, 1)
     fig.set_size_inches(20, 15)
-    plt.hist(1. - sm.toarray(), bins=50, normed=False)
+    distances = 1. - triu(extra.symmetric_similarity_matrix(sm), 1).data
+    plt.hist(distances, bins=50, normed=False)
     plt.ylim([0, 10])
     fig.savefig(filename + "_histogram_distances.pdf")
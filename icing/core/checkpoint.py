@@ -0,0 +1,204 @@
+"""Checkpoints of long similarity computations.
+
+The candidate pairs are split into deterministic shards, and the
+similarities of each shard are written to a work directory as soon as the
+shard is done. A manifest records a digest of the records and of the
+similarity parameters, so that a computation restarted with the same
+inputs only computes the missing shards, while a change in the inputs
+discards the old ones.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import glob
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import pandas as pd
+import tempfile
+
+from sklearn.base import BaseEstimator
+
+
+def _update_digest(digest, obj):
+    """Feed a canonical representation of obj to a hash object."""
+    if isinstance(obj, BaseEstimator):
+        digest.update(type(obj).__name__.encode('utf-8'))
+        _update_digest(digest, obj.get_params(deep=False))
+    elif isinstance(obj, dict):
+        for key in sorted(obj):
+            _update_digest(digest, key)
+            _update_digest(digest, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        digest.update(b'[')
+        for x in obj:
+            _update_digest(digest, x)
+        digest.update(b']')
+    elif isinstance(obj, (set, frozenset)):
+        _update_digest(digest, sorted(obj))
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        _update_digest(digest, list(obj.index))
+        _update_digest(digest, obj.values)
+    elif isinstance(obj, np.poly1d):
+        _update_digest(digest, obj.coeffs)
+    elif isinstance(obj, np.ndarray):
+        digest.update(str(obj.dtype).encode('utf-8'))
+        if obj.dtype == object:
+            _update_digest(digest, obj.tolist())
+        else:
+            digest.update(np.ascontiguousarray(obj).tobytes())
+    elif callable(obj) and hasattr(obj, '__name__'):
+        digest.update(('%s.%s' % (getattr(obj, '__module__', ''),
+                                  obj.__name__)).encode('utf-8'))
+    else:
+        digest.update(repr(obj).encode('utf-8'))
+    digest.update(b';')
+
+
+def params_digest(*objs):
+    """Hash of parameters, estimators and arrays.
+
+    Estimators are hashed by their class and parameters, arrays and data
+    frames by their values. Functions are hashed by name, so changes in
+    their code are not detected.
+
+    Returns
+    -------
+    digest : str
+        Hexadecimal SHA-1 digest.
+    """
+    digest = hashlib.sha1()
+    _update_digest(digest, objs)
+    return digest.hexdigest()
+
+
+def shard_pairs(lengths, rows, cols, shard_size=100000):
+    """Split pairs into deterministic shards.
+
+    Pairs are grouped by the length of the shorter junction of the pair,
+    and each group is cut into consecutive shards of at most `shard_size`
+    pairs. The same pairs always give the same shards.
+
+    Parameters
+    ----------
+    lengths : array_like
+        Junction length of each record.
+    rows, cols : array_like
+        Indices of the pairs.
+    shard_size : int, optional, default: 100000
+        Maximum number of pairs in a shard.
+
+    Returns
+    -------
+    shards : list of array
+        Positions of the pairs of each shard.
+    """
+    if shard_size < 1:
+        raise ValueError("shard_size must be positive, got %r" % shard_size)
+    lengths = np.asarray(lengths, dtype=int)
+    rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+    keys = np.minimum(lengths[rows], lengths[cols])
+    order = np.lexsort((cols, rows, keys))
+    bounds = np.flatnonzero(np.diff(keys[order])) + 1
+    shards = []
+    for group in np.split(order, bounds):
+        shards.extend(group[i:i + shard_size]
+                      for i in range(0, group.shape[0], shard_size))
+    return [x for x in shards if x.shape[0] > 0]
+
+
+def _atomic_write(path, write):
+    """Write a file through a temporary file in the same directory."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ShardStore(object):
+    """Completed shards of a similarity computation in a work directory.
+
+    The directory contains a ``manifest.json`` file and a ``shard_*.npz``
+    file for each completed shard. Files are written atomically, so a shard
+    file is either complete or absent, even if the process is killed.
+
+    Parameters
+    ----------
+    work_dir : str
+        Work directory. It is created if it does not exist.
+    digest : str
+        Digest of the inputs of the computation, as returned by
+        `params_digest`. Shards computed with a different digest are
+        discarded.
+    n_shards : int
+        Number of shards of the computation.
+    """
+
+    def __init__(self, work_dir, digest, n_shards):
+        self.work_dir = work_dir
+        self.digest = digest
+        self.n_shards = n_shards
+        if not os.path.exists(work_dir):
+            os.makedirs(work_dir)
+        for tmp in glob.glob(os.path.join(work_dir, '*.tmp')):
+            os.remove(tmp)
+
+        manifest = self._read_manifest()
+        if manifest != self._manifest():
+            stale = glob.glob(os.path.join(work_dir, 'shard_*.npz'))
+            if manifest is not None and stale:
+                logging.warn("Similarity parameters changed, discarding %i "
+                             "completed shards in %s", len(stale), work_dir)
+            for path in stale:
+                os.remove(path)
+            _atomic_write(self._manifest_path, lambda f: f.write(
+                json.dumps(self._manifest(), indent=2,
+                           sort_keys=True).encode('utf-8')))
+
+    @property
+    def _manifest_path(self):
+        return os.path.join(self.work_dir, 'manifest.json')
+
+    def _manifest(self):
+        return dict(digest=self.digest, n_shards=self.n_shards)
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _path(self, shard):
+        return os.path.join(self.work_dir, 'shard_%06d.npz' % shard)
+
+    def completed(self):
+        """Return the sorted list of the completed shards."""
+        return [i for i in range(self.n_shards)
+                if os.path.exists(self._path(i))]
+
+    def save(self, shard, data, rows, cols):
+        """Store the similarities of a completed shard."""
+        _atomic_write(self._path(shard), lambda f: np.savez(
+            f, data=data, rows=rows, cols=cols))
+
+    def load(self, shard):
+        """Load the similarities of a completed shard.
+
+        Returns
+        -------
+        data, rows, cols : array
+            Similarities of the shard and their indices.
+        """
+        with np.load(self._path(shard)) as f:
+            return f['data'], f['rows'], f['cols']
@@ -19,7 +19,7 @@ from collections import defaultdict
 from functools import partial
 
 from icing.core.cluster import define_clusts
-from icing.core.distances import string_distance
+from icing.core.distances import apply_correction, string_distance
 from icing.core.similarity_scores import similarity_score_tripartite as mwi
 from icing.core.parallel_distance import sm_sparse
 from icing.kernel import stringkernel
@@ -415,7 +415,12 @@ def compute_similarity_matrix(db_iter, sparse_mode=True, **sim_func_args):
 
     set_defaults_sim_func(sim_func_args, igs)
     logging.info("Similarity function parameters: %s", sim_func_args)
-    similarity_function = partial(sim_function, **sim_func_args)
+    # the mutation correction is applied to all the similarities at once
+    correct = sim_func_args.get('correct', True)
+    correction_function = sim_func_args.get(
+        'correction_function', lambda _: 1)
+    similarity_function = partial(
+        sim_function, **dict(sim_func_args, correct=False))
 
     # logging.info("Start similar_elements function ...")
     # rows, cols = similar_elements(dd, igs, n, similarity_function)
@@ -423,6 +428,11 @@ def compute_similarity_matrix(db_iter, sparse_mode=True, **sim_func_args):
     logging.info("Start parallel_sim_matrix function ...")
     data, rows, cols = sm_sparse(
         np.array(igs), similarity_function, sim_func_args['tol'])
+    if correct:
+        data = apply_correction(data, rows, cols, [x.mut for x in igs],
+                                correction_function)
+        keep = data > 0
+        data, rows, cols = data[keep], rows[keep], cols[keep]
 
     # from icing.externals import neighbors
     # sp = neighbors.radius_neighbors_graph(np.array(igs))
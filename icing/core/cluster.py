@@ -7,16 +7,159 @@ import fastcluster
 from scipy.cluster.hierarchy import fcluster
 from scipy.spatial.distance import squareform
 from sklearn.cluster import DBSCAN
+from sklearn.utils import check_random_state
 from sklearn.utils.sparsetools import connected_components
 
 from icing.externals import AffinityPropagation
+from icing.externals.spectral import component_spectral_clustering
 from icing.utils import extra
 
 
+def louvain(similarity_matrix, resolution=1., random_state=None,
+            max_levels=20, max_iter=100, sample_weight=None):
+    """Community detection on a sparse similarity graph.
+
+    Nodes are moved between communities while the modularity increases
+    (`icing.core.graphclustering.local_moving`), then communities are
+    aggregated into nodes, until no node moves.
+
+    Parameters
+    ----------
+    similarity_matrix : scipy.sparse matrix, shape (n_samples, n_samples)
+        Similarity matrix between samples. Triangular matrices are made
+        symmetric, and the diagonal is ignored.
+    resolution : float, optional, default: 1.
+        Higher resolutions give smaller communities.
+    random_state : int, RandomState instance or None, optional
+        Seed of the order in which nodes are visited.
+    max_levels : int, optional, default: 20
+        Maximum number of aggregations.
+    max_iter : int, optional, default: 100
+        Maximum number of passes over the nodes at each level.
+    sample_weight : array-like, shape (n_samples,), optional
+        Multiplicity of each sample. A sample with weight w is equivalent to
+        w identical samples, with similarity 1 between each other.
+
+    Returns
+    -------
+    labels : array, shape (n_samples,)
+        Community of each sample, starting from 0.
+    """
+    from icing.core.graphclustering import local_moving
+    random_state = check_random_state(random_state)
+    graph = extra.symmetric_similarity_matrix(similarity_matrix).astype(
+        np.float64)
+    if sample_weight is not None:
+        weights = np.asarray(sample_weight, dtype=np.float64)
+        graph = scipy.sparse.diags(weights).dot(graph).dot(
+            scipy.sparse.diags(weights)) + scipy.sparse.diags(
+                weights * (weights - 1))
+    graph = scipy.sparse.csr_matrix(graph)
+
+    labels = np.arange(graph.shape[0])
+    for _ in range(max_levels):
+        communities, n_moves = local_moving(
+            graph.indptr.astype(np.int32), graph.indices.astype(np.int32),
+            graph.data.astype(np.float64),
+            np.arange(graph.shape[0], dtype=np.int32),
+            resolution=resolution, max_iter=max_iter,
+            seed=random_state.randint(np.iinfo(np.int32).max))
+        if n_moves == 0:
+            break
+        communities = np.unique(communities, return_inverse=True)[1]
+        labels = communities[labels]
+
+        # one node for each community, with internal weights on the diagonal
+        membership = scipy.sparse.csr_matrix((
+            np.ones(graph.shape[0]), (np.arange(graph.shape[0]),
+                                      communities)))
+        graph = scipy.sparse.csr_matrix(
+            membership.T.dot(graph).dot(membership))
+    return labels
+
+
+def threshold_clustering(similarity_matrix, threshold=0.05):
+    """Single linkage clusters at a distance threshold.
+
+    Samples with similarity at least ``1 - threshold`` are joined by a
+    compiled union-find (`icing.core.graphclustering.union_find`), without
+    building any dense matrix.
+
+    Parameters
+    ----------
+    similarity_matrix : scipy.sparse matrix, shape (n_samples, n_samples)
+        Similarity matrix between samples.
+    threshold : float, optional, default: 0.05
+        Distance threshold.
+
+    Returns
+    -------
+    labels : array, shape (n_samples,)
+        Cluster of each sample, starting from 0.
+    """
+    from icing.core.graphclustering import union_find
+    edges = scipy.sparse.coo_matrix(similarity_matrix)
+    mask = edges.data >= 1 - threshold
+    return union_find(edges.row[mask], edges.col[mask], edges.shape[0])
+
+
 def define_clusts(similarity_matrix, threshold=0.05, max_iter=200,
-                  method='ap'):
-    """Define clusters given the similarity matrix and the threshold."""
+                  method='ap', sample_weight=None, n_jobs=-1,
+                  resolution=1., random_state=0):
+    """Define clusters given the similarity matrix and the threshold.
+
+    Parameters
+    ----------
+    similarity_matrix : scipy.sparse matrix, shape (n_samples, n_samples)
+        Similarity matrix between samples.
+    threshold : float, optional, default: 0.05
+        Distance threshold for hierarchical and threshold clustering.
+    max_iter : int, optional, default: 200
+        Maximum number of iterations for affinity propagation.
+    method : ('ap', 'dbscan', 'hc', 'spectral', 'graph', 'threshold')
+        Clustering method to apply to each connected component. 'spectral'
+        embeds each component with a sparse eigensolver and chooses its
+        number of clusters with the eigengap heuristic. 'graph' finds
+        communities on the whole sparse graph with `louvain`. 'threshold'
+        gives single linkage clusters at `threshold` with
+        `threshold_clustering`. Default is 'ap'.
+    sample_weight : array-like, shape (n_samples,), optional
+        Multiplicity of each sample, when each sample represents a group of
+        identical records. It is used to set AP preferences, DBSCAN
+        sample weights and graph node weights. 'hc' and 'spectral' ignore
+        it.
+    n_jobs : int, optional, default: -1
+        Number of components clustered in parallel by 'spectral'.
+    resolution : float, optional, default: 1.
+        Resolution of 'graph' communities.
+    random_state : int, RandomState instance or None, optional, default: 0
+        Seed for 'spectral' and 'graph'.
+
+    Notes
+    -----
+    The computation follows the type of `similarity_matrix`. With a float32
+    matrix, affinity propagation messages are float32 too.
+
+    Returns
+    -------
+    clusters : array, shape (n_samples,)
+        Cluster of each sample.
+    """
+    if method == 'spectral':
+        clusters = component_spectral_clustering(
+            similarity_matrix, random_state=random_state, n_jobs=n_jobs)
+        return clusters + 1
+    if method == 'threshold':
+        return threshold_clustering(similarity_matrix, threshold) + 1
+    if method == 'graph':
+        clusters = louvain(similarity_matrix, resolution=resolution,
+                           random_state=random_state,
+                           sample_weight=sample_weight)
+        return clusters + 1
+
     n, labels = connected_components(similarity_matrix, directed=False)
+    if sample_weight is not None:
+        sample_weight = np.asarray(sample_weight)
     prev_max_clust = 0
     print("connected components: %d" % n)
     clusters = labels.copy()
@@ -31,7 +174,7 @@ def define_clusts(similarity_matrix, threshold=0.05, max_iter=200,
         idxs = np.where(labels == i)[0]
         if idxs.shape[0] > 1:
             sm = similarity_matrix[idxs][:, idxs]
-            sm += sm.T + scipy.sparse.eye(sm.shape[0])
+            sm += sm.T + scipy.sparse.eye(sm.shape[0], dtype=sm.dtype)
 
             # Hierarchical clustering
             if method == 'hc':
@@ -45,7 +188,8 @@ def define_clusts(similarity_matrix, threshold=0.05, max_iter=200,
 
             # DBSCAN
             elif method == 'dbscan':
-                db = ap.fit(1. - sm.toarray())
+                db = ap.fit(1. - sm.toarray(), sample_weight=None if
+                            sample_weight is None else sample_weight[idxs])
                 # Number of clusters in labels, ignoring noise if present.
                 clusters_ = db.labels_
                 # n_clusters_ = len(set(clusters_)) - int(0 in clusters_)
@@ -53,6 +197,14 @@ def define_clusts(similarity_matrix, threshold=0.05, max_iter=200,
             # AffinityPropagation
             # ap = AffinityPropagation(affinity='precomputed')
             elif method == 'ap':
+                if sample_weight is not None:
+                    # a sample with weight w stands for w identical samples:
+                    # its similarities count w times and, when it is an
+                    # exemplar, its w - 1 copies have similarity 1 with it
+                    weights = sample_weight[idxs]
+                    ap.preference = (np.median(sm.data) + weights - 1).astype(
+                        sm.dtype)
+                    sm = scipy.sparse.diags(weights.astype(sm.dtype)).dot(sm)
                 db = ap.fit(sm)
                 clusters_ = db.labels_
             else:
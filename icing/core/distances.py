@@ -12,9 +12,11 @@ Licensed under the FreeBSD license (see LICENSE.txt).
 from __future__ import division
 
 import numpy as np
+import pandas as pd
 
 from itertools import izip  # combinations, izip, product
 from Bio.pairwise2 import align
+from scipy.sparse import csr_matrix
 from sklearn.base import BaseEstimator
 
 # try:
@@ -24,6 +26,7 @@ from sklearn.base import BaseEstimator
 #                       "Did you compile icing with "
 #                       "'python setup.py build_ext --inplace install'?")
 
+from icing.core.junctiondistance import weighted_mismatches
 from icing.kernel import stringkernel
 # from string_kernel import stringkernel
 from icing.models.model import model_matrix
@@ -89,6 +92,13 @@ def junction_distance(seq1, seq2, n, dist_mat, norm, sym, tol=3, c=35.,
     length_constraint : boolean, optional, default: True
         Insert the constraint on the difference between the lengths of seq1 and
         seq2. If False, `tol` is ignored.
+    max_distance : float, optional
+        Distance cutoff. The sum over characters stops as soon as it proves
+        that the distance is higher than `max_distance`, and 1 is returned,
+        as for sequences too different in length.
+    char_table : tuple, optional
+        The output of ``char_distance_table(dist_mat)``, to avoid computing
+        it at each call.
 
     Returns
     -------
@@ -139,8 +149,38 @@ def junction_distance(seq1, seq2, n, dist_mat, norm, sym, tol=3, c=35.,
                 for c1, c2, n1, n2 in izip(seqq1, seqq2, nmer1, nmer2)]) / (norm_by)
 
 
+def char_distance_table(dist_mat):
+    """Encode a character distance matrix for `weighted_mismatches`.
+
+    Parameters
+    ----------
+    dist_mat : pandas.DataFrame
+        Matrix which define the distance between the single characters.
+
+    Returns
+    -------
+    lookup : array, shape (256,)
+        Row of each character in `table`, -1 if not in the alphabet.
+    table : array, shape (n_chars, n_chars)
+        Symmetric distance between characters.
+    nonnegative : bool
+        Whether all the distances are non-negative, so that partial sums
+        never decrease and can be abandoned.
+    """
+    if not dist_mat.columns.equals(dist_mat.index):
+        dist_mat = dist_mat.loc[:, dist_mat.index]
+    lookup = np.full(256, -1, dtype=np.int32)
+    for i, char in enumerate(dist_mat.index):
+        if len(char) == 1:
+            lookup[ord(char)] = i
+    values = dist_mat.values.astype(float)
+    table = (values + values.T) / 2.
+    return lookup, table, bool(np.all(table >= 0))
+
+
 def string_distance(seq1, seq2, len_seq1, len_seq2, dist_mat, dist_mat_max,
-                    tol=3, length_constraint=True):
+                    tol=3, length_constraint=True, max_distance=None,
+                    char_table=None):
     """Calculate a distance between two input sequences.
 
     Parameters
@@ -158,6 +198,13 @@ def string_distance(seq1, seq2, len_seq1, len_seq2, dist_mat, dist_mat_max,
     length_constraint : boolean, optional, default: True
         Insert the constraint on the difference between the lengths of seq1 and
         seq2. If False, `tol` is ignored.
+    max_distance : float, optional
+        Distance cutoff. The sum over characters stops as soon as it proves
+        that the distance is higher than `max_distance`, and 1 is returned,
+        as for sequences too different in length.
+    char_table : tuple, optional
+        The output of ``char_distance_table(dist_mat)``, to avoid computing
+        it at each call.
 
     Returns
     -------
@@ -177,15 +224,221 @@ def string_distance(seq1, seq2, len_seq1, len_seq2, dist_mat, dist_mat_max,
             # seq1, seq2 = map(extra.junction_re, igalign.alignment(seq1, seq2))
             # print 'after align:\n', seq1, '\n', seq2, '\n--------------'
     norm_by = len_seq1 * dist_mat_max
-    return sum([np.mean((
-        float(dist_mat.at[c1, c2]),
-        float(dist_mat.at[c2, c1]))) for c1, c2 in izip(
-            list(seq1), list(seq2))]) / norm_by
+    lookup, table, nonnegative = char_table or char_distance_table(dist_mat)
+    max_sum = np.inf
+    if max_distance is not None and nonnegative:
+        # a small margin, so that rounding never abandons a pair within
+        # the cutoff
+        max_sum = max_distance * norm_by * (1 + 1e-9)
+    distance = weighted_mismatches(
+        str(seq1), str(seq2), lookup, table, max_sum) / norm_by
+    if max_distance is not None and distance > max_distance:
+        return 1.
+    return distance
+
+
+def encode_strings(strings, alphabet):
+    """Encode strings as rows of integer codes over an alphabet.
+
+    Parameters
+    ----------
+    strings : array-like
+        String sequences.
+    alphabet : array-like
+        Characters of the alphabet, e.g., the index of a distance matrix.
+
+    Returns
+    -------
+    codes : array, shape (n_strings, max_length)
+        Position of each character in the alphabet. Shorter strings are
+        padded with ``len(alphabet)``.
+    lengths : array, shape (n_strings,)
+        Length of each string.
+    """
+    lookup = np.full(256, -1, dtype=np.int32)
+    for i, char in enumerate(alphabet):
+        lookup[ord(char)] = i
+    lengths = np.array([len(x) for x in strings], dtype=int)
+    codes = np.full((lengths.shape[0], max(lengths.max(), 1) if
+                     lengths.shape[0] else 1), len(alphabet), dtype=np.int32)
+    for i, x in enumerate(strings):
+        codes[i, :lengths[i]] = lookup[np.fromstring(x, dtype=np.uint8)]
+    if np.any(codes < 0):
+        raise ValueError("Some characters are not in the model alphabet")
+    return codes, lengths
+
+
+def string_distance_pairs(strings, rows, cols, dist_mat, dist_mat_max,
+                          tol=3, chunk_size=100000, max_distance=None):
+    """Compute `string_distance` on pairs of strings of a collection.
+
+    Distances between strings of the same length are computed with array
+    operations if `dist_mat` is accepted by `block_weights`, so that they
+    are equal to `string_distance`. Otherwise, and for strings with
+    different lengths, they are computed one pair at a time.
+
+    Parameters
+    ----------
+    strings : array-like
+        String sequences.
+    rows, cols : array-like
+        Indices of the pairs of strings on which to compute the distance.
+    dist_mat : pandas.DataFrame
+        Matrix which define the distance between the single characters.
+    tol : int, optional, default: 3
+        Tolerance in the length of the sequences.
+    chunk_size : int, optional, default: 100000
+        Number of pairs to evaluate at a time.
+    max_distance : float, optional
+        Distance cutoff, as in `string_distance`. Distances higher than
+        `max_distance` are returned as 1.
+
+    Returns
+    -------
+    distances : array, shape (n_pairs,)
+        Normalised distances between the pairs of strings.
+    """
+    rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+    codes, lengths = encode_strings(strings, dist_mat.index)
+    weights = block_weights(dist_mat)
+
+    distances = np.ones(rows.shape[0])
+    len_diff = np.abs(lengths[rows] - lengths[cols])
+    if weights is not None:
+        # exact sums, with a null distance for padding characters
+        n_chars = dist_mat.shape[0]
+        dist_pad = np.zeros((n_chars + 1, n_chars + 1))
+        dist_pad[:-1, :-1] = weights
+        equal = np.where(len_diff == 0)[0]
+        for start in range(0, equal.shape[0], chunk_size):
+            idx = equal[start:start + chunk_size]
+            distances[idx] = dist_pad[
+                codes[rows[idx]], codes[cols[idx]]].sum(axis=1) / (
+                    lengths[rows[idx]] * dist_mat_max)
+        if max_distance is not None:
+            distances[distances > max_distance] = 1.
+        per_pair = (len_diff > 0) & (len_diff <= tol)
+    else:
+        per_pair = len_diff <= tol
+
+    char_table = char_distance_table(dist_mat)
+    for k in np.where(per_pair)[0]:
+        i, j = rows[k], cols[k]
+        distances[k] = string_distance(
+            strings[i], strings[j], lengths[i], lengths[j], dist_mat,
+            dist_mat_max=dist_mat_max, tol=tol, max_distance=max_distance,
+            char_table=char_table)
+    return distances
+
+
+def block_weights(dist_mat):
+    """Character distances for array computations of `string_distance`.
+
+    Sums of the weights must be exact in floating point, for the distances
+    to be equal to `string_distance` whatever the order of the sum. This
+    holds if all the weights are finite multiples of 1/2, as for 'ham',
+    'aa', 'blosum50' and 'pam30'. The matrix must also be symmetric, as
+    block products do not keep the order of the pairs.
+
+    Returns
+    -------
+    dist_sym : array or None
+        Distance matrix, or None if it cannot be used.
+    """
+    dist_sym = np.asarray(dist_mat.values, dtype=float)
+    if not np.array_equal(dist_sym, dist_sym.T) or \
+            not np.all(np.isfinite(dist_sym)) or np.any(
+                dist_sym * 2 != np.round(dist_sym * 2)):
+        return None
+    return dist_sym
+
+
+def block_string_distances(strings, groups, dist_mat, dist_mat_max,
+                           max_distance=1., max_block_size=2 ** 22):
+    """Compute `string_distance` between equal-length strings of each group.
+
+    Strings of a group with the same length are one-hot encoded over the
+    alphabet of `dist_mat`, so that all their distances are the product
+    ``X W Y^T``, computed by BLAS. For the Hamming distance this is
+    ``L - X Y^T``. Large buckets are split into blocks of rows.
+
+    Parameters
+    ----------
+    strings : array-like
+        String sequences.
+    groups : list of array-like
+        Indices of the strings in each group, e.g., for each V gene the
+        strings with that gene. Only pairs in the same group are computed.
+    dist_mat : pandas.DataFrame
+        Matrix which define the distance between the single characters. It
+        must be accepted by `block_weights`.
+    dist_mat_max : float
+        Maximum of `dist_mat`, used for normalisation.
+    max_distance : float, optional, default: 1
+        Only distances strictly lower than `max_distance` are returned.
+    max_block_size : int, optional, default: 2 ** 22
+        Maximum number of distances computed by a single product.
+
+    Returns
+    -------
+    rows, cols : array, shape (n_pairs,)
+        Indices of the pairs, with rows < cols, sorted by row then col.
+    distances : array, shape (n_pairs,)
+        Normalised distances between the pairs of strings.
+    """
+    dist_sym = block_weights(dist_mat)
+    if dist_sym is None:
+        raise ValueError("The distance matrix cannot be used for block "
+                         "distances. See `block_weights`.")
+    strings = np.asarray(strings, dtype=object)
+    n = strings.shape[0]
+    codes, lengths = encode_strings(strings, dist_mat.index)
+    n_chars = dist_sym.shape[0]
+    hamming = np.array_equal(dist_sym, 1 - np.eye(n_chars))
+
+    pairs, distances = [np.empty(0, dtype=np.int64)], [np.empty(0)]
+    for group in groups:
+        group = np.asarray(group, dtype=int)
+        group = group[np.argsort(lengths[group], kind='mergesort')]
+        bounds = np.flatnonzero(np.diff(lengths[group])) + 1
+        for idx in np.split(group, bounds):
+            m = idx.shape[0]
+            if m < 2:
+                continue
+            length = lengths[idx[0]]
+            onehot = np.zeros((m, length * n_chars))
+            onehot[np.arange(m)[:, None], np.arange(length) * n_chars +
+                   codes[idx, :length]] = 1
+            left = onehot if hamming else \
+                dist_sym[codes[idx, :length]].reshape(m, -1)
+
+            step = max(1, max_block_size // m)
+            for start in range(0, m - 1, step):
+                block = left[start:start + step].dot(onehot[start:].T)
+                if hamming:
+                    block = length - block
+                block /= length * dist_mat_max
+                i, j = np.nonzero(block < max_distance)
+                upper = j > i
+                i, j = i[upper], j[upper]
+                distances.append(block[i, j])
+                i, j = idx[start + i], idx[start + j]
+                pairs.append(np.minimum(i, j).astype(np.int64) * n +
+                             np.maximum(i, j))
+
+    pairs, first = np.unique(np.concatenate(pairs), return_index=True)
+    return ((pairs // n).astype(int), (pairs % n).astype(int),
+            np.concatenate(distances)[first])
 
 
 class Distance(BaseEstimator):
     _estimator_type = "distance"
 
+    def batch_pairwise(self, strings, rows, cols):
+        """Compute distances between pairs of strings of a collection."""
+        return np.array([self.pairwise(strings[i], strings[j])
+                         for i, j in izip(rows, cols)], dtype=float)
+
 
 class StringKernelDistance(Distance):
     """Utility class for string kernel for computing distances."""
@@ -208,21 +461,35 @@ class StringKernelDistance(Distance):
 
 
 class StringDistance(Distance):
-    """Utility class for string distance."""
+    """Utility class for string distance.
+
+    With `max_distance`, the sum over characters of each pair stops as soon
+    as the distance exceeds the cutoff, and 1 is returned instead.
+    """
 
-    def __init__(self, model='ham', dist_mat=None, tol=3):
+    def __init__(self, model='ham', dist_mat=None, tol=3, max_distance=None):
         self.model = model
         self.dist_mat = dist_mat
         self.tol = tol
+        self.max_distance = max_distance
 
         if self.dist_mat is None:
             self.dist_mat = model_matrix(model)
         self.dist_mat_max = np.max(np.max(self.dist_mat))
+        self.char_table = char_distance_table(self.dist_mat)
 
     def pairwise(self, x1, x2):
         return string_distance(
             x1, x2, len(x1), len(x2), dist_mat=self.dist_mat,
-            dist_mat_max=self.dist_mat_max, tol=self.tol)
+            dist_mat_max=self.dist_mat_max, tol=self.tol,
+            max_distance=self.max_distance, char_table=self.char_table)
+
+    def batch_pairwise(self, strings, rows, cols):
+        """Compute distances between pairs of strings of a collection."""
+        return string_distance_pairs(
+            strings, rows, cols, dist_mat=self.dist_mat,
+            dist_mat_max=self.dist_mat_max, tol=self.tol,
+            max_distance=self.max_distance)
 
 
 class IgDistance(Distance):
@@ -290,6 +557,53 @@ def correction_function(x):
     return 1 - x / 100.
 
 
+def apply_correction(values, rows, cols, mut, correct_by, combine='mean'):
+    """Correct similarities or distances for the mutation level.
+
+    Each positive value, for the pair of records ``(rows[k], cols[k])``, is
+    multiplied by `correct_by` of the mean (or maximum) mutation level of
+    the two records, clipped in [0, 1]. `correct_by` is evaluated once on
+    the array of all the mutation levels, such as a learned `np.poly1d`.
+    Functions which only accept scalars are evaluated on each unique level.
+
+    Parameters
+    ----------
+    values : array_like
+        Uncorrected similarities or distances. They are not modified, so
+        they can be corrected again with a different function.
+    rows, cols : array_like
+        Indices of the records of each pair.
+    mut : array_like
+        Mutation level of each record.
+    correct_by : function
+        Correction for a mutation level.
+    combine : ('mean', 'max'), optional, default: 'mean'
+        How the mutation levels of two records are combined.
+
+    Returns
+    -------
+    corrected : array
+        Corrected values. Negative values are set to 0.
+    """
+    if combine not in ('mean', 'max'):
+        raise ValueError("combine must be 'mean' or 'max', got %r" % combine)
+    corrected = np.array(values, dtype=float)
+    positive = np.flatnonzero(corrected > 0)
+    mut = np.asarray(mut, dtype=float)
+    mut1, mut2 = mut[np.asarray(rows)[positive]], mut[np.asarray(cols)[
+        positive]]
+    levels = np.maximum(mut1, mut2) if combine == 'max' else \
+        (mut1 + mut2) / 2.
+    try:
+        correction = np.asarray(correct_by(levels), dtype=float)
+    except (TypeError, ValueError):
+        unique_levels, inverse = np.unique(levels, return_inverse=True)
+        correction = np.array([correct_by(x) for x in unique_levels],
+                              dtype=float)[inverse]
+    corrected[positive] *= np.clip(correction, 0, 1)
+    return np.maximum(corrected, 0)
+
+
 def distance_dataframe(s, x1, x2, rm_duplicates=False, tol=3,
                        junction_dist=None, correct=False,
                        correct_by=correction_function,
@@ -333,6 +647,161 @@ def distance_dataframe(s, x1, x2, rm_duplicates=False, tol=3,
     return max(distance, 0)
 
 
+class DataFrameDistance(object):
+    """Distance between records of a dataframe, backed by NumPy arrays.
+
+    It computes the same distance of `distance_dataframe`, but the columns
+    used by the distance are extracted once, so each evaluation only indexes
+    arrays. Objects can be pickled, so they can be used as a callable
+    metric in parallel sklearn estimators, as in::
+
+        DBSCAN(metric=DataFrameDistance(s), algorithm='brute', n_jobs=-1)
+
+    where samples are the positions of the records in `s`.
+
+    Parameters
+    ----------
+    s : pandas.DataFrame
+        Records, as loaded by `icing.utils.io.load_dataframe`.
+    """
+
+    def __init__(self, s, rm_duplicates=False, tol=3, junction_dist=None,
+                 correct=False, correct_by=correction_function,
+                 model='nt'):
+        self.rm_duplicates = rm_duplicates
+        self.tol = tol
+        self.junction_dist = junction_dist
+        self.correct = correct
+        self.correct_by = correct_by
+
+        model = 'aa_' if model == 'aa' else ''
+        self.junctions = s[model + 'junc'].values
+        self.junction_codes = pd.factorize(self.junctions)[0]
+        self.lengths = s[model + 'junction_length'].values.astype(int)
+        self.mut = s['mut'].values.astype(float)
+
+        gene_sets = {}
+        self.v_gene_ids = np.array([gene_sets.setdefault(
+            frozenset(x), len(gene_sets)) for x in s['v_gene_set'].values],
+            dtype=int)
+        self.v_gene_sets = [None] * len(gene_sets)
+        for k, v in extra.items_iterator(gene_sets):
+            self.v_gene_sets[v] = k
+
+    def __call__(self, x1, x2):
+        """Compute the distance between two records.
+
+        Parameters
+        ----------
+        x1, x2 : array-like
+            Arrays whose first element is the position of a record.
+        """
+        i, j = int(x1[0]), int(x2[0])
+        shared_v = not self.v_gene_sets[self.v_gene_ids[i]].isdisjoint(
+            self.v_gene_sets[self.v_gene_ids[j]])
+
+        if self.junction_codes[i] == self.junction_codes[j]:
+            if shared_v:
+                return 1 if self.rm_duplicates else 0
+            return 1
+
+        if abs(self.lengths[i] - self.lengths[j]) > self.tol or not shared_v:
+            return 1
+
+        distance = self.junction_dist.pairwise(
+            self.junctions[i], self.junctions[j])
+        if 1 > distance > 0 and self.correct:
+            correction = self.correct_by(max(self.mut[i], self.mut[j]))
+            distance *= np.clip(correction, 0, 1)
+        return max(distance, 0)
+
+    def graph(self, idxs=None, max_distance=1.):
+        """Compute the sparse graph of distances between records.
+
+        Distances are computed only for the pairs of records which share a
+        V gene and have a junction length difference of at most `tol`.
+        All other pairs have distance 1.
+
+        Parameters
+        ----------
+        idxs : array-like, optional
+            Positions of the records to use. If None, use all the records.
+        max_distance : float, optional, default: 1
+            Only distances strictly lower than `max_distance` are stored.
+
+        Returns
+        -------
+        graph : scipy.sparse.csr_matrix, shape (n_records, n_records)
+            Symmetric matrix of distances. Null distances are stored
+            explicitly, so it can be used with `metric='precomputed'` in
+            sklearn estimators.
+        """
+        from icing.core.parallel_distance import candidate_pairs
+        if idxs is None:
+            idxs = np.arange(self.lengths.shape[0])
+        idxs = np.asarray(idxs, dtype=int)
+        junctions = self.junctions[idxs]
+        codes = self.junction_codes[idxs]
+        lengths = self.lengths[idxs]
+        v_gene_sets = [self.v_gene_sets[x] for x in self.v_gene_ids[idxs]]
+
+        rows, cols = candidate_pairs(v_gene_sets, lengths, self.tol)
+        use_blocks = isinstance(self.junction_dist, StringDistance) and \
+            block_weights(self.junction_dist.dist_mat) is not None
+        if use_blocks:
+            # equal-length junctions are compared with block products
+            unequal = lengths[rows] != lengths[cols]
+            rows, cols = rows[unequal], cols[unequal]
+
+        same = codes[rows] == codes[cols]
+        distances = np.zeros(rows.shape[0])
+        if self.rm_duplicates:
+            distances[same] = 1
+        diff = np.where(~same)[0]
+        distances[diff] = self.junction_dist.batch_pairwise(
+            junctions, rows[diff], cols[diff])
+
+        if use_blocks:
+            genes = {}
+            for i, gene_set in enumerate(v_gene_sets):
+                for gene in gene_set or ():
+                    genes.setdefault(gene, []).append(i)
+            # correction can only lower distances, so filter after it
+            block_rows, block_cols, block_distances = block_string_distances(
+                junctions, genes.values(), self.junction_dist.dist_mat,
+                self.junction_dist.dist_mat_max,
+                max_distance=1. if self.correct else max_distance)
+            if self.rm_duplicates:
+                block_distances[codes[block_rows] == codes[block_cols]] = 1
+            rows = np.concatenate((rows, block_rows))
+            cols = np.concatenate((cols, block_cols))
+            distances = np.concatenate((distances, block_distances))
+
+        if self.correct:
+            to_correct = (distances > 0) & (distances < 1)
+            distances[to_correct] = apply_correction(
+                distances[to_correct], rows[to_correct], cols[to_correct],
+                self.mut[idxs], self.correct_by, combine='max')
+
+        mask = distances < max_distance
+        rows, cols, distances = rows[mask], cols[mask], distances[mask]
+        n = idxs.shape[0]
+        return csr_matrix((np.concatenate((distances, distances)),
+                           (np.concatenate((rows, cols)),
+                            np.concatenate((cols, rows)))), shape=(n, n))
+
+
+def sparse_distance_dataframe(s, idxs=None, max_distance=1., **kwargs):
+    """Compute the sparse graph of distances between records.
+
+    The distance is the same of `distance_dataframe`, but it is computed only
+    for the pairs of records which share a V gene and have a junction length
+    difference of at most `tol`. See `DataFrameDistance.graph`.
+    """
+    return DataFrameDistance(s, **kwargs).graph(
+        idxs, max_distance=max_distance)
+
+
 def ig_distance(s, x1, x2, rm_duplicates=False, tol=3, junction_dist=None,
                 correct=False):
     """Compute pairwise similarity.
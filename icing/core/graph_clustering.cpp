@@ -0,0 +1,230 @@
+/* author: Federico Tomasi
+ * license: FreeBSD License
+ * copyright: Copyright (C) 2016 Federico Tomasi
+ *
+ * Local moving of nodes between communities of a weighted undirected graph,
+ * which is the inner loop of the Louvain method for modularity optimisation,
+ * and union-find of the endpoints of a list of edges.
+ */
+#include <Python.h>
+#include <algorithm>
+#include <vector>
+
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <numpy/arrayobject.h>
+
+// Park-Miller minimal standard generator, to shuffle nodes deterministically
+static inline unsigned long next_random(unsigned long *state) {
+    *state = (*state * 48271UL) % 2147483647UL;
+    return *state;
+}
+
+static PyObject *
+local_moving(PyObject *self, PyObject *args, PyObject *keywds) {
+    PyArrayObject *indptr_arr, *indices_arr, *data_arr, *communities_arr;
+    double resolution = 1.;
+    unsigned long seed = 0;
+    int max_iter = 100;
+
+    static char *kwlist[] = {"indptr", "indices", "data", "communities",
+                             "resolution", "seed", "max_iter", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "O!O!O!O!|dki", kwlist,
+            &PyArray_Type, &indptr_arr, &PyArray_Type, &indices_arr,
+            &PyArray_Type, &data_arr, &PyArray_Type, &communities_arr,
+            &resolution, &seed, &max_iter))
+        return NULL;
+
+    if (PyArray_TYPE(indptr_arr) != NPY_INT32 ||
+            PyArray_TYPE(indices_arr) != NPY_INT32 ||
+            PyArray_TYPE(communities_arr) != NPY_INT32 ||
+            PyArray_TYPE(data_arr) != NPY_FLOAT64 ||
+            !PyArray_IS_C_CONTIGUOUS(indptr_arr) ||
+            !PyArray_IS_C_CONTIGUOUS(indices_arr) ||
+            !PyArray_IS_C_CONTIGUOUS(data_arr) ||
+            !PyArray_IS_C_CONTIGUOUS(communities_arr)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "expected contiguous int32 indptr, indices and "
+                        "communities, and float64 data");
+        return NULL;
+    }
+
+    const npy_intp n = PyArray_SIZE(communities_arr);
+    if (PyArray_SIZE(indptr_arr) != n + 1) {
+        PyErr_SetString(PyExc_ValueError,
+                        "indptr and communities have inconsistent sizes");
+        return NULL;
+    }
+    const npy_int32 *indptr = (npy_int32 *) PyArray_DATA(indptr_arr);
+    const npy_int32 *indices = (npy_int32 *) PyArray_DATA(indices_arr);
+    const double *data = (double *) PyArray_DATA(data_arr);
+
+    PyArrayObject *result = (PyArrayObject *) PyArray_NewCopy(
+        communities_arr, NPY_CORDER);
+    if (result == NULL) return NULL;
+    npy_int32 *community = (npy_int32 *) PyArray_DATA(result);
+    long n_moves = 0;
+
+    Py_BEGIN_ALLOW_THREADS
+    // weighted degree of nodes and total degree of communities
+    std::vector<double> degree(n, 0.), total(n, 0.);
+    double total_weight = 0.;
+    for (npy_intp i = 0; i < n; ++i) {
+        for (npy_int32 k = indptr[i]; k < indptr[i + 1]; ++k)
+            degree[i] += data[k];
+        total[community[i]] += degree[i];
+        total_weight += degree[i];
+    }
+
+    std::vector<npy_int32> order(n);
+    for (npy_intp i = 0; i < n; ++i) order[i] = (npy_int32) i;
+    unsigned long state = seed % 2147483646UL + 1;
+    for (npy_intp i = n - 1; i > 0; --i)
+        std::swap(order[i], order[next_random(&state) % (i + 1)]);
+
+    // weight from the current node to each neighbouring community
+    std::vector<double> link(n, 0.);
+    std::vector<npy_int32> neighbours;
+    neighbours.reserve(64);
+
+    for (int iter = 0; total_weight > 0 && iter < max_iter; ++iter) {
+        long moves = 0;
+        for (npy_intp o = 0; o < n; ++o) {
+            const npy_int32 i = order[o];
+            const npy_int32 old = community[i];
+            neighbours.clear();
+            neighbours.push_back(old);
+            link[old] = 0.;
+            for (npy_int32 k = indptr[i]; k < indptr[i + 1]; ++k) {
+                const npy_int32 j = indices[k];
+                if (j == i) continue;
+                const npy_int32 c = community[j];
+                if (link[c] == 0. && c != old) neighbours.push_back(c);
+                link[c] += data[k];
+            }
+
+            // modularity gain of adding i to each community, without i
+            total[old] -= degree[i];
+            const double scale = resolution * degree[i] / total_weight;
+            npy_int32 best = old;
+            double best_gain = link[old] - scale * total[old];
+            for (size_t t = 1; t < neighbours.size(); ++t) {
+                const npy_int32 c = neighbours[t];
+                const double gain = link[c] - scale * total[c];
+                if (gain > best_gain) {
+                    best_gain = gain;
+                    best = c;
+                }
+            }
+            total[best] += degree[i];
+            community[i] = best;
+            if (best != old) ++moves;
+
+            for (size_t t = 0; t < neighbours.size(); ++t)
+                link[neighbours[t]] = 0.;
+        }
+        n_moves += moves;
+        if (moves == 0) break;
+    }
+    Py_END_ALLOW_THREADS
+
+    return Py_BuildValue("Nl", (PyObject *) result, n_moves);
+}
+
+static inline npy_intp find_root(npy_intp *parent, npy_intp i) {
+    while (parent[i] != i) {
+        parent[i] = parent[parent[i]];  // path halving
+        i = parent[i];
+    }
+    return i;
+}
+
+static PyObject *
+union_find(PyObject *self, PyObject *args, PyObject *keywds) {
+    PyObject *rows_obj, *cols_obj;
+    Py_ssize_t n_samples;
+
+    static char *kwlist[] = {"rows", "cols", "n_samples", NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "OOn", kwlist,
+            &rows_obj, &cols_obj, &n_samples))
+        return NULL;
+
+    PyArrayObject *rows_arr = (PyArrayObject *) PyArray_FROMANY(
+        rows_obj, NPY_INTP, 1, 1, NPY_ARRAY_IN_ARRAY);
+    if (rows_arr == NULL) return NULL;
+    PyArrayObject *cols_arr = (PyArrayObject *) PyArray_FROMANY(
+        cols_obj, NPY_INTP, 1, 1, NPY_ARRAY_IN_ARRAY);
+    if (cols_arr == NULL) {
+        Py_DECREF(rows_arr);
+        return NULL;
+    }
+    const npy_intp n_edges = PyArray_SIZE(rows_arr);
+    const npy_intp *rows = (npy_intp *) PyArray_DATA(rows_arr);
+    const npy_intp *cols = (npy_intp *) PyArray_DATA(cols_arr);
+    int valid = PyArray_SIZE(cols_arr) == n_edges;
+    for (npy_intp k = 0; valid && k < n_edges; ++k)
+        valid = rows[k] >= 0 && rows[k] < n_samples &&
+                cols[k] >= 0 && cols[k] < n_samples;
+    if (!valid) {
+        Py_DECREF(rows_arr);
+        Py_DECREF(cols_arr);
+        PyErr_SetString(PyExc_ValueError,
+                        "rows and cols must have the same size, with "
+                        "values in [0, n_samples)");
+        return NULL;
+    }
+
+    npy_intp dims[1] = {(npy_intp) n_samples};
+    PyArrayObject *result = (PyArrayObject *) PyArray_SimpleNew(
+        1, dims, NPY_INTP);
+    if (result == NULL) {
+        Py_DECREF(rows_arr);
+        Py_DECREF(cols_arr);
+        return NULL;
+    }
+    npy_intp *labels = (npy_intp *) PyArray_DATA(result);
+
+    Py_BEGIN_ALLOW_THREADS
+    std::vector<npy_intp> parent(n_samples), size(n_samples, 1);
+    for (npy_intp i = 0; i < n_samples; ++i) parent[i] = i;
+    for (npy_intp k = 0; k < n_edges; ++k) {
+        npy_intp a = find_root(&parent[0], rows[k]);
+        npy_intp b = find_root(&parent[0], cols[k]);
+        if (a == b) continue;
+        if (size[a] < size[b]) std::swap(a, b);  // union by size
+        parent[b] = a;
+        size[a] += size[b];
+    }
+
+    // number components by their first sample
+    std::vector<npy_intp> component(n_samples, -1);
+    npy_intp n_components = 0;
+    for (npy_intp i = 0; i < n_samples; ++i) {
+        const npy_intp root = find_root(&parent[0], i);
+        if (component[root] < 0) component[root] = n_components++;
+        labels[i] = component[root];
+    }
+    Py_END_ALLOW_THREADS
+
+    Py_DECREF(rows_arr);
+    Py_DECREF(cols_arr);
+    return (PyObject *) result;
+}
+
+static PyMethodDef GraphClusteringMethods[] = {
+    {"local_moving", (PyCFunction)local_moving, METH_VARARGS | METH_KEYWORDS,
+     "local_moving(indptr, indices, data, communities, resolution=1., "
+     "seed=0, max_iter=100)\n\n"
+     "Move nodes of a symmetric CSR graph between communities while the "
+     "modularity increases.\nReturn the new communities and the number of "
+     "moves."},
+    {"union_find", (PyCFunction)union_find, METH_VARARGS | METH_KEYWORDS,
+     "union_find(rows, cols, n_samples)\n\n"
+     "Connected components of the graph with edges (rows[k], cols[k]).\n"
+     "Return the component of each sample, numbered by first sample."},
+    {NULL, NULL, 0, NULL}        /* Sentinel */
+};
+
+PyMODINIT_FUNC initgraphclustering(void) {
+    (void) Py_InitModule("graphclustering", GraphClusteringMethods);
+    import_array();
+}
@@ -0,0 +1,79 @@
+/* author: Federico Tomasi
+ * license: FreeBSD License
+ * copyright: Copyright (C) 2016 Federico Tomasi
+ *
+ * Sum of the distances between the characters of two aligned junctions,
+ * which stops as soon as the partial sum exceeds a cutoff.
+ */
+#define PY_SSIZE_T_CLEAN
+#include <Python.h>
+
+#define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
+#include <numpy/arrayobject.h>
+
+static PyObject *
+weighted_mismatches(PyObject *self, PyObject *args, PyObject *keywds) {
+    const char *seq1, *seq2;
+    Py_ssize_t len1, len2;
+    PyArrayObject *lookup_arr, *table_arr;
+    double max_sum = Py_HUGE_VAL;
+
+    static char *kwlist[] = {"seq1", "seq2", "lookup", "table", "max_sum",
+                             NULL};
+    if (!PyArg_ParseTupleAndKeywords(args, keywds, "s#s#O!O!|d", kwlist,
+            &seq1, &len1, &seq2, &len2, &PyArray_Type, &lookup_arr,
+            &PyArray_Type, &table_arr, &max_sum))
+        return NULL;
+
+    if (PyArray_TYPE(lookup_arr) != NPY_INT32 ||
+            PyArray_SIZE(lookup_arr) != 256 ||
+            !PyArray_IS_C_CONTIGUOUS(lookup_arr) ||
+            PyArray_TYPE(table_arr) != NPY_FLOAT64 ||
+            PyArray_NDIM(table_arr) != 2 ||
+            PyArray_DIM(table_arr, 0) != PyArray_DIM(table_arr, 1) ||
+            !PyArray_IS_C_CONTIGUOUS(table_arr)) {
+        PyErr_SetString(PyExc_ValueError,
+                        "expected a contiguous int32 lookup of size 256 and "
+                        "a square contiguous float64 table");
+        return NULL;
+    }
+    const npy_int32 *lookup = (npy_int32 *) PyArray_DATA(lookup_arr);
+    const double *table = (double *) PyArray_DATA(table_arr);
+    const npy_intp n_chars = PyArray_DIM(table_arr, 0);
+
+    // characters are compared up to the shorter sequence
+    const Py_ssize_t length = len1 < len2 ? len1 : len2;
+    double total = 0.;
+    int invalid = 0;
+    for (Py_ssize_t k = 0; k < length; ++k) {
+        const npy_int32 a = lookup[(unsigned char) seq1[k]];
+        const npy_int32 b = lookup[(unsigned char) seq2[k]];
+        if (a < 0 || b < 0 || a >= n_chars || b >= n_chars) {
+            invalid = 1;
+            break;
+        }
+        total += table[a * n_chars + b];
+        if (total > max_sum) break;  // the pair cannot be within the cutoff
+    }
+    if (invalid) {
+        PyErr_SetString(PyExc_ValueError,
+                        "Some characters are not in the model alphabet");
+        return NULL;
+    }
+    return PyFloat_FromDouble(total);
+}
+
+static PyMethodDef JunctionDistanceMethods[] = {
+    {"weighted_mismatches", (PyCFunction)weighted_mismatches,
+     METH_VARARGS | METH_KEYWORDS,
+     "weighted_mismatches(seq1, seq2, lookup, table, max_sum=inf)\n\n"
+     "Sum table[lookup[seq1[k]], lookup[seq2[k]]] over the positions of the "
+     "sequences.\nStop as soon as the sum exceeds max_sum, and return the "
+     "partial sum."},
+    {NULL, NULL, 0, NULL}        /* Sentinel */
+};
+
+PyMODINIT_FUNC initjunctiondistance(void) {
+    (void) Py_InitModule("junctiondistance", JunctionDistanceMethods);
+    import_array();
+}
@@ -0,0 +1,277 @@
+"""Metric trees over junctions, for radius queries.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import numpy as np
+
+from sklearn.utils import check_random_state
+
+from icing.core.distances import StringDistance
+
+
+class VPTree(object):
+    """Vantage point tree over strings.
+
+    Each node keeps a vantage point and the median `mu` of the distances
+    between the vantage point and the strings below it. Strings closer than
+    `mu` go in the inside subtree, the others in the outside one. A radius
+    query skips a subtree when the triangle inequality guarantees that it
+    has no string within the radius.
+
+    Parameters
+    ----------
+    strings : array-like
+        String sequences.
+    junction_dist : Distance
+        Distance between strings, with `pairwise` and `batch_pairwise`.
+    leaf_size : int, optional, default: 16
+        Maximum number of strings in a leaf, compared one by one.
+    random_state : int, RandomState instance or None, optional
+        Used to choose the vantage points.
+
+    Attributes
+    ----------
+    n_evaluations_ : int
+        Number of distances computed to build the tree.
+    """
+
+    def __init__(self, strings, junction_dist, leaf_size=16,
+                 random_state=None):
+        self.strings = np.asarray(strings, dtype=object)
+        self.junction_dist = junction_dist
+        self.leaf_size = leaf_size
+        self.n_evaluations_ = 0
+        self.root_ = self._build(np.arange(self.strings.shape[0]),
+                                 check_random_state(random_state))
+
+    def _distances(self, string, idx):
+        """Distances between a string and the strings in `idx`."""
+        strings = np.empty(idx.shape[0] + 1, dtype=object)
+        strings[0], strings[1:] = string, self.strings[idx]
+        return self.junction_dist.batch_pairwise(
+            strings, np.zeros(idx.shape[0], dtype=int),
+            np.arange(1, idx.shape[0] + 1))
+
+    def _build(self, idx, random_state):
+        if idx.shape[0] <= self.leaf_size:
+            return idx
+        pos = random_state.randint(idx.shape[0])
+        vantage, others = idx[pos], np.delete(idx, pos)
+        distances = self._distances(self.strings[vantage], others)
+        self.n_evaluations_ += others.shape[0]
+        mu = np.median(distances)
+        inside = distances <= mu
+        if inside.all():
+            # all the strings are equidistant, do not split them further
+            return idx
+        return (vantage, mu, self._build(others[inside], random_state),
+                self._build(others[~inside], random_state))
+
+    def query_radius(self, string, radius, slack=0., start=0):
+        """Find the strings within a distance from `string`.
+
+        Parameters
+        ----------
+        string : str
+            Query string.
+        radius : float
+            Maximum distance of the strings to return.
+        slack : float, optional, default: 0.
+            Margin added to the pruning bounds. Distances which violate the
+            triangle inequality by less than `slack` do not lose neighbours.
+        start : int, optional, default: 0
+            Only return strings at positions not lower than `start`. Leaves
+            skip the other strings, so that a self-join of the tree computes
+            the distance of each pair once.
+
+        Returns
+        -------
+        idx : array
+            Positions of the strings within `radius`.
+        distances : array
+            Their distances from `string`.
+        n_evaluations : int
+            Number of distances computed by the query.
+        """
+        found, found_distances = [], []
+        n_evaluations = 0
+        stack = [self.root_]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, np.ndarray):
+                node = node[node >= start]
+                distances = self._distances(string, node)
+                n_evaluations += node.shape[0]
+                found.append(node[distances <= radius])
+                found_distances.append(distances[distances <= radius])
+                continue
+
+            vantage, mu, inside, outside = node
+            distance = self.junction_dist.pairwise(
+                string, self.strings[vantage])
+            n_evaluations += 1
+            if distance <= radius and vantage >= start:
+                found.append(np.array([vantage]))
+                found_distances.append(np.array([distance]))
+            if distance - radius - slack <= mu:
+                stack.append(inside)
+            if distance + radius + slack > mu:
+                stack.append(outside)
+
+        if not found:
+            return np.empty(0, dtype=int), np.empty(0), n_evaluations
+        return (np.concatenate(found), np.concatenate(found_distances),
+                n_evaluations)
+
+
+class JunctionIndex(object):
+    """Radius queries on junctions which share a V gene.
+
+    A `VPTree` is built for each V gene and junction length. Queries visit
+    the trees of the query V genes, for lengths differing by at most `tol`.
+
+    Between junctions with the same length, the distance of `StringDistance`
+    is a normalised Hamming distance, and pruning is exact. Junctions with
+    different lengths are aligned, gaps cost as wildcards and the distance
+    is normalised by the aligned length, so the triangle inequality does
+    not hold. Such queries are only pruned with a finite `slack`, which
+    trades distance evaluations for recall (see
+    `icing.validation.pruning.compare_metric_tree`).
+
+    Parameters
+    ----------
+    junctions : array-like
+        Junction of each record.
+    v_genes : array-like
+        For each record, an iterable of its V genes.
+    junction_dist : Distance, optional
+        Distance between junctions. Default is `StringDistance()`.
+    tol : int, optional, default: 3
+        Tolerance in the length of the junctions.
+    leaf_size : int, optional, default: 16
+        Maximum number of junctions in a leaf of the trees.
+    slack : float, optional, default: np.inf
+        Margin added to the pruning bounds of queries on junctions with a
+        different length. See `VPTree.query_radius`. The default visits all
+        the junctions with a different length.
+    random_state : int, RandomState instance or None, optional
+        Used to choose the vantage points.
+
+    Attributes
+    ----------
+    n_evaluations_ : int
+        Number of distances computed to build the trees and by the queries.
+    n_candidates_ : int
+        Number of distances an exhaustive search would have computed for the
+        same queries.
+    """
+
+    def __init__(self, junctions, v_genes, junction_dist=None, tol=3,
+                 leaf_size=16, slack=np.inf, random_state=None):
+        self.junctions = np.asarray(junctions, dtype=object)
+        self.v_genes = list(v_genes)
+        self.junction_dist = junction_dist or StringDistance()
+        self.tol = tol
+        self.leaf_size = leaf_size
+        self.slack = slack
+        random_state = check_random_state(random_state)
+
+        self.lengths = np.array([len(x) for x in self.junctions], dtype=int)
+        buckets = {}
+        for i, genes in enumerate(self.v_genes):
+            for gene in genes or ():
+                buckets.setdefault((gene, self.lengths[i]), []).append(i)
+        self.trees_ = {}
+        for key, idx in buckets.items():
+            idx = np.array(idx, dtype=int)
+            self.trees_[key] = (idx, VPTree(
+                self.junctions[idx], self.junction_dist, leaf_size=leaf_size,
+                random_state=random_state))
+        self.n_evaluations_ = sum(
+            tree.n_evaluations_ for _, tree in self.trees_.values())
+        self.n_candidates_ = 0
+
+    def query(self, junction, v_genes, radius, lengths=None, start=0):
+        """Find the junctions within a distance, sharing a V gene.
+
+        Parameters
+        ----------
+        junction : str
+            Query junction. It does not need to be in the index.
+        v_genes : iterable
+            V genes of the query.
+        radius : float
+            Maximum distance of the junctions to return.
+        lengths : iterable, optional
+            Junction lengths to search. Default is all the lengths which
+            differ by at most `tol` from the query.
+        start : int, optional, default: 0
+            Only return junctions with index not lower than `start`.
+
+        Returns
+        -------
+        idx : array
+            Positions of the junctions within `radius`, sorted.
+        distances : array
+            Their distances from `junction`.
+        """
+        if lengths is None:
+            lengths = range(len(junction) - self.tol,
+                            len(junction) + self.tol + 1)
+        found = [np.empty(0, dtype=int)]
+        found_distances = [np.empty(0)]
+        for gene in v_genes or ():
+            for length in lengths:
+                if (gene, length) not in self.trees_:
+                    continue
+                idx, tree = self.trees_[gene, length]
+                # positions in the tree follow the order of the indices
+                first = np.searchsorted(idx, start)
+                pos, distances, n_evaluations = tree.query_radius(
+                    junction, radius, start=first,
+                    slack=0. if length == len(junction) else self.slack)
+                self.n_evaluations_ += n_evaluations
+                self.n_candidates_ += idx.shape[0] - first
+                found.append(idx[pos])
+                found_distances.append(distances)
+
+        idx, first = np.unique(np.concatenate(found), return_index=True)
+        return idx, np.concatenate(found_distances)[first]
+
+    def radius_graph(self, radius):
+        """Find all the pairs of indexed junctions within a distance.
+
+        Parameters
+        ----------
+        radius : float
+            Maximum distance between the junctions of a pair.
+
+        Returns
+        -------
+        rows, cols : array
+            Indices of the pairs, with rows < cols, sorted by row then col.
+        distances : array
+            Distances between the junctions of each pair.
+        """
+        n = self.junctions.shape[0]
+        pairs, distances = [np.empty(0, dtype=np.int64)], [np.empty(0)]
+        for i in range(n):
+            # each pair is found from its shorter junction, or from its
+            # lower index if the junctions have the same length
+            idx, dist = self.query(
+                self.junctions[i], self.v_genes[i], radius,
+                lengths=[self.lengths[i]], start=i + 1)
+            longer_idx, longer_dist = self.query(
+                self.junctions[i], self.v_genes[i], radius, lengths=range(
+                    self.lengths[i] + 1, self.lengths[i] + self.tol + 1))
+            idx = np.concatenate((idx, longer_idx))
+            dist = np.concatenate((dist, longer_dist))
+            keep = idx != i
+            pairs.append(np.minimum(i, idx[keep]).astype(np.int64) * n +
+                         np.maximum(i, idx[keep]))
+            distances.append(dist[keep])
+        pairs, first = np.unique(np.concatenate(pairs), return_index=True)
+        return ((pairs // n).astype(int), (pairs % n).astype(int),
+                np.concatenate(distances)[first])
@@ -7,14 +7,24 @@ Author: Federico Tomasi
 Copyright (c) 2016, Federico Tomasi.
 Licensed under the FreeBSD license (see LICENSE.txt).
 """
+import logging
 import multiprocessing as mp
 import numpy as np
 import scipy
 import scipy.spatial
+import time
+import traceback
+
+from itertools import chain, ifilter, combinations, islice, izip
+from sklearn.utils import check_random_state
 
-from itertools import chain, ifilter, combinations, islice
 from icing.utils.extra import term_processes, progressbar
 
+try:
+    import Queue
+except ImportError:  # python3
+    import queue as Queue
+
 try:
     xrange
 except NameError:  # python3
@@ -28,6 +38,187 @@ def _min(generator, func):
         return 0
 
 
+def cost_chunks(costs, n_chunks):
+    """Split work into chunks with similar costs, most expensive first.
+
+    Parameters
+    ----------
+    costs : array_like
+        Estimated cost of each unit of work.
+    n_chunks : int
+        Maximum number of chunks.
+
+    Returns
+    -------
+    order : array
+        Units of work sorted by decreasing cost.
+    chunks : list of tuple
+        Bounds ``(start, end)`` of the chunks in `order`.
+    """
+    costs = np.asarray(costs, dtype=float)
+    order = np.argsort(-costs, kind='mergesort')
+    cumulative = np.cumsum(costs[order])
+    if costs.shape[0] == 0:
+        return order, []
+    bounds = np.searchsorted(cumulative, np.linspace(
+        0, cumulative[-1], max(n_chunks, 1) + 1)[1:-1], side='right')
+    bounds = np.unique(np.concatenate(([0], bounds, [costs.shape[0]])))
+    return order, list(zip(bounds[:-1], bounds[1:]))
+
+
+def _scheduled_worker(idx, work, tasks, results):
+    busy = wait = 0.
+    outputs = []
+    try:
+        while True:
+            tic = time.time()
+            chunk = tasks.get()
+            wait += time.time() - tic
+            if chunk is None:
+                break
+            tic = time.time()
+            outputs.append(work(*chunk))
+            busy += time.time() - tic
+    except BaseException as e:
+        # the parent re-raises the error, instead of waiting forever
+        results.put((idx, None, dict(error=e,
+                                     traceback=traceback.format_exc())))
+        return
+    results.put((idx, outputs, dict(busy=busy, wait=wait,
+                                    n_chunks=len(outputs))))
+
+
+def _scheduled_results(results, procs, timeout):
+    """Get the result of each process, failing if one of them died."""
+    done = set()
+    while len(done) < len(procs):
+        try:
+            idx, output, stat = results.get(timeout=timeout)
+        except Queue.Empty:
+            dead = [i for i, p in enumerate(procs)
+                    if i not in done and not p.is_alive()]
+            if not dead:
+                continue
+            try:
+                # a process may have exited right after its last put
+                idx, output, stat = results.get(timeout=timeout)
+            except Queue.Empty:
+                raise RuntimeError(
+                    "Worker %d exited with code %s without results"
+                    % (dead[0], procs[dead[0]].exitcode))
+        if 'error' in stat:
+            logging.error("Worker %d failed:\n%s", idx, stat['traceback'])
+            raise stat['error']
+        done.add(idx)
+        yield idx, output, stat
+
+
+def schedule(work, chunks, nprocs, timeout=1.):
+    """Run work on chunks, handed out to processes from a shared queue.
+
+    Each process takes the next chunk as soon as it finishes the previous
+    one, so that no process stays idle while others still have work.
+
+    Parameters
+    ----------
+    work : function
+        Called as ``work(start, end)`` for each chunk, in a child process.
+    chunks : list of tuple
+        Bounds of the chunks, in the order in which to hand them out.
+    nprocs : int
+        Number of processes.
+    timeout : float, optional, default: 1.
+        Interval in seconds at which the processes are checked while
+        waiting for their results.
+
+    Returns
+    -------
+    outputs : list
+        Return values of `work`, in order of completion.
+    stats : list of dict
+        For each process, the time spent computing (``busy``), waiting for
+        chunks (``wait``) and not computing (``idle``) in seconds, and the
+        number of chunks (``n_chunks``).
+
+    Raises
+    ------
+    Exception
+        The error raised by `work` in a child process, or a RuntimeError if
+        a process died without results. The other processes are terminated.
+    """
+    nprocs = max(min(nprocs, len(chunks)), 1)
+    tasks, results = mp.Queue(), mp.Queue()
+    for chunk in chunks:
+        tasks.put(chunk)
+    for _ in xrange(nprocs):
+        tasks.put(None)
+
+    procs = []
+    outputs, stats = [], []
+    tic = time.time()
+    try:
+        for idx in xrange(nprocs):
+            p = mp.Process(target=_scheduled_worker,
+                           args=(idx, work, tasks, results))
+            p.start()
+            procs.append(p)
+
+        # results are collected before joining, so that processes can
+        # flush them
+        for idx, output, stat in _scheduled_results(results, procs,
+                                                    timeout):
+            outputs.extend(output)
+            stat['worker'] = idx
+            stats.append(stat)
+        for p in procs:
+            p.join()
+    except (KeyboardInterrupt, SystemExit):
+        term_processes(procs, 'Exit signal received\n')
+    except BaseException:
+        for p in procs:
+            p.terminate()
+            p.join()
+        raise
+
+    elapsed = time.time() - tic
+    for stat in sorted(stats, key=lambda x: x['worker']):
+        stat['idle'] = max(elapsed - stat['busy'], 0.)
+        logging.info("Worker %d: %d chunks, busy %.2fs, idle %.2fs",
+                     stat['worker'], stat['n_chunks'], stat['busy'],
+                     stat['idle'])
+    return outputs, sorted(stats, key=lambda x: x['worker'])
+
+
+def estimate_pair_costs(lengths, rows, cols, alignment=True, kn_range=1):
+    """Estimate the relative cost of computing the similarity of pairs.
+
+    Parameters
+    ----------
+    lengths : array_like
+        Junction length of each record.
+    rows, cols : array_like
+        Indices of the pairs.
+    alignment : bool, optional, default: True
+        If True, junctions with different lengths are aligned, with cost
+        ``l1 * l2``, and junctions with the same length are compared
+        position by position, with cost ``l1``, as in `StringDistance`.
+        If False, each pair costs ``l1 * l2 * kn_range``, as string kernels
+        with `kn_range` k-mer lengths.
+    kn_range : int, optional, default: 1
+        Number of k-mer lengths of string kernels.
+
+    Returns
+    -------
+    costs : array
+        Estimated cost of each pair.
+    """
+    lengths = np.asarray(lengths, dtype=float)
+    len1, len2 = lengths[np.asarray(rows)], lengths[np.asarray(cols)]
+    if not alignment:
+        return len1 * len2 * kn_range
+    return np.where(len1 == len2, len1, len1 * len2)
+
+
 def dnearest_inter_padding(l1, l2, dist_function, filt=None, func=min):
     """Compute in a parallel way a dist2nearest for two 1-d arrays.
 
@@ -99,11 +290,11 @@ def dnearest_intra_padding(l1, dist_function, filt=None, func=min):
     dist2nearest : array_like
         1-D array
     """
-    def _internal(l1, n, idx, nprocs, shared_arr, dist_function):
-        for i in xrange(idx, n, nprocs):
+    def _internal(start, end):
+        for i in order[start:end]:
             # if i % 100 == 0:
             #     progressbar(i, n)
-            shared_arr[i] = _min(ifilter(filt, chain(
+            shared_array[i] = _min(ifilter(filt, chain(
                 (dist_function(l1[i], l1[j]) for j in xrange(0, i)),
                 (dist_function(l1[i], l1[j]) for j in xrange(i + 1, n))
             )), func)
@@ -111,21 +302,9 @@ def dnearest_intra_padding(l1, dist_function, filt=None, func=min):
     n = len(l1)
     nprocs = min(mp.cpu_count(), n)
     shared_array = mp.Array('d', [0.] * n)
-    procs = []
-    try:
-        for idx in xrange(nprocs):
-            p = mp.Process(target=_internal,
-                           args=(l1, n, idx, nprocs, shared_array,
-                                 dist_function))
-            p.start()
-            procs.append(p)
-
-        for p in procs:
-            p.join()
-    except (KeyboardInterrupt, SystemExit):
-        term_processes(procs, 'Exit signal received\n')
-    except BaseException as msg:
-        term_processes(procs, 'ERROR: %s\n' % msg)
+    # rows have the same number of pairs, small chunks balance the rest
+    order, chunks = cost_chunks(np.ones(n), nprocs * 16)
+    schedule(_internal, chunks, nprocs)
 
     # progressbar(n, n)
     return shared_array
@@ -194,34 +373,22 @@ def dm_dense_intra_padding(l1, dist_function, condensed=False):
     dist_matrix : array_like
         Symmetric NxN distance matrix for each input_array element.
     """
-    def _internal(l1, n, idx, nprocs, shared_arr, dist_function):
-        for i in xrange(idx, n, nprocs):
+    def _internal(start, end):
+        for i in order[start:end]:
             if i % 2 == 0:
                 progressbar(i, n)
             # shared_arr[i, i:] = [dist_function(l1[i], el2) for el2 in l2]
             for j in xrange(i + 1, n):
-                shared_arr[i, j] = dist_function(l1[i], l1[j])
+                shared_array[i, j] = dist_function(l1[i], l1[j])
                 # if shared_arr[idx, j] == 0:
                 # print l1[i].junction, '\n', l1[j].junction, '\n----------'
 
     n = len(l1)
     nprocs = min(mp.cpu_count(), n)
     shared_array = np.frombuffer(mp.Array('d', n*n).get_obj()).reshape((n, n))
-    procs = []
-    try:
-        for idx in xrange(nprocs):
-            p = mp.Process(target=_internal,
-                           args=(l1, n, idx, nprocs, shared_array,
-                                 dist_function))
-            p.start()
-            procs.append(p)
-
-        for p in procs:
-            p.join()
-    except (KeyboardInterrupt, SystemExit):
-        term_processes(procs, 'Exit signal received\n')
-    except BaseException as msg:
-        term_processes(procs, 'ERROR: %s\n' % msg)
+    # row i has n - i - 1 pairs
+    order, chunks = cost_chunks(n - np.arange(n) - 1., nprocs * 16)
+    schedule(_internal, chunks, nprocs)
 
     progressbar(n, n)
     dist_matrix = shared_array + shared_array.T
@@ -237,7 +404,285 @@ def _job(n, X, tol):
         return (i, j)
 
 
-def sm_sparse(X, metric, tol):
+def candidate_pairs(v_genes, lengths, tol):
+    """Compute the pairs of records which share a V gene and a length.
+
+    For each V gene, records are sorted by junction length, so that the
+    pairs with a length difference of at most `tol` are generated by array
+    operations, without visiting all the possible pairs.
+
+    Parameters
+    ----------
+    v_genes : array_like
+        For each record, an iterable of its V genes.
+    lengths : array_like
+        Junction length of each record.
+    tol : int
+        Tolerance in the length of the junctions.
+
+    Returns
+    -------
+    rows, cols : array_like
+        Indices of the pairs, with rows < cols, sorted by row then col.
+    """
+    lengths = np.asarray(lengths)
+    n = lengths.shape[0]
+    index = {}
+    for i, genes in enumerate(v_genes):
+        for gene in genes or ():
+            index.setdefault(gene, []).append(i)
+
+    codes = [np.empty(0, dtype=np.int64)]
+    for idx in index.values():
+        idx = np.asarray(idx)
+        idx = idx[np.argsort(lengths[idx], kind='mergesort')]
+        lens = lengths[idx]
+        m = idx.shape[0]
+        # partners of position k are positions k+1, ..., end[k] - 1
+        end = np.searchsorted(lens, lens + tol, side='right')
+        counts = end - np.arange(1, m + 1)
+        total = counts.sum()
+        if total == 0:
+            continue
+        offsets = np.arange(total) - np.repeat(
+            np.cumsum(counts) - counts, counts)
+        first = np.repeat(np.arange(m), counts)
+        i, j = idx[first], idx[first + 1 + offsets]
+        codes.append(np.minimum(i, j).astype(np.int64) * n + np.maximum(i, j))
+    codes = np.unique(np.concatenate(codes))
+    return (codes // n).astype(int), (codes % n).astype(int)
+
+
+def _pairs_by_key(keys, idx):
+    """Compute the pairs of elements of `idx` with the same key."""
+    order = np.argsort(keys, kind='mergesort')
+    keys, idx = keys[order], idx[order]
+    m = keys.shape[0]
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    sizes = np.diff(np.r_[starts, m])
+    # partners of position k are positions k+1, ..., end[k] - 1
+    counts = np.repeat(starts + sizes, sizes) - np.arange(1, m + 1)
+    total = counts.sum()
+    offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    first = np.repeat(np.arange(m), counts)
+    return idx[first], idx[first + 1 + offsets]
+
+
+def is_hamming_model(dist_mat):
+    """Return True if `dist_mat` only contains null or unit distances."""
+    values = np.asarray(dist_mat, dtype=float)
+    return bool(np.all((values == 0) | (values == 1)) and
+                np.all(np.diag(values) == 0))
+
+
+def hamming_candidate_pairs(v_genes, junctions, lengths, tol, max_distance,
+                            dist_mat):
+    """Compute candidate pairs, with a pigeonhole index for equal lengths.
+
+    As `candidate_pairs`, but pairs of junctions with the same length are
+    kept only if their normalised Hamming distance is at most
+    `max_distance`. A junction of length L is split into r + 1 segments,
+    with ``r = floor(max_distance * L)``, and two junctions within distance
+    r share at least one segment. So only junctions sharing a segment are
+    compared, with a vectorised Hamming check.
+
+    Characters with null distance from other characters, such as 'N' in the
+    'ham' model, are wildcards. Junctions which contain them are kept as
+    candidates with all the junctions of the same length.
+
+    Parameters
+    ----------
+    v_genes : array_like
+        For each record, an iterable of its V genes.
+    junctions : array_like
+        Junction of each record.
+    lengths : array_like
+        Junction length of each record, used with `tol`.
+    tol : int
+        Tolerance in the length of the junctions.
+    max_distance : float
+        Maximum normalised Hamming distance between equal-length junctions.
+    dist_mat : pandas.DataFrame
+        Distance between characters, with null or unit values. See
+        `is_hamming_model`.
+
+    Returns
+    -------
+    rows, cols : array_like
+        Indices of the pairs, with rows < cols, sorted by row then col.
+    """
+    if not is_hamming_model(dist_mat):
+        raise ValueError("The distance matrix is not a Hamming model")
+    junctions = np.asarray(junctions, dtype=object)
+    lengths = np.asarray(lengths)
+    n = junctions.shape[0]
+    rows, cols = candidate_pairs(v_genes, lengths, tol)
+    junction_lengths = np.array([len(x) for x in junctions], dtype=int)
+    unequal = junction_lengths[rows] != junction_lengths[cols]
+    codes = [rows[unequal].astype(np.int64) * n + cols[unequal]]
+
+    # remove wildcards until the other characters have unit distances
+    chars = np.unique(np.fromstring(''.join(junctions), dtype=np.uint8))
+    alphabet = [chr(c) for c in chars]
+    if not set(alphabet) <= set(dist_mat.index):
+        raise ValueError("Some characters are not in the model alphabet")
+    matches = dist_mat.loc[alphabet, alphabet].values == 0
+    matches = (matches | matches.T) & ~np.eye(chars.shape[0], dtype=bool)
+    wildcard = np.zeros(chars.shape[0], dtype=bool)
+    while np.any(matches[~wildcard][:, ~wildcard]):
+        counts = matches[:, ~wildcard].sum(axis=1)
+        counts[wildcard] = -1
+        wildcard[np.argmax(counts)] = True
+    is_wildcard = np.zeros(256, dtype=bool)
+    is_wildcard[chars[wildcard]] = True
+
+    index = {}
+    for i, genes in enumerate(v_genes):
+        for gene in genes or ():
+            index.setdefault(gene, []).append(i)
+    for group in index.values():
+        group = np.asarray(group, dtype=int)
+        group = group[np.argsort(junction_lengths[group], kind='mergesort')]
+        bounds = np.flatnonzero(np.diff(junction_lengths[group])) + 1
+        for idx in np.split(group, bounds):
+            if idx.shape[0] < 2:
+                continue
+            length = junction_lengths[idx[0]]
+            encoded = np.fromstring(''.join(junctions[idx]), dtype=np.uint8
+                                    ).reshape(idx.shape[0], length)
+            dirty = is_wildcard[encoded].any(axis=1)
+            for i in idx[dirty]:
+                codes.append(np.minimum(i, idx).astype(np.int64) * n +
+                             np.maximum(i, idx))
+
+            clean, encoded = idx[~dirty], encoded[~dirty]
+            radius = int(np.floor(max_distance * length + 1e-9))
+            if radius + 1 > length:
+                i, j = _pairs_by_key(np.zeros(clean.shape[0]), clean)
+            else:
+                segments = np.linspace(0, length, radius + 2).astype(int)
+                pairs = [np.empty(0, dtype=np.int64)]
+                for start, end in zip(segments[:-1], segments[1:]):
+                    keys = np.unique(np.ascontiguousarray(
+                        encoded[:, start:end]).view(
+                            np.dtype((np.void, end - start))),
+                        return_inverse=True)[1]
+                    i, j = _pairs_by_key(keys, np.arange(clean.shape[0]))
+                    pairs.append(np.minimum(i, j).astype(np.int64) *
+                                 clean.shape[0] + np.maximum(i, j))
+                pairs = np.unique(np.concatenate(pairs))
+                i, j = pairs // clean.shape[0], pairs % clean.shape[0]
+                within = (encoded[i] != encoded[j]).sum(axis=1) <= radius
+                i, j = clean[i[within]], clean[j[within]]
+            i, j = np.minimum(i, j), np.maximum(i, j)
+            close = np.abs(lengths[i] - lengths[j]) <= tol
+            codes.append(i[close].astype(np.int64) * n + j[close])
+
+    codes = np.unique(np.concatenate(codes))
+    codes = codes[codes // n != codes % n]
+    return (codes // n).astype(int), (codes % n).astype(int)
+
+
+def minhash_candidate_pairs(v_genes, junctions, lengths, tol, k=3,
+                            n_bands=16, n_rows=4, random_state=None):
+    """Compute candidate pairs whose junctions share many k-mers.
+
+    As `candidate_pairs`, but pairs are kept only if their junctions agree
+    on at least one band of their MinHash signatures. A signature is made
+    of ``n_bands * n_rows`` minima of random hash functions over the set of
+    k-mers of a junction, grouped in `n_bands` bands of `n_rows` values.
+    Two junctions whose k-mer sets have Jaccard similarity s agree on a
+    band with probability ``s ** n_rows``, so they are kept with probability
+    ``1 - (1 - s ** n_rows) ** n_bands``. More bands or fewer rows increase
+    the recall and the number of pairs kept.
+
+    This is an approximate filter: similar junctions may be missed. Check
+    its recall with `icing.validation.pruning.compare_minhash`.
+
+    Parameters
+    ----------
+    v_genes : array_like
+        For each record, an iterable of its V genes.
+    junctions : array_like
+        Junction of each record.
+    lengths : array_like
+        Junction length of each record, used with `tol`.
+    tol : int
+        Tolerance in the length of the junctions.
+    k : int, optional, default: 3
+        Length of k-mers. Junctions shorter than `k` are a single k-mer.
+    n_bands : int, optional, default: 16
+        Number of bands of the signatures.
+    n_rows : int, optional, default: 4
+        Number of hash values in each band.
+    random_state : int, RandomState instance or None, optional
+        Used to draw the hash functions.
+
+    Returns
+    -------
+    rows, cols : array_like
+        Indices of the pairs, with rows < cols, sorted by row then col.
+    """
+    junctions = np.asarray(junctions, dtype=object)
+    lengths = np.asarray(lengths)
+    n = junctions.shape[0]
+    random_state = check_random_state(random_state)
+
+    index = {}
+    for i, genes in enumerate(v_genes):
+        for gene in genes or ():
+            index.setdefault(gene, []).append(i)
+    groups = [np.asarray(g, dtype=int) for g in index.values() if len(g) > 1]
+    if not groups:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+
+    # k-mer sets of unique junctions, as rows of a CSR structure
+    unique, inverse = np.unique(junctions, return_inverse=True)
+    vocabulary = {}
+    indptr, indices = [0], []
+    for junction in unique:
+        kmers = set(junction[i:i + k]
+                    for i in range(len(junction) - k + 1)) or set([junction])
+        indices.extend(vocabulary.setdefault(x, len(vocabulary))
+                       for x in kmers)
+        indptr.append(len(indices))
+    indices = np.array(indices, dtype=np.int64)
+
+    prime = 2147483647  # hash functions (a * x + b) mod prime
+    codes = [np.empty(0, dtype=np.int64)]
+    for _ in range(n_bands):
+        a = random_state.randint(1, prime, size=(n_rows, 1)).astype(np.int64)
+        b = random_state.randint(0, prime, size=(n_rows, 1)).astype(np.int64)
+        signatures = np.minimum.reduceat(
+            (a * indices + b) % prime, indptr[:-1], axis=1).T
+        keys = np.unique(np.ascontiguousarray(signatures).view(
+            np.dtype((np.void, signatures.itemsize * n_rows))).ravel(),
+            return_inverse=True)[1][inverse]
+        for group in groups:
+            i, j = _pairs_by_key(keys[group], group)
+            i, j = np.minimum(i, j), np.maximum(i, j)
+            close = np.abs(lengths[i] - lengths[j]) <= tol
+            codes.append(i[close].astype(np.int64) * n + j[close])
+
+    codes = np.unique(np.concatenate(codes))
+    return (codes // n).astype(int), (codes % n).astype(int)
+
+
+def index_dtype_for(dtype, n_samples):
+    """Integer type for indices of `n_samples` samples with values of `dtype`.
+
+    Values of 32 bits are coupled with 32 bits indices, if they fit.
+    """
+    if np.dtype(dtype).itemsize > 4:
+        return np.dtype(np.intp)
+    if n_samples > np.iinfo(np.int32).max:
+        raise ValueError("Too many samples (%d) for 32 bits indices"
+                         % n_samples)
+    return np.dtype(np.int32)
+
+
+def sm_sparse(X, metric, tol, dtype=np.float64, min_similarity=0.,
+              pairs=None, costs=None, return_stats=False):
     """Compute in a parallel way a sim matrix for a 1-d array.
 
     Parameters
@@ -247,47 +692,40 @@ def sm_sparse(X, metric, tol):
         elements of l1.
     dist_function : function
         Function to use for the distance computation.
+    dtype : numpy dtype, optional, default: np.float64
+        Type of similarities. With np.float32, indices are stored as
+        np.int32, which halves the memory of the output.
+    min_similarity : float, optional, default: 0.
+        Similarities lower than this are discarded by the workers as soon as
+        they are computed.
+    pairs : tuple of array_like, optional
+        Rows and columns of the pairs on which to compute similarities. If
+        None, use `candidate_pairs`.
+    costs : array_like, optional
+        Estimated cost of each pair. Pairs are sorted by decreasing cost and
+        handed out to the processes in small chunks of similar cost from a
+        shared queue. If None, use `estimate_pair_costs` on the length of
+        the junctions (or of the strings) of X.
+    return_stats : bool, optional, default: False
+        Also return, for each process, its busy and idle time as computed
+        by `schedule`.
 
     Returns
     -------
-    dist_matrix : array_like
-        Symmetric NxN distance matrix for each input_array element.
+    data, rows, cols : array_like
+        Similarities of the pairs which are kept, and their indices.
+    stats : list of dict
+        Only if `return_stats` is True.
     """
-    def _internal(X, metric, iterator, idx, return_queue):
-        data = np.empty(0, dtype=float)
-        rows = np.empty(0, dtype=int)
-        cols = np.empty(0, dtype=int)
-        append = np.append
-        for i, j in iterator:
-            res = metric(X[i], X[j])
-            if res > 0:
-                data = append(data, res)
-                rows = append(rows, i)
-                cols = append(cols, j)
-        return_queue.put((data, rows, cols), False)
-        return_queue.put(None, True)
-
-    def _internal_deque(X, metric, iterator, idx, return_queue):
-        from collections import deque
-        deq = deque()
-        appendleft = deq.appendleft
-        popleft = deq.popleft
-        for i, j in iterator:
-            res = metric(X[i], X[j])
-            if res > 0:  # np.random.ranf(1)[0] / 10:
-                appendleft((res, i, j))
-
-        len_d = len(deq)
-        data = np.empty(len_d, dtype=float)
-        rows = np.empty(len_d, dtype=int)
-        cols = np.empty(len_d, dtype=int)
-        for i in xrange(len_d):
-            res = popleft()
-            data[i] = res[0]
-            rows[i] = res[1]
-            cols[i] = res[2]
-        return_queue.put((data, rows, cols), False)
-        return_queue.put(None, True)
+    dtype = np.dtype(dtype)
+    index_dtype = index_dtype_for(dtype, X.shape[0])
+
+    def _internal(start, end):
+        idx = order[start:end]
+        res = np.array([metric(X[i], X[j]) for i, j in izip(
+            pair_rows[idx], pair_cols[idx])], dtype=float)
+        keep = (res > 0) & (res >= min_similarity)
+        return idx[keep], res[keep].astype(dtype)
 
     n = X.shape[0]
     nprocs = min(mp.cpu_count(), n)
@@ -351,49 +789,29 @@ def sm_sparse(X, metric, tol):
     #
     # iterator = opt_iterator()
 
-    iterator = list(
-        (i, j) for i, j in combinations(xrange(X.shape[0]), 2) if
-        len(X[i].setV & X[j].setV) > 0 and
-        abs(X[i].junction_length - X[j].junction_length) <= tol)
+    if pairs is None:
+        pairs = candidate_pairs(
+            [x.setV for x in X], [x.junction_length for x in X], tol)
+    pair_rows = np.asarray(pairs[0], dtype=int)
+    pair_cols = np.asarray(pairs[1], dtype=int)
+    if costs is None:
+        costs = estimate_pair_costs(
+            [len(getattr(x, 'junc', x)) for x in X], pair_rows, pair_cols)
     # print(time.time() - tic)
     # pool.close()
-    len_it = len(iterator)
-    procs = []
-    manager = mp.Manager()
-    return_queue = manager.Queue()
-    data = np.empty(0, dtype=float)
-    rows = np.empty(0, dtype=int)
-    cols = np.empty(0, dtype=int)
-    try:
-        for idx in xrange(nprocs):
-            num_elem = int(len_it / nprocs) + 1
-            itera = iterator[:num_elem]
-            iterator = iterator[num_elem:]
-            # itera = list(islice(iterator, int(n * (n - 1) / (2. * nprocs)) + 1))
-            p = mp.Process(
-                target=_internal_deque,
-                args=(X, metric, itera, idx, return_queue))
-            p.start()
-            procs.append(p)
-
-        count = 0
-        while count < nprocs:
-            v = return_queue.get(True)
-            if v is None:
-                count += 1
-                continue
-            data = np.hstack((data, v[0]))
-            rows = np.hstack((rows, v[1]))
-            cols = np.hstack((cols, v[2]))
-
-        for p in procs:
-            p.join()
-        assert return_queue.empty()
-
-    except (KeyboardInterrupt, SystemExit):
-        term_processes(procs, 'Exit signal received\n')
-    except BaseException as msg:
-        term_processes(procs, 'ERROR: %s\n' % msg)
+    order, chunks = cost_chunks(costs, nprocs * 64)
+    outputs, stats = schedule(_internal, chunks, nprocs)
+
+    # keep the pairs in their original order, whatever the schedule
+    idx = np.concatenate([np.empty(0, dtype=int)] + [x[0] for x in outputs])
+    data = np.concatenate([np.empty(0, dtype=dtype)] +
+                          [x[1] for x in outputs])
+    sort = np.argsort(idx, kind='mergesort')
+    idx, data = idx[sort], data[sort]
+    rows = pair_rows[idx].astype(index_dtype)
+    cols = pair_cols[idx].astype(index_dtype)
+    if return_stats:
+        return data, rows, cols, stats
     return data, rows, cols
 
 
@@ -119,7 +119,7 @@ def _sparse_sum_update(data, rows, diag_idxs):
 
 
 def _update_r_max_row(data, row_indptr):
-    max_row = np.empty(data.shape[0])
+    max_row = np.empty(data.shape[0], dtype=data.dtype)
     for i in range(row_indptr.shape[0] - 1):
         i_start = row_indptr[i]
         i_end = row_indptr[i + 1]
@@ -130,19 +130,23 @@ def _update_r_max_row(data, row_indptr):
 
 
 def _copy_symmetric_elem(rows, cols, data, single_rows):
-    # mask = np.logical_and(rows != cols, np.in1d(cols, list(single_rows)))
-    rows_copy = np.empty(0, dtype=int)
-    cols_copy = np.empty(0, dtype=int)
-    data_copy = np.empty(0)
-    for ind in single_rows:
-        mask = np.logical_and(cols == ind, cols != rows)
-        idx = np.argmin(data[mask])
-        rows_copy = np.append(rows_copy, cols[mask][idx])
-        cols_copy = np.append(cols_copy, rows[mask][idx])
-        data_copy = np.append(data_copy, data[mask][idx])
-    rows = np.concatenate((rows, rows_copy))
-    cols = np.concatenate((cols, cols_copy))
-    data = np.concatenate((data, data_copy))
+    """Copy the transposed minimum element of the columns of single rows.
+
+    For each row in `single_rows`, the minimum off-diagonal element of the
+    column with the same index is copied in the symmetric position. Ties are
+    broken by the position of the element in the input arrays.
+    """
+    idx = np.where(np.logical_and(
+        np.in1d(cols, single_rows), cols != rows))[0]
+    # group by column, then sort each group by value (stable on position)
+    idx = idx[np.lexsort((idx, data[idx], cols[idx]))]
+    first = np.ones(idx.shape[0], dtype=bool)
+    first[1:] = cols[idx][1:] != cols[idx][:-1]
+    idx = idx[first]
+
+    rows, cols = (np.concatenate((rows, cols[idx])),
+                  np.concatenate((cols, rows[idx])))
+    data = np.concatenate((data, data[idx]))
     return rows, cols, data
 
 
@@ -172,56 +176,56 @@ def remove_single_samples(rows, cols, data, n_samples):
         Rows and columns for the sparse matrix. Data is row-based.
     n_samples : int
         Number of samples in the original input data.
+
+    Returns
+    -------
+    rows, cols, data : array-like
+        Rows and columns for the sparse matrix, sorted by row.
+    left_ori : array-like or None
+        Original index of each sample left, if any sample was removed.
+    single_samples : array-like or None
+        Sorted original indices of the removed samples.
+    n_samples : int
+        Number of samples left.
     """
     # find rows and cols that only have one datapoint
-    unique, counts = np.unique(rows, return_counts=True)
-    single_rows = unique[counts < 2]
-    unique, counts = np.unique(cols, return_counts=True)
-    single_cols = unique[counts < 2]
-    if single_rows.shape[0] == 0 and single_cols.shape[0] == 0:
+    single_rows = np.bincount(rows, minlength=n_samples) == 1
+    single_cols = np.bincount(cols, minlength=n_samples) == 1
+    if not np.any(single_rows) and not np.any(single_cols):
         return rows, cols, data, None, None, n_samples
 
-    single_rows, single_cols = set(single_rows), set(single_cols)
-    single_samples = single_rows & single_cols
-    left_ori_dict = None
-    if len(single_samples) > 0:
-        # row indexs that left after remove single samples
-        mask = np.ones(n_samples, dtype=bool)
-        mask[np.array(single_samples)] = False
-        # map of original row index to current row index(after remove rows/cols
-        # that only have single item)
-        ori_left_dict, left_ori_dict = {}, {}
-        for left, ori in enumerate(np.arange(n_samples)[mask]):
-            ori_left_dict[ori] = left
-            left_ori_dict[left] = ori
-
-        # remove single elements outside the diagonal
-        mask = np.ones(rows.shape[0], dtype=bool)
-        mask[single_samples] = False
-        idx_to_leave = np.logical_or(rows == cols, mask)
+    is_single_sample = np.logical_and(single_rows, single_cols)
+    single_samples = np.where(is_single_sample)[0]
+    left_ori = None
+    if single_samples.shape[0] > 0:
+        # remove all elements of single samples
+        idx_to_leave = ~np.logical_or(
+            is_single_sample[rows], is_single_sample[cols])
         rows = rows[idx_to_leave]
         cols = cols[idx_to_leave]
         data = data[idx_to_leave]
 
     # If some row have a single data point, copy the min value in col
-    single_rows = single_rows - single_samples
-    if len(single_rows) > 0:
+    single_rows = np.where(np.logical_and(single_rows, ~is_single_sample))[0]
+    if single_rows.shape[0] > 0:
         rows, cols, data = _copy_symmetric_elem(rows, cols, data, single_rows)
 
     # If some col have a single data point, copy the min value in row
-    single_cols = single_cols - single_samples
-    if len(single_cols) > 0:
+    single_cols = np.where(np.logical_and(single_cols, ~is_single_sample))[0]
+    if single_cols.shape[0] > 0:
         cols, rows, data = _copy_symmetric_elem(cols, rows, data, single_cols)
 
     # change row, col index if there is any sample removed
-    if len(single_samples) > 0:
-        change_idx = np.vectorize(lambda x: ori_left_dict[x])
-        rows = change_idx(rows)
-        cols = change_idx(cols)
-        n_samples -= len(single_samples)
+    if single_samples.shape[0] > 0:
+        # map of original index to current index (after removing samples)
+        left_ori = np.where(~is_single_sample)[0]
+        ori_left = np.cumsum(~is_single_sample) - 1
+        rows = ori_left[rows]
+        cols = ori_left[cols]
+        n_samples -= single_samples.shape[0]
 
     idx_sorted_left_ori = np.lexsort((cols, rows))
     rows = rows[idx_sorted_left_ori]
     cols = cols[idx_sorted_left_ori]
     data = data[idx_sorted_left_ori]
-    return rows, cols, data, left_ori_dict, single_samples, n_samples
+    return rows, cols, data, left_ori, single_samples, n_samples
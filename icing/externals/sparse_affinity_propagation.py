@@ -15,7 +15,9 @@ Original authors for sklearn:
 # License: BSD 3 clause
 """
 import numpy as np
+import time
 
+from collections import deque
 from scipy.sparse import coo_matrix
 from scipy.sparse import issparse
 from sklearn.cluster import AffinityPropagation
@@ -30,7 +32,9 @@ from ._sparse_affinity_propagation import (
 
 def sparse_ap(S, preference=None, convergence_iter=15, max_iter=200,
               damping=0.5, copy=True, verbose=False,
-              return_n_iter=False, convergence_percentage=0.999999):
+              return_n_iter=False, convergence_percentage=0.999999,
+              convergence='labels', adaptive_damping=False, callback=None,
+              return_trace=False):
     """Perform Affinity Propagation Clustering of data.
 
     Same as affinity_propagation(), but assume S be a sparse matrix.
@@ -71,6 +75,28 @@ def sparse_ap(S, preference=None, convergence_iter=15, max_iter=200,
     return_n_iter : bool, default False
         Whether or not to return the number of iterations.
 
+    convergence_percentage : float, optional, default: 0.999999
+        Fraction of labels which must not change in an iteration for it to
+        count towards convergence. Used only with ``convergence='labels'``.
+
+    convergence : ('labels', 'exemplars'), optional, default: 'labels'
+        With 'labels', stop when labels do not change for `convergence_iter`
+        iterations. With 'exemplars', stop when the set of exemplars does
+        not change for `convergence_iter` iterations; this avoids computing
+        labels at each iteration.
+
+    adaptive_damping : boolean, optional, default: False
+        Increase the damping by 0.05 (up to 0.95) when the set of exemplars
+        oscillates, i.e., it changes back to one of the last four sets.
+
+    callback : callable, optional
+        Called after each iteration as ``callback(record)``, where `record`
+        is the row of the trace for the iteration (see `return_trace`). If it
+        returns True, iterations are stopped.
+
+    return_trace : bool, default False
+        Whether or not to return the trace of the iterations.
+
     Returns
     -------
 
@@ -84,6 +110,14 @@ def sparse_ap(S, preference=None, convergence_iter=15, max_iter=200,
         number of iterations run. Returned only if `return_n_iter` is
         set to True.
 
+    trace : structured array, shape (n_iter,)
+        For each iteration, the fraction of labels changed
+        (``label_change``), the number of exemplars (``n_exemplars``), the
+        net similarity, i.e., the sum of similarities between each sample and
+        its exemplar (``net_similarity``), the damping used (``damping``)
+        and the wall time in seconds since the first iteration (``time``).
+        Returned only if `return_trace` is set to True.
+
     Notes
     -----
     See examples/cluster/plot_affinity_propagation.py for an example.
@@ -93,24 +127,106 @@ def sparse_ap(S, preference=None, convergence_iter=15, max_iter=200,
     Brendan J. Frey and Delbert Dueck, "Clustering by Passing Messages
     Between Data Points", Science Feb. 2007
     """
-    # rows, cols, data = matrix_to_row_col_data(S)
-    rows, cols, data = S.row, S.col, as_float_array(S.data, copy=copy)
-    n_samples = S.shape[0]
+    if damping < 0.5 or damping >= 1:
+        raise ValueError('damping must be >= 0.5 and < 1')
+
+    problem = _sparse_ap_setup(S, copy=copy)
+    preferences = parse_preference(preference, S.shape[0], problem['data'])
+    data = _sparse_ap_data(problem, preferences)
+    A = np.zeros(data.shape[0], dtype=data.dtype)
+    R = np.zeros(data.shape[0], dtype=data.dtype)
+
+    labels, it, trace = _sparse_ap_iterate(
+        problem, data, A, R, convergence_iter=convergence_iter,
+        max_iter=max_iter, damping=damping, verbose=verbose,
+        convergence_percentage=convergence_percentage,
+        convergence=convergence, adaptive_damping=adaptive_damping,
+        callback=callback, trace=return_trace)
+    cluster_centers_indices, labels = _sparse_ap_labels(problem, labels)
+
+    result = (cluster_centers_indices, labels)
+    if return_n_iter:
+        result += (it + 1,)
+    if return_trace:
+        result += (trace,)
+    return result
+
+
+def sparse_ap_path(S, preferences, convergence_iter=15, max_iter=200,
+                   damping=0.5, copy=True, verbose=False,
+                   convergence_percentage=0.999999, convergence='labels',
+                   adaptive_damping=False):
+    """Perform Affinity Propagation Clustering for a sequence of preferences.
+
+    The sparse structure of `S` is preprocessed once, and each preference is
+    warm started with the responsibilities and availabilities of the
+    previous one. Warm starts are most effective when consecutive
+    preferences are close, e.g., when they are sorted.
+
+    Parameters
+    ----------
+    S : array-like, shape (n_samples, n_samples)
+        Matrix of similarities between points
 
-    preferences = parse_preference(preference, n_samples, data)
+    preferences : list
+        Sequence of preferences. Each one is a float, an array-like of shape
+        (n_samples,), 'median' or 'min', as for `sparse_ap`.
+
+    Other parameters are the same of `sparse_ap`.
+
+    Returns
+    -------
+
+    cluster_centers_indices : list of arrays
+        Index of clusters centers for each preference.
+
+    labels : array, shape (n_preferences, n_samples)
+        Cluster labels of each point for each preference.
+
+    n_iter : array, shape (n_preferences,)
+        Number of iterations run for each preference.
+    """
     if damping < 0.5 or damping >= 1:
         raise ValueError('damping must be >= 0.5 and < 1')
-    if convergence_percentage is None:
-        convergence_percentage = 1
 
-    random_state = np.random.RandomState(0)
+    problem = _sparse_ap_setup(S, copy=copy)
+    A = np.zeros(problem['s_data'].shape[0], dtype=problem['s_data'].dtype)
+    R = np.zeros(problem['s_data'].shape[0], dtype=problem['s_data'].dtype)
+
+    centers_path, labels_path, n_iter_path = [], [], []
+    for preference in preferences:
+        data = _sparse_ap_data(problem, parse_preference(
+            preference, S.shape[0], problem['data']))
+        labels, it, _ = _sparse_ap_iterate(
+            problem, data, A, R, convergence_iter=convergence_iter,
+            max_iter=max_iter, damping=damping, verbose=verbose,
+            convergence_percentage=convergence_percentage,
+            convergence=convergence, adaptive_damping=adaptive_damping)
+        cluster_centers_indices, labels = _sparse_ap_labels(problem, labels)
+        centers_path.append(cluster_centers_indices)
+        labels_path.append(labels)
+        n_iter_path.append(it + 1)
+    return centers_path, np.array(labels_path), np.array(n_iter_path)
+
+
+def _sparse_ap_setup(S, copy=True):
+    """Precompute the sparse structure used by the AP iterations.
+
+    The structure does not depend on preferences, which are only placed on
+    the diagonal by `_sparse_ap_data`. Messages have the same type of `S`
+    (float32 or float64); with float32 similarities, indices are int32.
+    """
+    # rows, cols, data = matrix_to_row_col_data(S)
+    rows, cols, data = S.row, S.col, as_float_array(S.data, copy=copy)
+    n_samples = S.shape[0]
 
-    # Place preference on the diagonal of S
-    rows, cols, data = _set_sparse_diagonal(rows, cols, data, preferences)
-    rows, cols, data, left_ori_dict, idx_single_samples, n_samples = \
-        remove_single_samples(rows, cols, data, n_samples)
+    # Place a dummy preference on the diagonal of S
+    rows, cols, s_data = _set_sparse_diagonal(
+        rows, cols, data.copy(), np.zeros(n_samples, dtype=data.dtype))
+    rows, cols, s_data, left_ori, idx_single_samples, n_samples = \
+        remove_single_samples(rows, cols, s_data, n_samples)
 
-    data_len = data.shape[0]
+    data_len = s_data.shape[0]
     row_indptr = np.append(
         np.insert(np.where(np.diff(rows) > 0)[0] + 1, 0, 0), data_len)
 
@@ -122,25 +238,89 @@ def sparse_ap(S, preference=None, convergence_iter=15, max_iter=200,
     col_indptr = np.append(
         np.insert(np.where(np.diff(cols_colbased) > 0)[0] + 1, 0, 0), data_len)
 
-    kk_row_index = np.where(rows == cols)[0]
-    kk_col_index = np.where(rows_colbased == cols_colbased)[0]
+    index_dtype = np.int32 if data.dtype.itemsize <= 4 else np.intp
+    return dict(
+        data=data, s_data=s_data, cols=cols, n_samples=n_samples,
+        left_ori=left_ori, idx_single_samples=idx_single_samples,
+        row_indptr=row_indptr, col_indptr=col_indptr,
+        row_to_col_idx=row_to_col_idx.astype(index_dtype, copy=False),
+        col_to_row_idx=col_to_row_idx.astype(index_dtype, copy=False),
+        kk_row_index=np.where(rows == cols)[0].astype(
+            index_dtype, copy=False),
+        kk_col_index=np.where(rows_colbased == cols_colbased)[0].astype(
+            index_dtype, copy=False))
+
+
+def _sparse_ap_data(problem, preferences):
+    """Similarities with preferences on the diagonal, without degeneracies."""
+    data = problem['s_data'].copy()
+    if problem['left_ori'] is not None:
+        preferences = preferences[problem['left_ori']]
+    data[problem['kk_row_index']] = preferences
+
+    # Remove degeneracies, at the precision of data
+    random_state = np.random.RandomState(0)
+    finfo = np.finfo(data.dtype)
+    data += ((finfo.eps * data + finfo.tiny * 100) *
+             random_state.randn(data.shape[0])).astype(data.dtype)
+    return data
+
+
+def _dense_to_coo(X):
+    """Sparse matrix with all the entries of X, including null similarities.
+
+    `coo_matrix` drops zeros, which would remove edges from the problem.
+    """
+    rows, cols = np.indices(X.shape)
+    return coo_matrix((X.ravel(), (rows.ravel(), cols.ravel())),
+                      shape=X.shape)
+
+
+TRACE_DTYPE = np.dtype([
+    ('label_change', float), ('n_exemplars', int),
+    ('net_similarity', float), ('damping', float), ('time', float)])
+
+
+def _sparse_ap_iterate(problem, data, A, R, convergence_iter=15,
+                       max_iter=200, damping=0.5, verbose=False,
+                       convergence_percentage=0.999999, convergence='labels',
+                       adaptive_damping=False, callback=None, trace=False):
+    """Update availabilities A and responsibilities R in place.
+
+    Returns the index of the exemplar element of each row, the last
+    iteration and the trace of iterations (None if `trace` is False).
+    """
+    if convergence not in ('labels', 'exemplars'):
+        raise ValueError("convergence must be 'labels' or 'exemplars'. "
+                         "Got %s instead" % str(convergence))
+    if convergence_percentage is None:
+        convergence_percentage = 1
+    row_indptr = problem['row_indptr']
+    col_indptr = problem['col_indptr']
+    row_to_col_idx = problem['row_to_col_idx']
+    col_to_row_idx = problem['col_to_row_idx']
+    kk_row_index = problem['kk_row_index']
+    kk_col_index = problem['kk_col_index']
 
-    # Initialize messages
-    A = np.zeros(data_len, dtype=float)
-    R = np.zeros(data_len, dtype=float)
     # Intermediate results
-    tmp = np.zeros(data_len, dtype=float)
+    tmp = np.zeros(data.shape[0], dtype=data.dtype)
 
-    # Remove degeneracies
-    data += ((np.finfo(np.double).eps * data + np.finfo(np.double).tiny * 100)
-             * random_state.randn(data_len))
+    # labels are needed at each iteration only to check their convergence
+    # or to record them
+    record = trace or callback is not None
+    compute_labels = convergence == 'labels' or record
+    records = []
+    start_time = time.time()
 
     labels = np.empty(0, dtype=np.int)
     last_labels = None
+    exemplars = np.zeros(kk_row_index.shape[0], dtype=bool)
+    # recent sets of exemplars, to detect oscillations
+    history = deque(maxlen=4)
     convergence_count = 0
 
     for it in range(max_iter):
-        last_labels = labels.copy()
+        last_labels = labels
 
         # tmp = A + S; compute responsibilities
         np.add(A, data, tmp)
@@ -165,13 +345,41 @@ def sparse_ap(S, preference=None, convergence_iter=15, max_iter=200,
         A *= damping
         A -= tmp
 
+        exemplars = (A[kk_row_index] + R[kk_row_index]) > 0
+        if compute_labels:
+            labels = _sparse_row_maxindex(A + R, row_indptr)
+
         # Check for convergence
-        labels = _sparse_row_maxindex(A + R, row_indptr)
-        if labels.shape[0] == 0 or np.sum(last_labels == labels) / \
-                float(labels.shape[0]) < convergence_percentage:
-            convergence_count = 0
+        if convergence == 'labels':
+            stable = labels.shape[0] > 0 and np.sum(last_labels == labels) / \
+                float(labels.shape[0]) >= convergence_percentage
         else:
-            convergence_count += 1
+            stable = np.any(exemplars) and len(history) > 0 and \
+                exemplars.tostring() == history[-1]
+        convergence_count = convergence_count + 1 if stable else 0
+
+        if record:
+            records.append((
+                np.mean(last_labels != labels) if
+                last_labels.shape[0] == labels.shape[0] else 1.,
+                np.sum(exemplars), np.sum(data[labels]), damping,
+                time.time() - start_time))
+            if callback is not None and callback(
+                    np.array(records[-1:], dtype=TRACE_DTYPE)[0]):
+                if verbose:
+                    print("Stopped by callback after %d iterations." % it)
+                break
+
+        key = exemplars.tostring()
+        if adaptive_damping and damping < 0.95 and len(history) > 0 and \
+                key != history[-1] and key in history:
+            damping = min(damping + 0.05, 0.95)
+            history.clear()
+            if verbose:
+                print("Oscillation detected at iteration %d, damping "
+                      "set to %.2f." % (it, damping))
+        history.append(key)
+
         if convergence_count == convergence_iter:
             if verbose:
                 print("Converged after %d iterations." % it)
@@ -180,22 +388,32 @@ def sparse_ap(S, preference=None, convergence_iter=15, max_iter=200,
         if verbose:
             print("Did not converge")
 
-    if idx_single_samples is None or len(idx_single_samples) == 0:
-        cluster_centers_indices = cols[labels]
+    if not compute_labels:
+        labels = _sparse_row_maxindex(A + R, row_indptr)
+    if trace:
+        trace = np.array(records, dtype=TRACE_DTYPE)
     else:
-        cluster_centers_indices = [left_ori_dict[el] for el in cols[labels]]
-        for ind in sorted(idx_single_samples):
-            cluster_centers_indices.insert(ind, ind)
-        cluster_centers_indices = np.asarray(cluster_centers_indices)
+        trace = None
+    return labels, it, trace
 
-    _centers = np.unique(cluster_centers_indices)
-    lookup = {v: i for i, v in enumerate(_centers)}
-    labels = np.array([lookup[x] for x in cluster_centers_indices], dtype=int)
 
-    if return_n_iter:
-        return cluster_centers_indices, labels, it + 1
+def _sparse_ap_labels(problem, labels):
+    """Convert exemplar elements into centers and labels of all samples."""
+    cols = problem['cols']
+    idx_single_samples = problem['idx_single_samples']
+    if idx_single_samples is None or len(idx_single_samples) == 0:
+        cluster_centers_indices = cols[labels]
     else:
-        return cluster_centers_indices, labels
+        # single samples are exemplars of themselves
+        cluster_centers_indices = np.empty(
+            problem['n_samples'] + idx_single_samples.shape[0], dtype=int)
+        mask = np.ones(cluster_centers_indices.shape[0], dtype=bool)
+        mask[idx_single_samples] = False
+        cluster_centers_indices[mask] = problem['left_ori'][cols[labels]]
+        cluster_centers_indices[idx_single_samples] = idx_single_samples
+
+    labels = np.unique(cluster_centers_indices, return_inverse=True)[1]
+    return cluster_centers_indices, labels
 
 
 ###############################################################################
@@ -235,6 +453,24 @@ class AffinityPropagation(AffinityPropagation):
     verbose : boolean, optional, default: False
         Whether to be verbose.
 
+    convergence_percentage : float, optional, default: 0.999999
+        Fraction of labels which must not change in an iteration for it to
+        count towards convergence.
+
+    convergence : ('labels', 'exemplars'), optional, default: 'labels'
+        Stop when labels or the set of exemplars do not change for
+        `convergence_iter` iterations (see `sparse_ap`).
+
+    adaptive_damping : boolean, optional, default: False
+        Increase the damping when the set of exemplars oscillates.
+
+    callback : callable, optional
+        Called after each iteration with the row of the trace for the
+        iteration. If it returns True, iterations are stopped.
+
+    trace : boolean, optional, default: False
+        Whether to record the trace of the iterations in `trace_`.
+
 
     Attributes
     ----------
@@ -253,6 +489,10 @@ class AffinityPropagation(AffinityPropagation):
     n_iter_ : int
         Number of iterations taken to converge.
 
+    trace_ : structured array, shape (n_iter,)
+        Label change fraction, number of exemplars, net similarity, damping
+        and wall time of each iteration, if `trace` is True.
+
     Notes
     -----
     See examples/cluster/plot_affinity_propagation.py for an example.
@@ -269,7 +509,9 @@ class AffinityPropagation(AffinityPropagation):
 
     def __init__(self, damping=.5, max_iter=200, convergence_iter=15,
                  copy=True, preference=None, affinity='euclidean',
-                 verbose=False, convergence_percentage=0.999999):
+                 verbose=False, convergence_percentage=0.999999,
+                 convergence='labels', adaptive_damping=False, callback=None,
+                 trace=False):
         super(AffinityPropagation, self).__init__(
             damping=damping,
             max_iter=max_iter,
@@ -279,6 +521,10 @@ class AffinityPropagation(AffinityPropagation):
             preference=preference,
             affinity=affinity)
         self.convergence_percentage = convergence_percentage
+        self.convergence = convergence
+        self.adaptive_damping = adaptive_damping
+        self.callback = callback
+        self.trace = trace
 
     def fit(self, X, **kwargs):
         """Apply affinity propagation clustering.
@@ -307,14 +553,69 @@ class AffinityPropagation(AffinityPropagation):
                              "'euclidean'. Got %s instead"
                              % str(self.affinity))
 
-        self.cluster_centers_indices_, self.labels_, self.n_iter_ = \
-            sparse_ap(
-                self.affinity_matrix_, self.preference, max_iter=self.max_iter,
-                convergence_iter=self.convergence_iter, damping=self.damping,
-                copy=self.copy, verbose=self.verbose, return_n_iter=True,
-                convergence_percentage=self.convergence_percentage)
+        result = sparse_ap(
+            self.affinity_matrix_, self.preference, max_iter=self.max_iter,
+            convergence_iter=self.convergence_iter, damping=self.damping,
+            copy=self.copy, verbose=self.verbose, return_n_iter=True,
+            convergence_percentage=self.convergence_percentage,
+            convergence=self.convergence,
+            adaptive_damping=self.adaptive_damping, callback=self.callback,
+            return_trace=self.trace)
+        self.cluster_centers_indices_, self.labels_, self.n_iter_ = result[:3]
+        if self.trace:
+            self.trace_ = result[3]
 
         if self.affinity != "precomputed":
             self.cluster_centers_ = X.data[self.cluster_centers_indices_].copy()
 
         return self
+
+    def fit_path(self, X, preferences):
+        """Apply affinity propagation clustering for a sequence of preferences.
+
+        Each preference is warm started from the solution of the previous
+        one (see `sparse_ap_path`). Attributes of the estimator refer to the
+        last preference.
+
+        Parameters
+        ----------
+        X: array-like or sparse matrix,
+                shape (n_samples, n_features) or (n_samples, n_samples)
+            Data matrix or, if affinity is ``precomputed``, matrix of
+            similarities / affinities. All the entries of a dense matrix are
+            kept, including null similarities, as in `fit`.
+        preferences : list
+            Sequence of preferences.
+
+        Returns
+        -------
+        labels : array, shape (n_preferences, n_samples)
+            Cluster labels of each point for each preference.
+        n_iter : array, shape (n_preferences,)
+            Number of iterations run for each preference.
+        """
+        X = check_array(X, accept_sparse='csr')
+        if self.affinity == "precomputed":
+            self.affinity_matrix_ = coo_matrix(X) if issparse(X) else \
+                _dense_to_coo(X)
+        elif self.affinity == "euclidean":
+            self.affinity_matrix_ = _dense_to_coo(
+                -euclidean_distances(X, squared=True))
+        else:
+            raise ValueError("Affinity must be 'precomputed' or "
+                             "'euclidean'. Got %s instead"
+                             % str(self.affinity))
+
+        centers_path, labels_path, n_iter_path = sparse_ap_path(
+            self.affinity_matrix_, preferences, max_iter=self.max_iter,
+            convergence_iter=self.convergence_iter, damping=self.damping,
+            copy=self.copy, verbose=self.verbose,
+            convergence_percentage=self.convergence_percentage,
+            convergence=self.convergence,
+            adaptive_damping=self.adaptive_damping)
+        self.cluster_centers_indices_ = centers_path[-1]
+        self.labels_ = labels_path[-1]
+        self.n_iter_ = n_iter_path[-1]
+        if self.affinity != "precomputed":
+            self.cluster_centers_ = X[self.cluster_centers_indices_].copy()
+        return labels_path, n_iter_path
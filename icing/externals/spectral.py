@@ -9,6 +9,11 @@ import warnings
 
 import numpy as np
 
+from joblib import Parallel, delayed
+from scipy import sparse
+from scipy.linalg import eigh
+from scipy.sparse.csgraph import connected_components, laplacian
+from scipy.sparse.linalg import LinearOperator, lobpcg
 from sklearn.utils import check_random_state
 from sklearn.utils.validation import check_array
 from sklearn.metrics.pairwise import pairwise_kernels
@@ -132,6 +137,143 @@ def spectral_clustering(affinity, n_clusters=8, n_components=None,
     return labels
 
 
+def _preconditioner(lap):
+    """Preconditioner for the normalized laplacian `lap`.
+
+    AMG is used if pyamg is installed, elsewhere a Jacobi preconditioner.
+    The laplacian is singular, so it is slightly shifted.
+    """
+    try:
+        from pyamg import smoothed_aggregation_solver
+        shifted = lap + 1e-5 * sparse.identity(lap.shape[0], format='csr')
+        return smoothed_aggregation_solver(shifted).aspreconditioner()
+    except ImportError:
+        inv_diag = 1. / (lap.diagonal() + 1e-5)
+        return LinearOperator(lap.shape, matvec=lambda x: inv_diag * x.ravel(),
+                              matmat=lambda x: inv_diag[:, None] * x,
+                              dtype=lap.dtype)
+
+
+def _spectral_component(affinity, max_clusters=10, n_clusters=None,
+                        max_dense_size=200, eigen_tol=1e-6, max_iter=200,
+                        random_state=None, n_init=10):
+    """Spectral clustering of a connected graph.
+
+    The embedding is computed on the normalized laplacian, with LOBPCG for
+    large graphs and with a dense solver for graphs up to `max_dense_size`
+    nodes. If `n_clusters` is None, the number of clusters is chosen by the
+    largest gap between the first `max_clusters` + 1 eigenvalues.
+
+    Returns
+    -------
+    labels : array, shape (n_samples,)
+        Cluster of each sample, starting from 0.
+    """
+    random_state = check_random_state(random_state)
+    n_samples = affinity.shape[0]
+    n_components = min(
+        (max_clusters if n_clusters is None else n_clusters) + 1, n_samples)
+    lap, dd = laplacian(sparse.csr_matrix(affinity, dtype=np.float64),
+                        normed=True, return_diag=True)
+
+    if n_samples <= max(max_dense_size, 5 * n_components):
+        eigenvalues, maps = eigh(lap.toarray())
+        eigenvalues, maps = eigenvalues[:n_components], maps[:, :n_components]
+    else:
+        X = random_state.rand(n_samples, n_components)
+        X[:, 0] = dd
+        eigenvalues, maps = lobpcg(lap, X, M=_preconditioner(lap),
+                                   tol=eigen_tol, maxiter=max_iter,
+                                   largest=False)
+        order = np.argsort(eigenvalues)
+        eigenvalues, maps = eigenvalues[order], maps[:, order]
+
+    if n_clusters is None:
+        n_clusters = np.argmax(np.diff(eigenvalues)) + 1 \
+            if n_components > 1 else 1
+    n_clusters = min(n_clusters, n_samples)
+    if n_clusters < 2:
+        return np.zeros(n_samples, dtype=int)
+
+    maps = maps[:, :n_clusters] / dd[:, None]
+    _, labels, _ = k_means(maps, n_clusters, random_state=random_state,
+                           n_init=n_init)
+    return labels
+
+
+def component_spectral_clustering(affinity, max_clusters=10, n_clusters=None,
+                                  min_component_size=3, max_dense_size=200,
+                                  eigen_tol=1e-6, max_iter=200,
+                                  random_state=None, n_init=10, n_jobs=1):
+    """Spectral clustering of each connected component of a sparse graph.
+
+    A global embedding of a graph with many connected components needs as
+    many eigenvectors as components. Instead, each component is embedded on
+    its own, in parallel, and components with less than
+    `min_component_size` samples are a cluster each.
+
+    Parameters
+    -----------
+    affinity : sparse matrix, shape: (n_samples, n_samples)
+        The affinity matrix. Triangular matrices are made symmetric and the
+        diagonal is ignored. np.float32 matrices are converted to np.float64
+        one component at a time.
+    max_clusters : int, optional, default: 10
+        Maximum number of clusters in a component, when `n_clusters` is None.
+    n_clusters : int, optional, default: None
+        Number of clusters in each component. If None, it is chosen by the
+        eigengap heuristic.
+    min_component_size : int, optional, default: 3
+        Components smaller than this are not embedded.
+    max_dense_size : int, optional, default: 200
+        Components up to this size are embedded with a dense eigensolver,
+        larger ones with LOBPCG, preconditioned by AMG if pyamg is installed.
+    eigen_tol : float, optional, default: 1e-6
+        Tolerance of LOBPCG.
+    max_iter : int, optional, default: 200
+        Maximum number of iterations of LOBPCG.
+    random_state : int seed, RandomState instance, or None (default)
+        Used for LOBPCG initialization and k-means.
+    n_init : int, optional, default: 10
+        Number of k-means runs with different centroid seeds.
+    n_jobs : int, optional, default: 1
+        Number of components clustered in parallel.
+
+    Returns
+    -------
+    labels : array, shape (n_samples,)
+        Cluster of each sample, starting from 0.
+    """
+    from icing.utils.extra import symmetric_similarity_matrix
+    affinity = symmetric_similarity_matrix(affinity)
+    random_state = check_random_state(random_state)
+    n, components = connected_components(affinity, directed=False)
+    order = np.argsort(components, kind='mergesort')
+    bounds = np.searchsorted(components[order], np.arange(n + 1))
+    members = [order[bounds[i]:bounds[i + 1]] for i in range(n)]
+
+    large = [idxs for idxs in members if idxs.shape[0] >= min_component_size]
+    seeds = random_state.randint(np.iinfo(np.int32).max, size=len(large))
+    results = iter(Parallel(n_jobs=n_jobs)(
+        delayed(_spectral_component)(
+            affinity[idxs][:, idxs], max_clusters=max_clusters,
+            n_clusters=n_clusters, max_dense_size=max_dense_size,
+            eigen_tol=eigen_tol, max_iter=max_iter, random_state=seed,
+            n_init=n_init) for idxs, seed in zip(large, seeds)))
+
+    labels = np.empty(affinity.shape[0], dtype=int)
+    n_labels = 0
+    for idxs in members:
+        if idxs.shape[0] >= min_component_size:
+            component_labels = next(results)
+            labels[idxs] = component_labels + n_labels
+            n_labels += component_labels.max() + 1
+        else:
+            labels[idxs] = n_labels
+            n_labels += 1
+    return labels
+
+
 class SpectralClustering(SpectralClustering):
     """Apply clustering to a projection to the normalized laplacian.
 
@@ -217,6 +359,18 @@ class SpectralClustering(SpectralClustering):
         Parameters (keyword arguments) and values for kernel passed as
         callable object. Ignored by other kernels.
 
+    norm_laplacian : boolean, optional, default: True
+        Use the normalized laplacian for the embedding.
+
+    per_component : boolean, optional, default: False
+        Embed each connected component of a sparse precomputed affinity
+        on its own, with `component_spectral_clustering`. In this case,
+        `n_clusters` is the maximum number of clusters of each component,
+        which is chosen by the eigengap heuristic.
+
+    n_jobs : int, optional, default: 1
+        Number of components clustered in parallel, if `per_component`.
+
     Attributes
     ----------
     affinity_matrix_ : array-like, shape (n_samples, n_samples)
@@ -261,7 +415,8 @@ class SpectralClustering(SpectralClustering):
     def __init__(self, n_clusters=8, eigen_solver=None, random_state=None,
                  n_init=10, gamma=1., affinity='rbf', n_neighbors=10,
                  eigen_tol=0.0, assign_labels='kmeans', degree=3, coef0=1,
-                 kernel_params=None, norm_laplacian=True):
+                 kernel_params=None, norm_laplacian=True,
+                 per_component=False, n_jobs=1):
         super(SpectralClustering, self).__init__(
             n_clusters=n_clusters, eigen_solver=eigen_solver,
             random_state=random_state, n_init=n_init, gamma=gamma,
@@ -269,6 +424,8 @@ class SpectralClustering(SpectralClustering):
             assign_labels=assign_labels, degree=degree, coef0=coef0,
             kernel_params=kernel_params)
         self.norm_laplacian = norm_laplacian
+        self.per_component = per_component
+        self.n_jobs = n_jobs
 
     def fit(self, X, y=None):
         """Creates an affinity matrix for X using the selected affinity,
@@ -280,6 +437,17 @@ class SpectralClustering(SpectralClustering):
             OR, if affinity==`precomputed`, a precomputed affinity
             matrix of shape (n_samples, n_samples)
         """
+        if self.per_component and self.affinity == 'precomputed':
+            self.affinity_matrix_ = check_array(
+                X, accept_sparse=['csr', 'csc', 'coo'],
+                dtype=[np.float64, np.float32])
+            self.labels_ = component_spectral_clustering(
+                self.affinity_matrix_, max_clusters=self.n_clusters,
+                eigen_tol=self.eigen_tol or 1e-6,
+                random_state=self.random_state, n_init=self.n_init,
+                n_jobs=self.n_jobs)
+            return self
+
         X = check_array(X, accept_sparse=['csr', 'csc', 'coo'],
                         dtype=np.float64)
         if X.shape[0] == X.shape[1] and self.affinity != "precomputed":
@@ -4,24 +4,161 @@ import os
 import logging
 import numpy as np
 import gzip
+import warnings
 
 from functools import partial
+from joblib import Parallel, delayed
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
 from six.moves import cPickle as pkl
 from sklearn.base import BaseEstimator
-from sklearn.cluster import DBSCAN, MiniBatchKMeans
+from sklearn.cluster import DBSCAN
 from sklearn.neighbors import BallTree
 
-from icing.core.distances import distance_dataframe, StringDistance
-from icing.similarity_ import compute_similarity_matrix
+from icing.core.cloning import inverse_index
+from icing.core.distances import DataFrameDistance, StringDistance
+from icing.similarity_ import compute_similarity_matrix, is_similarity
 from icing.utils import extra
 
 
+def _clone_representatives(labels, similarity_matrix=None):
+    """Choose one representative record for each clone.
+
+    The representative is the medoid of the clone, i.e., the record with the
+    highest sum of similarities towards the other records in the same clone.
+    If `similarity_matrix` is None, the first record of each clone is used.
+
+    Parameters
+    ----------
+    labels : array-like, shape (n_samples,)
+        Clone of each record. Noisy records (label -1) are ignored.
+    similarity_matrix : scipy.sparse matrix, optional
+        Similarity matrix between records, as computed by
+        `compute_similarity_matrix`.
+
+    Returns
+    -------
+    representatives : array, shape (n_clones,)
+        Index of the representative record of each clone.
+    """
+    labels = np.asarray(labels)
+    n = labels.shape[0]
+    score = np.zeros(n)
+    if similarity_matrix is not None:
+        sm = similarity_matrix.tocoo()
+        same = labels[sm.row] == labels[sm.col]
+        score += np.bincount(sm.row[same], weights=sm.data[same], minlength=n)
+        score += np.bincount(sm.col[same], weights=sm.data[same], minlength=n)
+
+    order = np.lexsort((-score, labels))
+    first = np.ones(n, dtype=bool)
+    first[1:] = labels[order][1:] != labels[order][:-1]
+    representatives = order[first]
+    return representatives[labels[representatives] != -1]
+
+
+# clustering methods which take the multiplicity of collapsed records into
+# account through `sample_weight`
+_WEIGHTED = ('ap', 'dbscan', 'graph', 'threshold')
+
+
+def _collapse_duplicates(records, igsimilarity=None):
+    """Group records with the same V gene set, junction and mutation level.
+
+    Records of a group are indistinguishable to the similarity, so the
+    similarity between two groups is the one between any of their records.
+    If `igsimilarity` is given, a group is kept only if its records have
+    similarity 1 with each other (e.g., the mutation correction may lower
+    it), so that the expanded similarity matrix is exact.
+
+    Parameters
+    ----------
+    records : list of externals.DbCore.IgRecord
+        Records to group.
+    igsimilarity : IgSimilarity, optional
+        Similarity between records.
+
+    Returns
+    -------
+    unique_idx : array, shape (n_unique,)
+        Index of the first record of each group, used as representative.
+    inverse : array, shape (n_records,)
+        Group of each record.
+    weights : array, shape (n_unique,)
+        Number of records in each group.
+    """
+    keys, identical = {}, {}
+    inverse = np.empty(len(records), dtype=int)
+    for i, record in enumerate(records):
+        key = (tuple(sorted(record.setV)), record.junc, record.mut)
+        if key in keys and igsimilarity is not None:
+            if key not in identical:
+                first = records[keys[key][1]]
+                identical[key] = igsimilarity.pairwise(first, first) == 1
+            if not identical[key]:
+                key = key + (i,)
+        group, _ = keys.setdefault(key, (len(keys), i))
+        inverse[i] = group
+    unique_idx = np.empty(len(keys), dtype=int)
+    unique_idx[inverse[::-1]] = np.arange(len(records))[::-1]
+    weights = np.bincount(inverse, minlength=len(keys))
+    return unique_idx, inverse, weights
+
+
+def _expand_similarity_matrix(similarity_matrix, inverse):
+    """Expand a similarity matrix between groups to the original records.
+
+    Records in the same group have similarity 1. The result is upper
+    triangular, as the output of `compute_similarity_matrix`.
+    """
+    n = inverse.shape[0]
+    groups = sparse.csr_matrix(
+        (np.ones(n, dtype=similarity_matrix.dtype), (np.arange(n), inverse)),
+        shape=(n, similarity_matrix.shape[0]))
+    expanded = groups.dot(similarity_matrix + similarity_matrix.T).dot(
+        groups.T) + groups.dot(groups.T)
+    return sparse.triu(expanded, k=1).tocsr()
+
+
 class DefineClones(BaseEstimator):
-    """Clustering container for defining final clones."""
+    """Clustering container for defining final clones.
+
+    After `fit`, a representative record for each clone is kept together
+    with an inverse index on its V and J genes. New records can be then
+    assigned to the existing clones with `predict`, or used to update the
+    clones with `partial_fit`, without recomputing the whole similarity
+    matrix. A new record is assigned to a clone if its similarity with one of
+    the clone representatives is at least ``1 - threshold``.
+
+    If `collapse_duplicates` is True, records with the same V gene set,
+    junction and mutation level are collapsed into a single weighted record
+    before computing the similarity matrix, and their labels are expanded
+    back after clustering. Weights are used by 'ap', 'dbscan', 'graph' and
+    'threshold' clustering (with 'ap' preferences they only approximate the
+    clustering of all the records); records are not collapsed for the other
+    methods, or if `igsimilarity` removes duplicates.
+
+    With ``cluster='threshold'``, similarities lower than ``1 - threshold``
+    are discarded while computing them, and clones are the single linkage
+    clusters of the remaining ones.
+
+    Similarities and clustering messages are stored with type `dtype`. Using
+    np.float32 halves their memory; `icing.validation.precision` compares
+    the resulting clones with the ones obtained with np.float64.
+
+    If `lsh_params` is given, only pairs of records with similar k-mer sets
+    are evaluated, as in `compute_similarity_matrix`.
+
+    If `work_dir` is given, the similarity matrix is computed in shards which
+    are saved in `work_dir`, so that a `fit` interrupted while computing it
+    can be resumed by fitting again on the same records.
+    """
 
     def __init__(
         self, tag='debug', root=None, cluster='ap', igsimilarity=None,
-            threshold=0.05, compute_similarity=True, clustering=None):
+            threshold=0.05, compute_similarity=True, clustering=None,
+            collapse_duplicates=False, dtype=np.float64, lsh_params=None,
+            work_dir=None):
         """Description of params."""
         self.tag = tag
         self.root = root
@@ -30,6 +167,10 @@ class DefineClones(BaseEstimator):
         self.threshold = threshold
         self.compute_similarity = compute_similarity
         self.clustering = clustering
+        self.collapse_duplicates = collapse_duplicates
+        self.dtype = dtype
+        self.lsh_params = lsh_params
+        self.work_dir = work_dir
 
     @property
     def save_results(self):
@@ -52,14 +193,31 @@ class DefineClones(BaseEstimator):
             os.makedirs(output_folder)
 
         if self.compute_similarity:
+            records = list(records)
+            if self.collapse_duplicates and self.cluster in _WEIGHTED \
+                    and not getattr(self.igsimilarity, 'rm_duplicates',
+                                    False):
+                unique_idx, inverse, weights = _collapse_duplicates(
+                    records, self.igsimilarity)
+                logging.info("Collapsed %i records into %i unique records",
+                             len(records), unique_idx.shape[0])
+            else:
+                unique_idx = inverse = np.arange(len(records))
+                weights = None
+            unique_records = [records[i] for i in unique_idx]
             similarity_matrix = compute_similarity_matrix(
-                records, sparse_mode=True,
-                igsimilarity=self.igsimilarity)
+                unique_records, sparse_mode=True,
+                igsimilarity=self.igsimilarity, dtype=self.dtype,
+                min_similarity=1 - self.threshold if
+                self.cluster == 'threshold' else 0.,
+                lsh_params=self.lsh_params, work_dir=self.work_dir)
 
             if self.save_results:
                 sm_filename = output_filename + '_similarity_matrix.pkl.tz'
                 try:
-                    pkl.dump(similarity_matrix, gzip.open(
+                    pkl.dump(similarity_matrix if weights is None else
+                             _expand_similarity_matrix(
+                                 similarity_matrix, inverse), gzip.open(
                         os.path.join(output_folder, sm_filename), 'w+'))
                     logging.info("Dumped similarity matrix: %s",
                                  os.path.join(output_folder, sm_filename))
@@ -68,9 +226,10 @@ class DefineClones(BaseEstimator):
 
             logging.info("Start define_clusts function ...")
             from icing.core.cluster import define_clusts
-            labels = define_clusts(
+            unique_labels = define_clusts(
                 similarity_matrix, threshold=self.threshold,
-                method=self.cluster)
+                method=self.cluster, sample_weight=weights)
+            labels = np.asarray(unique_labels)[inverse]
         else:
             # use a method which does not require an explicit similarity_matrix
             # first, encode the IgRecords into strings
@@ -116,72 +275,503 @@ class DefineClones(BaseEstimator):
 
         clone_dict = {k.id: v for k, v in zip(records, labels)}
         self.clone_dict_ = clone_dict
+        self.clone_members_ = {}
+        for k, v in extra.items_iterator(clone_dict):
+            self.clone_members_.setdefault(v, []).append(k)
+
+        if self.compute_similarity:
+            self._set_representatives(
+                unique_records, unique_labels, similarity_matrix)
+            if self.save_results:
+                rep_filename = output_filename + '_representatives.pkl.tz'
+                pkl.dump([self.representatives_,
+                          self.representatives_labels_, self.index_],
+                         gzip.open(os.path.join(
+                             output_folder, rep_filename), 'w+'))
+                logging.info("Dumped clone representatives: %s",
+                             os.path.join(output_folder, rep_filename))
+
+        return self
+
+    def _set_representatives(self, records, labels, similarity_matrix=None):
+        """Store clone representatives and their V/J inverse index."""
+        records = list(records)
+        labels = np.asarray(labels)
+        idx = _clone_representatives(labels, similarity_matrix)
+        self.representatives_ = [records[i] for i in idx]
+        self.representatives_labels_ = labels[idx].copy()
+        self.representatives_lengths_ = np.array(
+            [x.junction_length for x in self.representatives_], dtype=int)
+        self.index_ = inverse_index(self.representatives_)
+        self.clone_representatives_ = {}
+        for i, label in enumerate(self.representatives_labels_):
+            self.clone_representatives_.setdefault(label, []).append(i)
+
+    def _candidates(self, record):
+        """Get representatives which share a V gene and junction length."""
+        candidates = set()
+        for vcall in record.setV:
+            candidates.update(self.index_.get(vcall, ()))
+        candidates = np.array(sorted(candidates), dtype=int)
+        if candidates.shape[0] > 0:
+            candidates = candidates[np.abs(
+                self.representatives_lengths_[candidates] -
+                record.junction_length) <= self.igsimilarity.tol]
+        return candidates
+
+    def _best_clones(self, record):
+        """Get clones with similarity to record higher than the threshold.
+
+        Returns
+        -------
+        clones : array
+            Labels of the matching clones, sorted by decreasing similarity.
+        """
+        candidates = self._candidates(record)
+        similarities = np.array([self.igsimilarity.pairwise(
+            record, self.representatives_[i]) for i in candidates])
+        if similarities.shape[0] == 0:
+            return similarities.astype(int)
+        mask = similarities >= 1. - self.threshold
+        order = np.argsort(-similarities[mask], kind='mergesort')
+        clones = self.representatives_labels_[candidates[mask][order]]
+        _, first = np.unique(clones, return_index=True)
+        return clones[np.sort(first)]
+
+    def predict(self, records):
+        """Assign records to the existing clones.
+
+        Parameters
+        ----------
+        records : iterable of externals.DbCore.IgRecord
+            Records to assign.
+
+        Returns
+        -------
+        labels : array, shape (n_records,)
+            Clone of each record. Records which do not match any existing
+            clone are labelled with -1.
+        """
+        if not hasattr(self, 'representatives_'):
+            raise ValueError("DefineClones is not fitted yet. "
+                             "Call 'fit' before 'predict'.")
+        if not is_similarity(self.igsimilarity):
+            raise ValueError("Clone assignment requires a similarity "
+                             "metric. See icing.similarity_")
+        records = list(records)
+        labels = np.empty(len(records), dtype=int)
+        for i, record in enumerate(records):
+            clones = self._best_clones(record)
+            labels[i] = clones[0] if clones.shape[0] > 0 else -1
+        return labels
+
+    def partial_fit(self, records, db_name=None):
+        """Update clones with a new batch of records.
+
+        Each record is compared only with the representatives of the clones
+        which share at least a V gene and have a compatible junction length.
+        A record is assigned to the most similar clone, or it becomes the
+        representative of a new clone. When a record matches more than one
+        clone, those clones are merged into the largest one, and only the
+        records of the others are relabelled.
+
+        Parameters
+        ----------
+        records : iterable of externals.DbCore.IgRecord
+            New records.
+        """
+        records = list(records)
+        if not hasattr(self, 'clone_dict_'):
+            return self.fit(records, db_name=db_name)
+        if not hasattr(self, 'representatives_'):
+            raise ValueError("Incremental assignment is available only "
+                             "when clones are fitted with "
+                             "compute_similarity=True")
+        if not is_similarity(self.igsimilarity):
+            raise ValueError("Incremental assignment requires a similarity "
+                             "metric. See icing.similarity_")
+
+        next_label = max(max(self.clone_dict_.values() or [0]),
+                         max(self.representatives_labels_.tolist() or [0])) + 1
+        n_merged = 0
+        for record in records:
+            clones = self._best_clones(record)
+            if clones.shape[0] == 0:
+                # new clone, the record is its representative
+                position = len(self.representatives_)
+                self.representatives_.append(record)
+                self.representatives_labels_ = np.append(
+                    self.representatives_labels_, next_label)
+                self.representatives_lengths_ = np.append(
+                    self.representatives_lengths_, record.junction_length)
+                for call in set(record.setV) | set(record.setJ):
+                    self.index_.setdefault(call, []).append(position)
+                self.clone_representatives_[next_label] = [position]
+                self.clone_members_[next_label] = []
+                label = next_label
+                next_label += 1
+            elif clones.shape[0] > 1:
+                # the record bridges more clones, merge them into the
+                # largest one
+                label = max(clones, key=lambda x: len(
+                    self.clone_members_[x]))
+                for other in clones:
+                    if other == label:
+                        continue
+                    members = self.clone_members_.pop(other)
+                    for k in members:
+                        self.clone_dict_[k] = label
+                    self.clone_members_[label].extend(members)
+                    positions = self.clone_representatives_.pop(other)
+                    self.representatives_labels_[positions] = label
+                    self.clone_representatives_[label].extend(positions)
+                n_merged += clones.shape[0] - 1
+            else:
+                label = clones[0]
+            self.clone_dict_[record.id] = label
+            self.clone_members_[label].append(record.id)
 
+        n_clones = len(self.clone_members_)
+        logging.info("Partial fit: %i new records, %i clones merged, "
+                     "number of clones: %i", len(records), n_merged, n_clones)
         return self
 
 
+def _assign_noise(graph, labels, core_samples):
+    """Assign noise samples to the cluster of the nearest core sample.
+
+    The nearest core sample is searched among the neighbours of each noise
+    sample in the sparse distance graph. Noise samples without core
+    neighbours form a new cluster each.
+
+    Parameters
+    ----------
+    graph : scipy.sparse.csr_matrix, shape (n_samples, n_samples)
+        Sparse distance graph, as computed by `DataFrameDistance.graph`
+        with the radius used to search the core samples.
+    labels : array-like, shape (n_samples,)
+        DBSCAN labels, where noise samples are labelled with -1.
+    core_samples : array-like
+        Indices of core samples.
+
+    Returns
+    -------
+    labels : array-like, shape (n_samples,)
+        Labels without noise samples.
+    """
+    is_core = np.zeros(labels.shape[0], dtype=bool)
+    is_core[core_samples] = True
+    new_label = np.max(labels) + 1
+    for i in np.where(labels == -1)[0]:
+        neighbours = graph.indices[graph.indptr[i]:graph.indptr[i + 1]]
+        distances = graph.data[graph.indptr[i]:graph.indptr[i + 1]]
+        mask = is_core[neighbours]
+        if np.any(mask):
+            labels[i] = labels[neighbours[mask][np.argmin(distances[mask])]]
+        else:
+            labels[i] = new_label
+            new_label += 1
+    return labels
+
+
+def _length_blocks(lengths, max_block_size=5000, overlap=0):
+    """Split records into blocks of contiguous junction lengths.
+
+    Sorted distinct lengths are greedily grouped so that each block owns at
+    most `max_block_size` records (a single length is never split). Each
+    block also includes the records whose length is within `overlap` of its
+    own lengths, so that neighbours across block boundaries are not lost.
+
+    Parameters
+    ----------
+    lengths : array-like, shape (n_samples,)
+        Junction length of each record.
+    max_block_size : int, optional, default: 5000
+        Maximum number of records owned by a block.
+    overlap : int, optional, default: 0
+        Maximum length difference of records shared with adjacent blocks.
+
+    Returns
+    -------
+    blocks : list of tuples
+        For each block, the array of its records and a boolean mask of the
+        records owned by the block. Each record is owned by exactly one block.
+    """
+    lengths = np.asarray(lengths)
+    order = np.argsort(lengths, kind='mergesort')
+    sorted_lengths = lengths[order]
+    unique, counts = np.unique(sorted_lengths, return_counts=True)
+
+    blocks = []
+    lo = 0
+    while lo < unique.size:
+        hi, size = lo, counts[lo]
+        while hi + 1 < unique.size and size + counts[hi + 1] <= max_block_size:
+            hi += 1
+            size += counts[hi]
+        start = np.searchsorted(sorted_lengths, unique[lo] - overlap, 'left')
+        end = np.searchsorted(sorted_lengths, unique[hi] + overlap, 'right')
+        members = order[start:end]
+        owned = (lengths[members] >= unique[lo]) & \
+            (lengths[members] <= unique[hi])
+        blocks.append((members, owned))
+        lo = hi + 1
+    return blocks
+
+
+def _cluster_block(estimator, metric, idxs, sample_weight, precomputed,
+                   noise_radius=None):
+    """Cluster a block of records, assigning noise samples to clusters.
+
+    Parameters
+    ----------
+    estimator : DBSCAN or HDBSCAN
+        Estimator used to cluster the block.
+    metric : DataFrameDistance
+        Distance between records.
+    idxs : array-like
+        Positions of the records of the block.
+    sample_weight : array-like
+        Weight of each record of the block.
+    precomputed : boolean
+        Cluster the sparse distance graph of the block instead of positions.
+    noise_radius : float, optional
+        If given, noise samples are assigned to the nearest core sample
+        within `noise_radius`, as in `_assign_noise`. Otherwise, they are
+        assigned to the nearest core sample according to `metric`.
+
+    Returns
+    -------
+    labels : array-like
+        Labels of the records of the block.
+    is_core : array-like
+        Boolean mask of the core samples of the block.
+    """
+    if idxs.size == 1:
+        return np.zeros(1, dtype=int), np.ones(1, dtype=bool)
+    positions = idxs.reshape(-1, 1).astype('float64')
+    if precomputed:
+        # DBSCAN neighbours are within eps, included
+        X_idx = metric.graph(
+            idxs, max_distance=np.nextafter(estimator.eps, np.inf))
+    else:
+        X_idx = positions
+
+    if not isinstance(estimator, DBSCAN):
+        from hdbscan.prediction import all_points_membership_vectors
+        estimator.fit(X_idx)  # unsupported weights
+        # avoid noise samples
+        soft_clusters = all_points_membership_vectors(estimator)
+        labels = np.array([np.argmax(x) for x in soft_clusters])
+        return labels, np.ones(idxs.size, dtype=bool)
+
+    labels = estimator.fit_predict(X_idx, sample_weight=sample_weight)
+    is_core = np.zeros(idxs.size, dtype=bool)
+    is_core[estimator.core_sample_indices_] = True
+    if not np.any(is_core):
+        labels[:] = 0
+    elif -1 in labels and noise_radius is not None:
+        labels = _assign_noise(
+            metric.graph(idxs, max_distance=np.nextafter(
+                noise_radius, np.inf)),
+            labels, estimator.core_sample_indices_)
+    elif -1 in labels:
+        balltree = BallTree(
+            positions[estimator.core_sample_indices_],
+            metric=metric if precomputed else estimator.metric)
+        noise_labels = balltree.query(
+            positions[labels == -1], k=1, return_distance=False).ravel()
+        # get labels for core points, then assign to noise points based
+        # on balltree
+        labels[labels == -1] = labels[
+            estimator.core_sample_indices_][noise_labels]
+    return labels, is_core
+
+
+def _merge_blocks(blocks, results, n_samples):
+    """Reconcile the labels of overlapping blocks.
+
+    Clusters of different blocks are merged when they share a record which
+    is a core sample in both. Each record then takes the label assigned by
+    the block which owns it.
+
+    Parameters
+    ----------
+    blocks : list of tuples
+        Blocks, as returned by `_length_blocks`.
+    results : list of tuples
+        Labels and core samples mask of each block, as returned by
+        `_cluster_block`.
+    n_samples : int
+        Number of records.
+
+    Returns
+    -------
+    labels : array-like, shape (n_samples,)
+        Consecutive labels of records.
+    """
+    offset = 0
+    samples, block_labels, owned_samples, owned_labels = [], [], [], []
+    for (members, owned), (labels, is_core) in zip(blocks, results):
+        labels = labels + offset
+        offset = labels.max() + 1
+        samples.append(members[is_core])
+        block_labels.append(labels[is_core])
+        owned_samples.append(members[owned])
+        owned_labels.append(labels[owned])
+
+    # link the labels of the same core sample in different blocks
+    samples = np.concatenate(samples)
+    block_labels = np.concatenate(block_labels)
+    order = np.argsort(samples, kind='mergesort')
+    samples, block_labels = samples[order], block_labels[order]
+    shared = np.where(samples[1:] == samples[:-1])[0]
+    links = sparse.coo_matrix(
+        (np.ones(shared.size), (block_labels[shared],
+                                block_labels[shared + 1])),
+        shape=(offset, offset))
+    merged = connected_components(links, directed=False)[1]
+
+    labels = np.empty(n_samples, dtype=int)
+    labels[np.concatenate(owned_samples)] = merged[
+        np.concatenate(owned_labels)]
+    return np.unique(labels, return_inverse=True)[1]
+
+
 class ICINGTwoStep(BaseEstimator):
+    """Two-step clonal inference on a dataframe of records.
+
+    Records are first split into blocks of contiguous junction lengths,
+    then each block is clustered with DBSCAN. Blocks are clustered in
+    parallel, and adjacent blocks share the records within `block_overlap`
+    of their lengths, so clusters across block boundaries are merged.
+    With the default parameters, DBSCAN runs on a precomputed sparse graph
+    of distances between records, computed only for records which share a
+    V gene and have compatible junction lengths
+    (see `DataFrameDistance.graph`). The parameters of the distance are
+    specified by `distance_params`, as for `DataFrameDistance`.
+
+    Noise records are assigned to the cluster of the nearest core record of
+    their block. With `noise_radius`, only core records within
+    `noise_radius` are considered, and noise records without one form their
+    own clusters.
+
+    Parameters
+    ----------
+    eps : float, optional, default: 0.5
+        Maximum distance between neighbouring records.
+    model : ('aa', 'nt'), optional, default: 'aa'
+        Use amino acid or nucleotide junctions to group identical records.
+    kmeans_params : dict, optional
+        .. note:: Deprecated. Blocks are computed by a deterministic
+           partition of junction lengths, and this parameter is ignored.
+           It will be removed in icing 0.2.
+    dbscan_params, hdbscan_params, dbspark_params : dict, optional
+        Parameters of the clustering estimators.
+    method : ('dbscan', 'hdbscan', 'spark'), optional, default: 'dbscan'
+        Clustering method of each block.
+    verbose : boolean, optional, default: False
+        Print information on blocks.
+    distance_params : dict, optional
+        Parameters of the distance between records.
+    max_block_size : int, optional, default: 5000
+        Maximum number of distinct records owned by each block.
+    block_overlap : int, optional
+        Maximum junction length difference of records shared by adjacent
+        blocks. If None, use the `tol` of the distance, so that blocks
+        contain the whole neighbourhood of the records they own.
+    n_jobs : int, optional, default: -1
+        Number of blocks clustered in parallel.
+    noise_radius : float, optional
+        Maximum distance between a noise record and the core record it is
+        assigned to, for 'dbscan'. If None, there is no limit.
+    """
 
     def __init__(self, eps=0.5, model='aa', kmeans_params=None,
                  dbscan_params=None, method='dbscan', hdbscan_params=None,
-                 dbspark_params=None, verbose=False):
+                 dbspark_params=None, verbose=False, distance_params=None,
+                 max_block_size=5000, block_overlap=None, n_jobs=-1,
+                 noise_radius=None):
         self.eps = eps
         self.model = 'aa_' if model == 'aa' else ''
         self.dbscan_params = dbscan_params or {}
-        self.kmeans_params = kmeans_params or dict(n_init=100, n_clusters=100)
+        self.kmeans_params = kmeans_params or {}
         self.method = method
         self.hdbscan_params = hdbscan_params or {}
         self.dbspark_params = dbspark_params or {}
         self.verbose = verbose
+        self.distance_params = distance_params or dict(
+            junction_dist=StringDistance(), correct=False, tol=0)
+        self.max_block_size = max_block_size
+        self.block_overlap = block_overlap
+        self.n_jobs = n_jobs
+        self.noise_radius = noise_radius
 
     def fit(self, X, y=None, sample_weight=None):
         """X is a dataframe."""
         if self.method not in ("dbscan", "hdbscan", "spark"):
             raise ValueError("Unsupported method '%s'" % self.method)
-        if not self.dbscan_params:
+        # columns are extracted once, and shared by all the blocks
+        self.metric_ = DataFrameDistance(X, **self.distance_params)
+        if self.kmeans_params:
+            warnings.warn("kmeans_params is deprecated and ignored, blocks "
+                          "are split on junction lengths.", DeprecationWarning)
+        # blocks are clustered in parallel, so estimators use one job each
+        if not self.dbscan_params and self.method == 'dbscan':
+            self.dbscan_params = dict(
+                min_samples=20, n_jobs=1, metric='precomputed')
+        elif not self.dbscan_params:
             self.dbscan_params = dict(
-                min_samples=20, n_jobs=-1, algorithm='brute',
-                metric=partial(distance_dataframe, X, **dict(
-                    junction_dist=StringDistance(),
-                    correct=False, tol=0)))
+                min_samples=20, n_jobs=1, algorithm='brute',
+                metric=self.metric_)
         if not self.hdbscan_params and self.method == 'hdbscan':
             self.hdbscan_params = dict(
-                min_samples=20, n_jobs=-1,
-                metric=partial(distance_dataframe, X, **dict(
-                    junction_dist=StringDistance(),
-                    correct=False, tol=0)))
+                min_samples=20, core_dist_n_jobs=1,
+                metric=self.metric_, prediction_data=True)
+        precomputed = self.method == 'dbscan' and \
+            self.dbscan_params.get('metric') == 'precomputed'
 
         self.dbscan_params['eps'] = self.eps
         # new part: group by junction and v genes
-        if self.method == 'hdbscan' and False:
-            # no grouping; unsupported sample_weight
-            groups_values = [[x] for x in np.arange(X.shape[0])]
-        else:
-            # list of lists
-            groups_values = X.groupby(
-                ["v_gene_set_str", self.model + "junc"]).groups.values()
+        # list of lists
+        groups_values = X.groupby(
+            ["v_gene_set_str", self.model + "junc"]).groups.values()
 
         idxs = np.array([elem[0] for elem in groups_values])  # take one of them
         sample_weight = np.array([len(elem) for elem in groups_values])
-        X_all = idxs.reshape(-1, 1)
-
-        if self.kmeans_params.get('n_clusters', True):
-            # ensure the number of clusters is higher than points
-            self.kmeans_params['n_clusters'] = min(
-                self.kmeans_params['n_clusters'], X_all.shape[0])
-        kmeans = MiniBatchKMeans(**self.kmeans_params)
 
-        lengths = X[self.model + 'junction_length'].values
-        kmeans.fit(lengths[idxs].reshape(-1, 1))
-        dbscan_labels = np.zeros_like(kmeans.labels_).ravel()
+        # block on the lengths used by the distance, so that an overlap of
+        # `tol` includes all the neighbours of the records of a block
+        overlap = self.block_overlap
+        if overlap is None:
+            overlap = self.metric_.tol
+        blocks = _length_blocks(
+            self.metric_.lengths[idxs], self.max_block_size, overlap)
+        if self.verbose:
+            print("Clustering %d records in %d blocks" % (
+                idxs.size, len(blocks)))
 
         if self.method == 'hdbscan':
             from hdbscan import HDBSCAN
-            from hdbscan.prediction import all_points_membership_vectors
             dbscan_sk = HDBSCAN(**self.hdbscan_params)
         else:
             dbscan_sk = DBSCAN(**self.dbscan_params)
-        if self.method == 'spark':
+
+        # spark is used only for large blocks, which run sequentially
+        spark_blocks = [i for i, (members, _) in enumerate(blocks)
+                        if self.method == 'spark' and members.size > 5000]
+        local_blocks = [i for i in range(len(blocks)) if i not in
+                        set(spark_blocks)]
+        results = [None] * len(blocks)
+        local_results = Parallel(n_jobs=self.n_jobs)(
+            delayed(_cluster_block)(
+                dbscan_sk, self.metric_, idxs[blocks[i][0]],
+                sample_weight[blocks[i][0]], precomputed, self.noise_radius)
+            for i in local_blocks)
+        for i, result in zip(local_blocks, local_results):
+            results[i] = result
+
+        if spark_blocks:
             from pyspark import SparkContext
             from icing.externals.pypardis import dbscan as dbpard
             sc = SparkContext.getOrCreate()
@@ -190,54 +780,15 @@ class ICINGTwoStep(BaseEstimator):
             dbscan = dbpard.DBSCAN(
                 dbscan_params=self.dbscan_params,
                 **self.dbspark_params)
-        # else:
-
-        for i, label in enumerate(np.unique(kmeans.labels_)):
-            idx_row = np.where(kmeans.labels_ == label)[0]
-
-            if self.verbose:
-                print("Iteration %d/%d" % (i, np.unique(kmeans.labels_).size),
-                      "(%d seqs)" % idx_row.size, end='\r')
-
-            X_idx = idxs[idx_row].reshape(-1, 1).astype('float64')
-            weights = sample_weight[idx_row]
-
-            if idx_row.size == 1:
-                db_labels = np.array([0])
-            elif self.method == 'spark' and idx_row.size > 5000:
+            for i in spark_blocks:
+                X_idx = idxs[blocks[i][0]].reshape(-1, 1).astype('float64')
                 test_data = sc.parallelize(enumerate(X_idx))
                 dbscan.train(test_data, sample_weight=sample_weight_map)
                 db_labels = np.array(dbscan.assignments())[:, 1]
-            elif self.method == 'hdbscan':
-                db_labels = dbscan_sk.fit_predict(X_idx)  # unsupported weights
-                # avoid noise samples
-                soft_clusters = all_points_membership_vectors(dbscan_sk)
-                db_labels = np.array([np.argmax(x) for x in soft_clusters])
-            else:
-                db_labels = dbscan_sk.fit_predict(
-                    X_idx, sample_weight=weights)
-
-            if len(dbscan_sk.core_sample_indices_) < 1:
-                db_labels[:] = 0
-            if -1 in db_labels:
-                balltree = BallTree(
-                    X_idx[dbscan_sk.core_sample_indices_],
-                    metric=dbscan_sk.metric)
-                noise_labels = balltree.query(
-                    X_idx[db_labels == -1], k=1, return_distance=False).ravel()
-                # get labels for core points, then assign to noise points based
-                # on balltree
-                dbscan_noise_labels = db_labels[
-                    dbscan_sk.core_sample_indices_][noise_labels]
-                db_labels[db_labels == -1] = dbscan_noise_labels
-
-            # hopefully, there are no noisy samples at this time
-            db_labels[db_labels > -1] = db_labels[db_labels > -1] + np.max(dbscan_labels) + 1
-            dbscan_labels[idx_row] = db_labels  # + np.max(dbscan_labels) + 1
-
-        if self.method == 'spark':
+                results[i] = db_labels, np.ones(db_labels.size, dtype=bool)
             sc.stop()
-        labels = dbscan_labels
+
+        labels = _merge_blocks(blocks, results, idxs.size)
 
         # new part: put together the labels
         labels_ext = np.zeros(X.shape[0], dtype=int)
@@ -15,28 +15,151 @@ import multiprocessing as mp
 import numpy as np
 import os
 import pandas as pd
-import scipy
+import scipy.sparse
 import seaborn as sns; sns.set_context('notebook')
 import sys; sys.setrecursionlimit(10000)
+import warnings
 
 from scipy.cluster.hierarchy import linkage, fcluster
 # from sklearn.cluster import SpectralClustering
-from sklearn.cluster import AffinityPropagation
 from sklearn.metrics import silhouette_samples  # , silhouette_score
+from sklearn.utils import check_random_state
 
+from icing.externals import AffinityPropagation
 from icing.externals import SpectralClustering
 from icing.externals import Tango
 from icing.utils import extra
 
 
+def sparse_silhouette_samples(similarity_matrix, cluster_labels, samples=None,
+                              chunk_size=10000):
+    """Compute the silhouette coefficients from a sparse similarity matrix.
+
+    Distances are ``1 - similarity``, where missing entries have distance 1.
+    For each sample, the sums of similarities towards each cluster are
+    computed by a sparse product with the cluster membership matrix, in
+    chunks of `chunk_size` samples, so the dense distance matrix is never
+    built. Results are the same of `sklearn.metrics.silhouette_samples` on
+    the dense distance matrix.
+
+    Parameters
+    ----------
+    similarity_matrix : scipy.sparse matrix, shape (n_samples, n_samples)
+        Similarity matrix, symmetric or triangular.
+    cluster_labels : array-like, shape (n_samples,)
+        Cluster of each sample.
+    samples : array-like, optional
+        Indices of the samples for which to compute the silhouette. If None,
+        use all the samples.
+    chunk_size : int, optional, default: 10000
+        Number of samples processed at once.
+
+    Returns
+    -------
+    silhouette : array, shape (n_samples,) or (len(samples),)
+        Silhouette coefficient of each sample.
+    """
+    similarity_matrix = extra.symmetric_similarity_matrix(similarity_matrix)
+    unique_labels, labels = np.unique(cluster_labels, return_inverse=True)
+    n_clusters = unique_labels.shape[0]
+    n_samples = labels.shape[0]
+    if not 1 < n_clusters < n_samples:
+        raise ValueError("Number of labels is %d. Valid values are 2 to "
+                         "n_samples - 1 (inclusive)" % n_clusters)
+    if samples is None:
+        samples = np.arange(n_samples)
+    samples = np.asarray(samples)
+
+    sizes = np.bincount(labels).astype(float)
+    membership = scipy.sparse.csr_matrix(
+        (np.ones(n_samples), (np.arange(n_samples), labels)),
+        shape=(n_samples, n_clusters))
+
+    silhouette = np.empty(samples.shape[0])
+    for start in range(0, samples.shape[0], chunk_size):
+        chunk = samples[start:start + chunk_size]
+        own = labels[chunk]
+        # sums of similarities of each sample towards each cluster
+        sums = similarity_matrix[chunk].dot(membership).tocsr()
+        sums.sort_indices()
+        rows = np.repeat(np.arange(chunk.shape[0]), np.diff(sums.indptr))
+
+        intra = np.zeros(chunk.shape[0])
+        is_own = sums.indices == own[rows]
+        intra[rows[is_own]] = sums.data[is_own]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            a = ((sizes[own] - 1) - intra) / (sizes[own] - 1)
+
+        # the nearest cluster is the one with the highest mean similarity;
+        # clusters without similarities have mean distance 1
+        mean_sim = np.where(is_own, -np.inf,
+                            sums.data / sizes[sums.indices])
+        max_sim = np.zeros(chunk.shape[0])
+        n_other = np.bincount(rows[~is_own], minlength=chunk.shape[0])
+        nonempty = np.diff(sums.indptr) > 0
+        max_sim[nonempty] = np.maximum.reduceat(
+            mean_sim, sums.indptr[:-1][nonempty])
+        max_sim[n_other < n_clusters - 1] = np.maximum(
+            max_sim[n_other < n_clusters - 1], 0)
+        b = 1 - max_sim
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            values = (b - a) / np.maximum(a, b)
+        values[sizes[own] == 1] = 0
+        silhouette[start:start + chunk_size] = np.nan_to_num(values)
+    return silhouette
+
+
+def sparse_silhouette_score(similarity_matrix, cluster_labels,
+                            sample_size=None, confidence=0.95,
+                            random_state=None, chunk_size=10000):
+    """Compute the mean silhouette coefficient from a sparse similarity matrix.
+
+    Parameters
+    ----------
+    similarity_matrix : scipy.sparse matrix, shape (n_samples, n_samples)
+        Similarity matrix, symmetric or triangular.
+    cluster_labels : array-like, shape (n_samples,)
+        Cluster of each sample.
+    sample_size : int, optional
+        If not None, estimate the mean on a random subset of samples (the
+        silhouette of each of them is exact).
+    confidence : float, optional, default: 0.95
+        Confidence of the interval of the estimated mean.
+    random_state : int or RandomState, optional
+        Random generator used for sampling.
+    chunk_size : int, optional, default: 10000
+        Number of samples processed at once.
+
+    Returns
+    -------
+    mean, lower, upper : float
+        Mean silhouette and its confidence interval. Without sampling, the
+        interval is collapsed on the mean.
+    """
+    n_samples = similarity_matrix.shape[0]
+    if sample_size is None or sample_size >= n_samples:
+        mean = np.mean(sparse_silhouette_samples(
+            similarity_matrix, cluster_labels, chunk_size=chunk_size))
+        return mean, mean, mean
+
+    from icing.core.learning_function import mean_confidence_interval
+    random_state = check_random_state(random_state)
+    samples = random_state.choice(n_samples, sample_size, replace=False)
+    values = sparse_silhouette_samples(
+        similarity_matrix, cluster_labels, samples=samples,
+        chunk_size=chunk_size)
+    return mean_confidence_interval(values, confidence=confidence)[:3]
+
+
 def plot_clusters_silhouette(X, cluster_labels, n_clusters, root='',
-                             file_format='pdf'):
+                             file_format='pdf', sample_silhouette_values=None):
     """Plot the silhouette score for each cluster, given the distance matrix X.
 
     Parameters
     ----------
     X : array_like, shape [n_samples_a, n_samples_a]
-        Distance matrix.
+        Distance matrix. Unused if `sample_silhouette_values` is given.
     cluster_labels : array_like
         List of integers which represents the cluster of the corresponding
         point in X. The size must be the same has a dimension of X.
@@ -46,6 +169,9 @@ def plot_clusters_silhouette(X, cluster_labels, n_clusters, root='',
         The root path for the output creation
     file_format : ('pdf', 'png')
         Choose the extension for output images.
+    sample_silhouette_values : array_like, optional
+        Precomputed silhouette of each sample, e.g., with
+        `sparse_silhouette_samples`.
     """
     # Create a subplot with 1 row and 2 columns
     fig, (ax1) = plt.subplots(1, 1)
@@ -57,15 +183,16 @@ def plot_clusters_silhouette(X, cluster_labels, n_clusters, root='',
     # ax1.set_xlim([-0.1, 1])
     # The (n_clusters+1)*10 is for inserting blank space between silhouette
     # plots of individual clusters, to demarcate them clearly.
-    ax1.set_ylim([0, len(X) + (n_clusters + 1) * 10])
+    ax1.set_ylim([0, len(cluster_labels) + (n_clusters + 1) * 10])
 
     # The silhouette_score gives the average value for all the samples.
     # This gives a perspective into the density and separation of the formed
     # clusters
 
     # Compute the silhouette scores for each sample
-    sample_silhouette_values = silhouette_samples(X, cluster_labels,
-                                                  metric="precomputed")
+    if sample_silhouette_values is None:
+        sample_silhouette_values = silhouette_samples(X, cluster_labels,
+                                                      metric="precomputed")
     silhouette_avg = np.mean(sample_silhouette_values)
     logging.info("Average silhouette_score: %.4f", silhouette_avg)
 
@@ -80,7 +207,7 @@ def plot_clusters_silhouette(X, cluster_labels, n_clusters, root='',
         size_cluster_i = ith_cluster_silhouette_values.shape[0]
         y_upper = y_lower + size_cluster_i
 
-        color = cm.spectral(float(i) / n_clusters)
+        color = cm.nipy_spectral(float(i) / n_clusters)
         ax1.fill_betweenx(np.arange(y_lower, y_upper),
                           0, ith_cluster_silhouette_values,
                           facecolor=color, edgecolor=color, alpha=0.7)
@@ -102,7 +229,8 @@ def plot_clusters_silhouette(X, cluster_labels, n_clusters, root='',
     ax1.set_xticks([-0.6, -0.4, -0.2, 0, 0.2, 0.4, 0.6, 0.8, 1])
 
     plt.suptitle(("Silhouette analysis (n_clusters {}, avg score {:.4f}, "
-                  "tot Igs {}".format(n_clusters, silhouette_avg, X.shape[0])),
+                  "tot Igs {}".format(n_clusters, silhouette_avg,
+                                      len(cluster_labels))),
                  fontsize=14, fontweight='bold')
     filename = os.path.join(root, 'silhouette_analysis_{}.{}'
                                   .format(extra.get_time(), file_format))
@@ -137,8 +265,119 @@ def save_results_clusters(filename, sample_names, cluster_labels):
             f.write("{}, {}\n".format(a, b))
 
 
+def _to_shared(X):
+    """Copy a dense matrix into shared memory, once for all the workers."""
+    X = np.ascontiguousarray(X, dtype=float)
+    shared = mp.RawArray('d', X.size)
+    np.frombuffer(shared).reshape(X.shape)[...] = X
+    return shared, X.shape
+
+
+def _from_shared(shared, shape):
+    """View of a matrix in shared memory, without copying it."""
+    return np.frombuffer(shared).reshape(shape)
+
+
+def _silhouette_from_sums(sums, labels, sizes):
+    """Average silhouette given the sum of distances of samples to clusters.
+
+    Parameters
+    ----------
+    sums : array-like, shape (n_samples, n_clusters)
+        Sum of distances between each sample and the samples of each cluster.
+    labels : array-like, shape (n_samples,)
+        Cluster of each sample, in [0, n_clusters).
+    sizes : array-like, shape (n_clusters,)
+        Number of samples in each cluster.
+    """
+    if sizes.shape[0] < 2:
+        return 0.
+    rows = np.arange(labels.shape[0])
+    own_sizes = sizes[labels]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        a = sums[rows, labels] / (own_sizes - 1)
+        mean = sums / sizes
+        mean[rows, labels] = np.inf
+        b = mean.min(axis=1)
+        silhouette = (b - a) / np.maximum(a, b)
+    silhouette[own_sizes == 1] = 0
+    return np.mean(np.nan_to_num(silhouette))
+
+
+def dendrogram_silhouette_sweep(dist_matrix, Z, thresholds):
+    """Compute the average silhouette cutting a dendrogram at many heights.
+
+    The sums of distances between each sample and each cluster are merged
+    incrementally following the merges in `Z`, while the dendrogram is cut at
+    increasing heights, instead of computing the silhouette from scratch at
+    each cut. For non-monotonic linkages, sums are aggregated from the
+    distances at each cut.
+
+    Parameters
+    ----------
+    dist_matrix : array-like, shape (n_samples, n_samples)
+        Precomputed distance matrix between points.
+    Z : array-like
+        Linkage matrix, results of scipy.cluster.hierarchy.linkage.
+    thresholds : array-like
+        Heights where to cut the dendrogram.
+
+    Returns
+    -------
+    results : list of tuples
+        For each threshold, in the input order, the number of clusters, the
+        average silhouette and the cluster labels, as `fcluster` with the
+        'distance' criterion.
+    """
+    n = dist_matrix.shape[0]
+    thresholds = np.asarray(thresholds)
+    results = [None] * thresholds.shape[0]
+    if np.any(np.diff(Z[:, 2]) < 0):
+        for i, threshold in enumerate(thresholds):
+            labels = np.unique(fcluster(Z, threshold, 'distance'),
+                               return_inverse=True)[1]
+            membership = np.zeros((n, labels.max() + 1))
+            membership[np.arange(n), labels] = 1
+            sizes = np.bincount(labels).astype(float)
+            results[i] = (sizes.shape[0], _silhouette_from_sums(
+                dist_matrix.dot(membership), labels, sizes), labels + 1)
+        return results
+
+    # columns of sums are clusters; column of each node of Z
+    sums = np.array(dist_matrix, dtype=float)
+    sizes = np.ones(n)
+    node_col = np.arange(2 * n - 1)
+    col_parent = np.arange(n)
+    k = 0
+    for i in np.argsort(thresholds, kind='mergesort'):
+        while k < Z.shape[0] and Z[k, 2] <= thresholds[i]:
+            ca, cb = node_col[int(Z[k, 0])], node_col[int(Z[k, 1])]
+            sums[:, ca] += sums[:, cb]
+            sizes[ca] += sizes[cb]
+            col_parent[cb] = ca
+            node_col[n + k] = ca
+            k += 1
+
+        # current cluster of each sample, then drop merged columns
+        roots = col_parent
+        while np.any(roots[roots] != roots):
+            roots = roots[roots]
+        active = np.where(roots == np.arange(roots.shape[0]))[0]
+        remap = np.empty(roots.shape[0], dtype=int)
+        remap[active] = np.arange(active.shape[0])
+        sums, sizes = sums[:, active], sizes[active]
+        node_col[:n + k] = remap[roots[node_col[:n + k]]]
+        col_parent = np.arange(active.shape[0])
+
+        labels = node_col[:n]
+        results[i] = (active.shape[0], _silhouette_from_sums(
+            sums, labels, sizes), labels + 1)
+    return results
+
+
 def single_silhouette_dendrogram(dist_matrix, Z, threshold, mode='clusters',
-                                 method='single', sample_names=None):
+                                 method='single', sample_names=None,
+                                 save_csv=True):
     """Compute the average silhouette at a given threshold.
 
     Parameters
@@ -162,8 +401,9 @@ def single_silhouette_dendrogram(dist_matrix, Z, threshold, mode='clusters',
     cluster_labels = fcluster(Z, threshold, 'distance')
     nclusts = np.unique(cluster_labels).shape[0]
 
-    save_results_clusters("res_{}_{:03d}_clust.csv".format(method, nclusts),
-                          sample_names, cluster_labels)
+    if save_csv:
+        save_results_clusters("res_{}_{:03d}_clust.csv".format(
+            method, nclusts), sample_names, cluster_labels)
 
     try:
         silhouette_list = silhouette_samples(dist_matrix, cluster_labels,
@@ -181,9 +421,13 @@ def single_silhouette_dendrogram(dist_matrix, Z, threshold, mode='clusters',
 
 
 def multi_cut_dendrogram(dist_matrix, Z, threshold_arr, n, mode='clusters',
-                         method='single', n_jobs=-1, sample_names=None):
+                         method='single', n_jobs=-1, sample_names=None,
+                         save_csv=True):
     """Cut a dendrogram at some heights.
 
+    Silhouettes are computed sequentially by `dendrogram_silhouette_sweep`,
+    which reuses the merges of `Z` between consecutive heights.
+
     Parameters
     ----------
     dist_matrix : array-like
@@ -197,6 +441,10 @@ def multi_cut_dendrogram(dist_matrix, Z, threshold_arr, n, mode='clusters',
         Length of threshold_arr
     mode : ('clusters', 'thresholds'), optional
         Choose what to visualise on the x-axis.
+    n_jobs : int, optional
+        Deprecated and ignored, since the sweep is sequential.
+    save_csv : boolean, optional, default: True
+        Save the clusters at each height with `save_results_clusters`.
 
     Returns
     -------
@@ -204,31 +452,18 @@ def multi_cut_dendrogram(dist_matrix, Z, threshold_arr, n, mode='clusters',
         The results to be visualised on a plot.
 
     """
-    def _internal(dist_matrix, Z, threshold_arr, idx, n_jobs, arr_length,
-                  queue_x, queue_y, mode='clusters', method='single',
-                  sample_names=None):
-        for i in range(idx, arr_length, n_jobs):
-            queue_x[i], queue_y[i] = single_silhouette_dendrogram(
-                dist_matrix, Z, threshold_arr[i], mode, method, sample_names)
-
-    if n_jobs == -1:
-        n_jobs = min(mp.cpu_count(), n)
-    queue_x, queue_y = mp.Array('d', [0.] * n), mp.Array('d', [0.] * n)
-    ps = []
-    try:
-        for idx in range(n_jobs):
-            p = mp.Process(target=_internal,
-                           args=(dist_matrix, Z, threshold_arr, idx, n_jobs, n,
-                                 queue_x, queue_y, mode, method, sample_names))
-            p.start()
-            ps.append(p)
-
-        for p in ps:
-            p.join()
-    except (KeyboardInterrupt, SystemExit):
-        extra.term_processes(ps, 'Exit signal received\n')
-    except BaseException as e:
-        extra.term_processes(ps, 'ERROR: %s\n' % e)
+    if n_jobs != -1:
+        warnings.warn("n_jobs is deprecated and ignored, the dendrogram is "
+                      "cut sequentially.", DeprecationWarning)
+    queue_x, queue_y = np.zeros(n), np.zeros(n)
+    results = dendrogram_silhouette_sweep(
+        np.asarray(dist_matrix), Z, threshold_arr[:n])
+    for i, (nclusts, silhouette_avg, cluster_labels) in enumerate(results):
+        if save_csv:
+            save_results_clusters("res_{}_{:03d}_clust.csv".format(
+                method, nclusts), sample_names, cluster_labels)
+        queue_x[i] = nclusts if mode == 'clusters' else threshold_arr[i]
+        queue_y[i] = silhouette_avg
     return queue_x, queue_y
 
 
@@ -236,7 +471,7 @@ def plot_average_silhouette_dendrogram(
         X, method_list=None, mode='clusters', n=20, min_threshold=0.02,
         max_threshold=0.8, verbose=True, interactive_mode=False,
         file_format='pdf', xticks=None, xlim=None, figsize=None, n_jobs=-1,
-        sample_names=None):
+        sample_names=None, save_csv=True):
     """Plot average silhouette for each tree cutting.
 
     A linkage matrix for each method in method_list is used.
@@ -259,12 +494,17 @@ def plot_average_silhouette_dendrogram(
         False: final plot will be only saved.
     file_format : ('pdf', 'png')
         Choose the extension for output images.
+    n_jobs : int, optional
+        Deprecated and ignored, since dendrograms are cut sequentially.
 
     Returns
     -------
     filename : str
         The output filename.
     """
+    if n_jobs != -1:
+        warnings.warn("n_jobs is deprecated and ignored, the dendrogram is "
+                      "cut sequentially.", DeprecationWarning)
     if method_list is None:
         method_list = ('single', 'complete', 'average', 'weighted',
                        'centroid', 'median', 'ward')
@@ -289,8 +529,9 @@ def plot_average_silhouette_dendrogram(
             max_i = max(Z[:, 2]) if method != 'ward' else np.percentile(Z[:, 2], 99.5)
             threshold_arr *= max_i
 
-        x, y = multi_cut_dendrogram(X, Z, threshold_arr, n, mode, method, n_jobs,
-                                    sample_names=sample_names)
+        x, y = multi_cut_dendrogram(X, Z, threshold_arr, n, mode, method,
+                                    sample_names=sample_names,
+                                    save_csv=save_csv)
         ax.plot(x, y, Tango.nextDark(), marker='o', ms=3, ls='-', label=method)
 
     # fig.tight_layout()
@@ -322,9 +563,11 @@ def plot_average_silhouette_dendrogram(
 
 
 def multi_cut_spectral(cluster_list, affinity_matrix, dist_matrix, n_jobs=-1,
-                       sample_names=None):
+                       sample_names=None, save_csv=True):
     """Perform a spectral clustering with variable cluster sizes.
 
+    Matrices are copied once in shared memory, and read by all the workers.
+
     Parameters
     ----------
     cluster_list : array-like
@@ -333,6 +576,8 @@ def multi_cut_spectral(cluster_list, affinity_matrix, dist_matrix, n_jobs=-1,
         Precomputed affinity matrix.
     dist_matrix : array-like
         Precomputed distance matrix between points.
+    save_csv : boolean, optional, default: True
+        Save the clusters of each step with `save_results_clusters`.
 
     Returns
     -------
@@ -341,8 +586,10 @@ def multi_cut_spectral(cluster_list, affinity_matrix, dist_matrix, n_jobs=-1,
         silhouette for each number of clusters present in cluster_list.
 
     """
-    def _internal(cluster_list, affinity_matrix, dist_matrix,
+    def _internal(cluster_list, affinity_shared, dist_shared, shape,
                   idx, n_jobs, n, queue_y):
+        affinity_matrix = _from_shared(affinity_shared, shape)
+        dist_matrix = _from_shared(dist_shared, shape)
         for i in range(idx, n, n_jobs):
             sp = SpectralClustering(n_clusters=cluster_list[i],
                                     affinity='precomputed',
@@ -350,9 +597,10 @@ def multi_cut_spectral(cluster_list, affinity_matrix, dist_matrix, n_jobs=-1,
                                     n_init=1000)
             sp.fit(affinity_matrix)
 
-            save_results_clusters("res_spectral_{:03d}_clust.csv"
-                                  .format(cluster_list[i]),
-                                  sample_names, sp.labels_)
+            if save_csv:
+                save_results_clusters("res_spectral_{:03d}_clust.csv"
+                                      .format(cluster_list[i]),
+                                      sample_names, sp.labels_)
 
             silhouette_list = silhouette_samples(dist_matrix, sp.labels_,
                                                  metric="precomputed")
@@ -361,13 +609,15 @@ def multi_cut_spectral(cluster_list, affinity_matrix, dist_matrix, n_jobs=-1,
     n = len(cluster_list)
     if n_jobs == -1:
         n_jobs = min(mp.cpu_count(), n)
+    affinity_shared, shape = _to_shared(affinity_matrix)
+    dist_shared, _ = _to_shared(dist_matrix)
     queue_y = mp.Array('d', [0.] * n)
     ps = []
     try:
         for idx in range(n_jobs):
             p = mp.Process(target=_internal,
-                           args=(cluster_list, affinity_matrix, dist_matrix,
-                                 idx, n_jobs, n, queue_y))
+                           args=(cluster_list, affinity_shared, dist_shared,
+                                 shape, idx, n_jobs, n, queue_y))
             p.start()
             ps.append(p)
 
@@ -383,7 +633,8 @@ def multi_cut_spectral(cluster_list, affinity_matrix, dist_matrix, n_jobs=-1,
 def plot_average_silhouette_spectral(
         X, n=30, min_clust=10, max_clust=None, verbose=True,
         interactive_mode=False, file_format='pdf', n_jobs=-1,
-        sample_names=None, affinity_delta=.2, is_affinity=False):
+        sample_names=None, affinity_delta=.2, is_affinity=False,
+        save_csv=True):
     """Plot average silhouette for some clusters, using an affinity matrix.
 
     Parameters
@@ -414,7 +665,7 @@ def plot_average_silhouette_spectral(
         max_clust = X.shape[0]
     cluster_list = np.unique(map(int, np.linspace(min_clust, max_clust, n)))
     y = multi_cut_spectral(cluster_list, A, X, n_jobs=n_jobs,
-                           sample_names=sample_names)
+                           sample_names=sample_names, save_csv=save_csv)
     ax.plot(cluster_list, y, Tango.next(), marker='o', linestyle='-', label='')
 
     # leg = ax.legend(loc='lower right')
@@ -445,56 +696,65 @@ def plot_average_silhouette_spectral(
     return filename
 
 def multi_cut_ap(preferences, affinity_matrix, dist_matrix, n_jobs=-1,
-                 sample_names=None):
+                 sample_names=None, save_csv=True):
     """Perform a AP clustering with variable cluster sizes.
 
+    AP is fitted on the sorted preferences as a path, where each preference
+    is warm started from the previous solution. Silhouettes are then
+    computed in parallel, on a distance matrix in shared memory.
+
     Parameters
     ----------
-    cluster_list : array-like
-        Contains the list of the number of clusters to use at each step.
+    preferences : array-like
+        Contains the list of preferences to use at each step.
     affinity_matrix : array-like
         Precomputed affinity matrix.
     dist_matrix : array-like
         Precomputed distance matrix between points.
+    save_csv : boolean, optional, default: True
+        Save the clusters of each preference with `save_results_clusters`.
 
     Returns
     -------
     queue_y : array-like
         Array to be visualised on the y-axis. Contains the list of average
-        silhouette for each number of clusters present in cluster_list.
+        silhouette for each preference present in preferences.
 
     """
-    def _internal(preferences, affinity_matrix, dist_matrix,
-                  idx, n_jobs, n, queue_y):
+    def _internal(labels_path, dist_shared, shape, idx, n_jobs, n, queue_y):
+        dist_matrix = _from_shared(dist_shared, shape)
         for i in range(idx, n, n_jobs):
-            ap = AffinityPropagation(preference=preferences[i],
-                                     affinity='precomputed',
-                                     max_iter=500)
-            ap.fit(affinity_matrix)
-
-            cluster_labels = ap.labels_.copy()
+            cluster_labels = labels_path[i]
             nclusts = np.unique(cluster_labels).shape[0]
-            save_results_clusters("res_ap_{:03d}_clust.csv"
-                                  .format(nclusts),
-                                  sample_names, ap.labels_)
+            if save_csv:
+                save_results_clusters("res_ap_{:03d}_clust.csv"
+                                      .format(nclusts),
+                                      sample_names, cluster_labels)
 
             if nclusts > 1:
                 try:
-                    silhouette_list = silhouette_samples(dist_matrix, ap.labels_,
-                                                     metric="precomputed")
+                    silhouette_list = silhouette_samples(
+                        dist_matrix, cluster_labels, metric="precomputed")
                     queue_y[i] = np.mean(silhouette_list)
                 except BaseException:
-                    print(dist_matrix.shape, ap.labels_.shape)
+                    print(dist_matrix.shape, cluster_labels.shape)
 
     n = len(preferences)
+    order = np.argsort(preferences)
+    ap = AffinityPropagation(affinity='precomputed', max_iter=500)
+    labels_path = np.empty((n, affinity_matrix.shape[0]), dtype=int)
+    labels_path[order] = ap.fit_path(
+        affinity_matrix, np.asarray(preferences)[order])[0]
+
     if n_jobs == -1:
         n_jobs = min(mp.cpu_count(), n)
+    dist_shared, shape = _to_shared(dist_matrix)
     queue_y = mp.Array('d', [0.] * n)
     ps = []
     try:
         for idx in range(n_jobs):
             p = mp.Process(target=_internal,
-                           args=(preferences, affinity_matrix, dist_matrix,
+                           args=(labels_path, dist_shared, shape,
                                  idx, n_jobs, n, queue_y))
             p.start()
             ps.append(p)
@@ -511,7 +771,8 @@ def multi_cut_ap(preferences, affinity_matrix, dist_matrix, n_jobs=-1,
 def plot_average_silhouette_ap(
         X, n=30, verbose=True,
         interactive_mode=False, file_format='pdf', n_jobs=-1,
-        sample_names=None, affinity_delta=.2, is_affinity=False):
+        sample_names=None, affinity_delta=.2, is_affinity=False,
+        save_csv=True):
     """Plot average silhouette for some clusters, using an affinity matrix.
 
     Parameters
@@ -544,7 +805,7 @@ def plot_average_silhouette_ap(
     preferences = np.append(np.linspace(np.min(A), np.median(A), n - 1),
                             np.median(A))
     y = multi_cut_ap(preferences, A, X, n_jobs=n_jobs,
-                     sample_names=sample_names)
+                     sample_names=sample_names, save_csv=save_csv)
     ax.plot(preferences, y, Tango.next(), marker='o', linestyle='-', label='')
 
     # leg = ax.legend(loc='lower right')
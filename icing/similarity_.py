@@ -3,15 +3,27 @@ import logging
 import numpy as np
 
 from scipy import sparse
-from sklearn.base import BaseEstimator
-
-from icing.core.distances import StringDistance
+from sklearn.base import BaseEstimator, clone
+
+from icing.core.checkpoint import ShardStore, params_digest, shard_pairs
+from icing.core.distances import StringDistance, apply_correction
+from icing.core.distances import block_string_distances, block_weights
+from icing.core.parallel_distance import candidate_pairs
+from icing.core.parallel_distance import estimate_pair_costs
+from icing.core.parallel_distance import hamming_candidate_pairs
+from icing.core.parallel_distance import index_dtype_for
+from icing.core.parallel_distance import is_hamming_model
+from icing.core.parallel_distance import minhash_candidate_pairs
 from icing.core.parallel_distance import sm_sparse
 from icing.kernel import stringkernel
 from icing.models.model import model_matrix
+from icing.utils.extra import LRUCache
 
 
-def compute_similarity_matrix(db_iter, sparse_mode=True, igsimilarity=None):
+def compute_similarity_matrix(db_iter, sparse_mode=True, igsimilarity=None,
+                              dtype=np.float64, min_similarity=0.,
+                              lsh_params=None, work_dir=None,
+                              shard_size=100000):
     """Compute the similarity matrix from a database iterator.
 
     Parameters
@@ -22,6 +34,34 @@ def compute_similarity_matrix(db_iter, sparse_mode=True, igsimilarity=None):
         Return a sparse similarity matrix.
     sim_func_args : dict, optional
         Optional parameters for the similarity function.
+    dtype : numpy dtype, optional, default: np.float64
+        Type of similarities. Use np.float32 (with 32 bits indices) to halve
+        the memory of the matrix.
+    min_similarity : float, optional, default: 0.
+        Keep only similarities of at least `min_similarity`. Lower values
+        are discarded while computing them, so they never reach the matrix.
+        With a Hamming junction model ('ham', 'aa'), candidate pairs of
+        junctions with the same length are generated by
+        `hamming_candidate_pairs`, so that only pairs within the distance
+        cutoff are evaluated. With a `StringSimilarity` junction similarity,
+        the junction distance of the other pairs is abandoned as soon as it
+        exceeds ``1 - min_similarity``.
+    lsh_params : dict, optional
+        Parameters of `minhash_candidate_pairs` (`k`, `n_bands`, `n_rows`,
+        `random_state`). If given, only pairs of records whose junctions
+        collide in a MinHash band are evaluated. This is an approximate
+        filter, for string kernels on large V gene buckets; check its recall
+        with `icing.validation.pruning.compare_minhash`.
+    work_dir : str, optional
+        If given, candidate pairs are split into shards by `shard_pairs`,
+        and the similarities of each shard are saved in `work_dir` as soon
+        as they are computed. A later call with the same records and
+        parameters only computes the missing shards, so an interrupted run
+        can be resumed. With an `IgSimilarity`, shards store uncorrected
+        similarities and the mutation correction is applied after merging
+        them, so that changing `correct_by` does not discard them.
+    shard_size : int, optional, default: 100000
+        Maximum number of candidate pairs in a shard.
 
     Returns
     -------
@@ -47,9 +87,42 @@ def compute_similarity_matrix(db_iter, sparse_mode=True, igsimilarity=None):
     # logging.info("Start similar_elements function ...")
     # rows, cols = similar_elements(dd, igs, n, similarity_function)
 
+    pairs = None
+    junction_sim = getattr(igsimilarity, 'junction_sim', None)
+    if min_similarity > 0 and isinstance(junction_sim, StringSimilarity) \
+            and junction_sim.max_distance is None:
+        # junction distances are abandoned as soon as they exceed the
+        # cutoff; the correction can only lower similarities, so no pair at
+        # least `min_similarity` is lost
+        igsimilarity = clone(igsimilarity)
+        junction_sim = igsimilarity.junction_sim
+        junction_sim.max_distance = 1 - min_similarity
+    if lsh_params is not None:
+        pairs = minhash_candidate_pairs(
+            [x.setV for x in igs], [x.junc for x in igs],
+            [x.junction_length for x in igs], igsimilarity.tol,
+            **lsh_params)
+        logging.info("MinHash prefilter kept %i candidate pairs",
+                     pairs[0].shape[0])
+    elif min_similarity > 0 and isinstance(junction_sim, StringSimilarity) \
+            and is_hamming_model(junction_sim.dist_mat):
+        pairs = hamming_candidate_pairs(
+            [x.setV for x in igs], [x.junc for x in igs],
+            [x.junction_length for x in igs], igsimilarity.tol,
+            1 - min_similarity, junction_sim.dist_mat)
+
     logging.info("Start parallel_sim_matrix function ...")
-    data, rows, cols = sm_sparse(
-        np.array(igs), igsimilarity.pairwise, igsimilarity.tol)
+    if work_dir is not None:
+        data, rows, cols = _checkpointed_similarities(
+            igs, igsimilarity, pairs, dtype, min_similarity, work_dir,
+            shard_size)
+    elif isinstance(igsimilarity, IgSimilarity):
+        data, rows, cols = _batch_similarities(
+            igs, igsimilarity, pairs, dtype, min_similarity)
+    else:
+        data, rows, cols = sm_sparse(
+            np.array(igs), igsimilarity.pairwise, igsimilarity.tol,
+            dtype=dtype, min_similarity=min_similarity, pairs=pairs)
 
     sparse_mat = sparse.csr_matrix((data, (rows, cols)), shape=(n, n))
     similarity_matrix = sparse_mat  # connected components works well
@@ -59,6 +132,110 @@ def compute_similarity_matrix(db_iter, sparse_mode=True, igsimilarity=None):
     return similarity_matrix
 
 
+def _batch_similarities(igs, igsimilarity, pairs, dtype, min_similarity,
+                        raw=False):
+    """Similarities of the candidate pairs with `IgSimilarity`."""
+    # junction similarities are computed once for each unique pair
+    if pairs is None:
+        pairs = candidate_pairs(
+            [x.setV for x in igs], [x.junction_length for x in igs],
+            igsimilarity.tol)
+    rows, cols = pairs
+    data = igsimilarity.batch_pairwise(
+        igs, rows, cols, min_similarity=min_similarity, raw=raw)
+    keep = (data > 0) & (data >= min_similarity)
+    index_dtype = index_dtype_for(np.dtype(dtype), len(igs))
+    return (data[keep].astype(dtype), rows[keep].astype(index_dtype),
+            cols[keep].astype(index_dtype))
+
+
+def _checkpointed_similarities(igs, igsimilarity, pairs, dtype,
+                               min_similarity, work_dir, shard_size):
+    """Similarities of the candidate pairs, computed shard by shard."""
+    if pairs is None:
+        pairs = candidate_pairs(
+            [x.setV for x in igs], [x.junction_length for x in igs],
+            igsimilarity.tol)
+    rows, cols = np.asarray(pairs[0]), np.asarray(pairs[1])
+    shards = shard_pairs(
+        [x.junction_length for x in igs], rows, cols, shard_size)
+
+    # the mutation correction is applied after merging, so that shards
+    # survive a change of the correction (e.g., learned again at each run)
+    batch = isinstance(igsimilarity, IgSimilarity)
+    correct_by = igsimilarity.correct_by if batch and \
+        igsimilarity.correct else None
+    params = igsimilarity.get_params(deep=False)
+    if batch:
+        params.pop('correct_by')
+    digest = params_digest(
+        type(igsimilarity).__name__, params, np.dtype(dtype).str,
+        min_similarity, rows, cols, [(x.junc, x.setV, x.mut) for x in igs])
+    store = ShardStore(work_dir, digest, len(shards))
+
+    completed = set(store.completed())
+    logging.info("%i of %i similarity shards already computed in %s",
+                 len(completed), len(shards), work_dir)
+    for i, shard in enumerate(shards):
+        if i in completed:
+            continue
+        if batch:
+            results = _batch_similarities(
+                igs, igsimilarity, (rows[shard], cols[shard]), dtype,
+                min_similarity, raw=True)
+        else:
+            results = sm_sparse(
+                np.array(igs), igsimilarity.pairwise, igsimilarity.tol,
+                dtype=dtype, min_similarity=min_similarity,
+                pairs=(rows[shard], cols[shard]))
+        store.save(i, *results)
+        logging.info("Similarity shard %i of %i done (%i pairs)", i + 1,
+                     len(shards), shard.shape[0])
+
+    index_dtype = index_dtype_for(np.dtype(dtype), len(igs))
+    results = [store.load(i) for i in range(len(shards))]
+    data = np.concatenate([np.empty(0, dtype=dtype)] +
+                          [x[0] for x in results])
+    rows = np.concatenate([np.empty(0, dtype=index_dtype)] +
+                          [x[1] for x in results])
+    cols = np.concatenate([np.empty(0, dtype=index_dtype)] +
+                          [x[2] for x in results])
+    if correct_by is not None:
+        data = apply_correction(data, rows, cols, [x.mut for x in igs],
+                                correct_by).astype(dtype)
+        keep = (data > 0) & (data >= min_similarity)
+        data, rows, cols = data[keep], rows[keep], cols[keep]
+    return data, rows, cols
+
+
+def correct_similarity_matrix(similarity_matrix, records, correct_by):
+    """Apply the mutation correction to a raw similarity matrix.
+
+    Parameters
+    ----------
+    similarity_matrix : scipy.sparse matrix
+        Uncorrected similarities, as computed by `compute_similarity_matrix`
+        with an `IgSimilarity` with ``correct=False``.
+    records : list of IgRecord
+        Records of the matrix, with their mutation levels.
+    correct_by : function
+        Correction for a mutation level, such as a learned `np.poly1d`.
+
+    Returns
+    -------
+    similarity_matrix : scipy.sparse.csr_matrix
+        Corrected similarities, with the same type.
+    """
+    matrix = sparse.coo_matrix(similarity_matrix)
+    data = apply_correction(matrix.data, matrix.row, matrix.col,
+                            [x.mut for x in records], correct_by)
+    corrected = sparse.csr_matrix(
+        (data.astype(matrix.dtype), (matrix.row, matrix.col)),
+        shape=matrix.shape)
+    corrected.eliminate_zeros()
+    return corrected
+
+
 class Similarity(BaseEstimator):
     _estimator_type = "similarity"
 
@@ -81,21 +258,158 @@ class StringKernel(Similarity):
             hard_matching=self.hard_matching)
 
 
+class FeatureMapStringKernel(StringKernel):
+    """String kernel approximated with an explicit feature map.
+
+    The sum of subsequence string kernels for lengths from `min_kn` to
+    `max_kn` is the dot product of vectors indexed by subsequences, where
+    each occurrence of a subsequence u in s weights ``lamda ** span``.
+    Here only occurrences spanning at most ``len(u) + max_gap`` characters
+    are kept, so that vectors are sparse and can be built once for each
+    unique junction. Normalised kernel values are then sparse dot products.
+
+    With hard matching, and `max_gap` at least the length of the strings,
+    this is the exact kernel of `StringKernel`. Use
+    `approximation_error` to check the error on a dataset.
+    """
+
+    def __init__(self, min_kn=1, max_kn=2, lamda=.5,
+                 check_min_length=0, hard_matching=1, max_gap=2):
+        super(FeatureMapStringKernel, self).__init__(
+            min_kn=min_kn, max_kn=max_kn, lamda=lamda,
+            check_min_length=check_min_length, hard_matching=hard_matching)
+        self.max_gap = max_gap
+
+    def features(self, strings):
+        """Compute the normalised feature vectors of strings.
+
+        Parameters
+        ----------
+        strings : array-like
+            String sequences.
+
+        Returns
+        -------
+        features : scipy.sparse.csr_matrix, shape (n_strings, n_features)
+            Feature vector of each string, with unit norm.
+        """
+        from itertools import combinations
+        strings = np.asarray(strings, dtype=object)
+        n = strings.shape[0]
+        chars = np.unique(np.fromstring(''.join(strings), dtype=np.uint8))
+        lookup = np.zeros(256, dtype=np.int64)
+        lookup[chars] = np.arange(1, chars.shape[0] + 1)
+        base = chars.shape[0] + 1
+        if float(base) ** self.max_kn * (self.max_kn + 1) >= 2 ** 63:
+            raise ValueError("max_kn is too high for the alphabet size")
+        lengths = np.array([len(x) for x in strings], dtype=int)
+
+        rows, keys, weights = [], [], []
+        for length in np.unique(lengths):
+            idx = np.where(lengths == length)[0]
+            codes = lookup[np.fromstring(''.join(strings[idx]), dtype=np.uint8)
+                           ].reshape(idx.shape[0], length)
+            for kn in range(self.min_kn, self.max_kn + 1):
+                if length < kn:
+                    # as the exact kernel, short strings match only if equal
+                    patterns = [(tuple(range(length)), 1.)] if length else []
+                else:
+                    patterns = [((0,), self.lamda)] if kn == 1 else [
+                        ((0,) + inner + (span - 1,), self.lamda ** span)
+                        for span in range(
+                            kn, min(kn + self.max_gap, length) + 1)
+                        for inner in combinations(range(1, span - 1), kn - 2)]
+                for offsets, weight in patterns:
+                    starts = np.arange(length - offsets[-1])
+                    key = np.zeros((idx.shape[0], starts.shape[0]),
+                                   dtype=np.int64)
+                    for offset in offsets:
+                        key = key * base + codes[:, starts + offset]
+                    rows.append(np.repeat(idx, starts.shape[0]))
+                    keys.append(key.ravel() * (self.max_kn + 1) + kn)
+                    weights.append(np.full(key.size, weight))
+
+        if not rows:
+            return sparse.csr_matrix((n, 0))
+        columns, keys = np.unique(np.concatenate(keys), return_inverse=True)
+        features = sparse.csr_matrix(
+            (np.concatenate(weights), (np.concatenate(rows), keys)),
+            shape=(n, columns.shape[0]))
+        norms = np.sqrt(np.asarray(features.multiply(features).sum(axis=1))
+                        ).ravel()
+        norms[norms == 0] = 1
+        return sparse.diags(1. / norms).dot(features).tocsr()
+
+    def pairwise(self, x1, x2):
+        features = self.features([x1, x2])
+        return features[0].dot(features[1].T).toarray()[0, 0]
+
+    def batch_pairwise(self, strings, rows, cols):
+        """Compute similarities between pairs of strings of a collection.
+
+        Feature vectors are computed once for each unique string, and
+        pairs are processed in chunks to bound memory.
+        """
+        uniques, inverse = np.unique(np.asarray(strings, dtype=object),
+                                     return_inverse=True)
+        features = self.features(uniques)
+        rows, cols = inverse[np.asarray(rows)], inverse[np.asarray(cols)]
+        chunk = 4096
+        return np.concatenate([np.empty(0)] + [np.asarray(
+            features[rows[start:start + chunk]].multiply(
+                features[cols[start:start + chunk]]).sum(axis=1)).ravel()
+            for start in range(0, rows.shape[0], chunk)])
+
+    def pairwise_matrix(self, strings):
+        """Compute the sparse kernel matrix between all strings."""
+        features = self.features(strings)
+        return features.dot(features.T).tocsr()
+
+    def approximation_error(self, strings, n_pairs=1000, random_state=None):
+        """Compare the approximation with the exact `StringKernel`.
+
+        Parameters
+        ----------
+        strings : array-like
+            String sequences.
+        n_pairs : int, optional, default: 1000
+            Number of random pairs of strings to compare.
+
+        Returns
+        -------
+        report : dict
+            Maximum and mean absolute error (``max_error``, ``mean_error``)
+            on the pairs, and the number of pairs (``n_pairs``).
+        """
+        from sklearn.utils import check_random_state
+        random_state = check_random_state(random_state)
+        strings = np.asarray(strings, dtype=object)
+        rows = random_state.randint(strings.shape[0], size=n_pairs)
+        cols = random_state.randint(strings.shape[0], size=n_pairs)
+        approx = self.batch_pairwise(strings, rows, cols)
+        exact = np.array([super(FeatureMapStringKernel, self).pairwise(
+            strings[i], strings[j]) for i, j in zip(rows, cols)])
+        error = np.abs(approx - exact)
+        return dict(max_error=error.max() if n_pairs else 0.,
+                    mean_error=error.mean() if n_pairs else 0.,
+                    n_pairs=n_pairs)
+
+
 class StringSimilarity(StringDistance, Similarity):
     """Utility class for string distance."""
 
-    def __init__(self, model='ham', dist_mat=None, tol=3):
-        self.model = model
-        self.dist_mat = dist_mat
-        self.tol = tol
-
-        if self.dist_mat is None:
-            self.dist_mat = model_matrix(model)
-        self.dist_mat_max = np.max(np.max(self.dist_mat))
+    def __init__(self, model='ham', dist_mat=None, tol=3, max_distance=None):
+        super(StringSimilarity, self).__init__(
+            model=model, dist_mat=dist_mat, tol=tol, max_distance=max_distance)
 
     def pairwise(self, x1, x2):
         return 1 - super(StringSimilarity, self).pairwise(x1, x2)
 
+    def batch_pairwise(self, strings, rows, cols):
+        """Compute similarities between pairs of strings of a collection."""
+        return 1 - super(StringSimilarity, self).batch_pairwise(
+            strings, rows, cols)
+
 
 class IgSimilarity(Similarity):
     """Container for computing distance between IgRecords."""
@@ -108,7 +422,7 @@ class IgSimilarity(Similarity):
     #     pass
     def __init__(
             self, junction_sim, tol=3, rm_duplicates=False,
-            correct=True, correct_by=None):
+            correct=True, correct_by=None, cache_size=65536):
         """Calculate a similarity between two input immunoglobulins.
 
         Parameters
@@ -117,6 +431,11 @@ class IgSimilarity(Similarity):
             Tolerance in the length of the sequences. Default is 3 (3 nucleotides
             form an amminoacid. If seq1 and seq2 represent amminoacidic sequences,
             use tol = 1).
+        cache_size : int, optional, default: 65536
+            Number of junction similarities kept by `pairwise` in an LRU
+            cache (`junction_cache_`, with hit and miss counters), so that
+            records with the same junctions are compared once. Use 0 to
+            disable it.
 
         Returns
         -------
@@ -131,6 +450,23 @@ class IgSimilarity(Similarity):
         self.correct = correct
         self.correct_by = correct_by
         self.tol = tol
+        self.cache_size = cache_size
+
+    def _junction_similarity(self, junc1, junc2):
+        """Similarity between junctions, looked up in the LRU cache."""
+        if not self.cache_size:
+            return self.junction_sim.pairwise(junc1, junc2)
+        if getattr(self, 'junction_cache_', None) is None:
+            self.junction_cache_ = LRUCache(self.cache_size)
+        # the alignment of junctions with different lengths depends on the
+        # order of the arguments, so (junc1, junc2) and (junc2, junc1) are
+        # different keys
+        key = (junc1, junc2)
+        similarity = self.junction_cache_.get(key)
+        if similarity is None:
+            similarity = self.junction_sim.pairwise(junc1, junc2)
+            self.junction_cache_[key] = similarity
+        return similarity
 
     def pairwise(self, x1, x2):
         """Compute pairwise similarity.
@@ -147,12 +483,139 @@ class IgSimilarity(Similarity):
                 len(x1.setV & x2.setV) < 1:
             return 0.
 
-        similarity = self.junction_sim.pairwise(x1.junc, x2.junc)
+        similarity = self._junction_similarity(x1.junc, x2.junc)
         if similarity > 0 and self.correct:
             correction = self.correct_by(np.mean((x1.mut, x2.mut)))
             similarity *= np.clip(correction, 0, 1)
         return max(similarity, 0)
 
+    def _block_similarities(self, records, inverse, uniques, rows, cols,
+                            min_similarity):
+        """Similarities of pairs of different junctions of the same length.
+
+        They are computed by `block_string_distances` on the unique
+        junctions of each V gene, and are equal to the ones of
+        `junction_sim`.
+        """
+        involved = np.zeros(uniques.shape[0], dtype=bool)
+        involved[rows] = involved[cols] = True
+        genes = {}
+        for record, junction in zip(records, inverse):
+            if involved[junction]:
+                for gene in record.setV:
+                    genes.setdefault(gene, set()).add(junction)
+        max_distance = 1. - min_similarity
+        if self.junction_sim.max_distance is not None:
+            max_distance = min(max_distance, self.junction_sim.max_distance)
+        # distances equal to the cutoff are kept
+        block_rows, block_cols, distances = block_string_distances(
+            uniques, [sorted(x) for x in genes.values()],
+            self.junction_sim.dist_mat, self.junction_sim.dist_mat_max,
+            max_distance=np.nextafter(max_distance, np.inf))
+
+        m = uniques.shape[0]
+        block_codes = block_rows.astype(np.int64) * m + block_cols
+        # the distance of junctions with the same length is symmetric
+        codes = np.minimum(rows, cols).astype(np.int64) * m + \
+            np.maximum(rows, cols)
+        similarities = np.zeros(codes.shape[0])
+        if block_codes.shape[0] == 0:
+            return similarities
+        position = np.minimum(np.searchsorted(block_codes, codes),
+                              block_codes.shape[0] - 1)
+        found = block_codes[position] == codes
+        similarities[found] = 1 - distances[position[found]]
+        similarities[(similarities <= 0) | (
+            similarities < min_similarity)] = 0
+        return similarities
+
+    def batch_pairwise(self, records, rows, cols, min_similarity=0.,
+                       raw=False):
+        """Compute similarities between pairs of records of a collection.
+
+        Records are mapped to their unique junctions, and the junction
+        similarity is computed in parallel once for each ordered pair of
+        unique junctions, then broadcast to the pairs of records. With a
+        `StringSimilarity` accepted by `block_weights`, pairs of different
+        junctions with the same length are computed with block products by
+        `block_string_distances`. Length and V gene filters are applied to
+        each pair of records, as in `pairwise`, and the mutation correction
+        is applied to all the pairs at once by `apply_correction`.
+
+        Parameters
+        ----------
+        records : list of IgRecord
+            Collection of records.
+        rows, cols : array_like
+            Indices of the pairs of records.
+        min_similarity : float, optional, default: 0.
+            Junction similarities lower than this are not kept, and their
+            pairs get a null similarity. The correction does not increase
+            similarities, so this does not change the pairs at least
+            `min_similarity`.
+        raw : bool, optional, default: False
+            If True, do not apply the mutation correction. Raw similarities
+            can be corrected later, with any correction function, by
+            `apply_correction` or `correct_similarity_matrix`.
+
+        Returns
+        -------
+        similarities : array
+            Similarity of each pair.
+        """
+        rows, cols = np.asarray(rows, dtype=int), np.asarray(cols, dtype=int)
+        junctions = np.empty(len(records), dtype=object)
+        junctions[:] = [x.junc for x in records]
+        uniques, inverse = np.unique(junctions, return_inverse=True)
+        lengths = np.array([x.junction_length for x in records], dtype=int)
+        valid = np.abs(lengths[rows] - lengths[cols]) <= self.tol
+        valid &= np.array([len(records[i].setV & records[j].setV) > 0
+                           for i, j in zip(rows, cols)], dtype=bool)
+        if self.rm_duplicates:
+            valid &= inverse[rows] != inverse[cols]
+
+        # pairs keep the order of the records, as junction similarities
+        # of different lengths are not symmetric
+        m = uniques.shape[0]
+        codes, pair_inverse = np.unique(
+            inverse[rows[valid]].astype(np.int64) * m + inverse[cols[valid]],
+            return_inverse=True)
+        junc_rows, junc_cols = codes // m, codes % m
+        junction_similarities = np.zeros(codes.shape[0])
+        unique_lengths = np.array([len(x) for x in uniques], dtype=int)
+        per_pair = np.ones(codes.shape[0], dtype=bool)
+        if isinstance(self.junction_sim, StringSimilarity) and \
+                block_weights(self.junction_sim.dist_mat) is not None:
+            # different junctions with the same length are compared with
+            # block products, for each V gene
+            per_pair = (junc_rows == junc_cols) | (
+                unique_lengths[junc_rows] != unique_lengths[junc_cols])
+            blocks = ~per_pair
+            junction_similarities[blocks] = self._block_similarities(
+                records, inverse, uniques, junc_rows[blocks],
+                junc_cols[blocks], min_similarity)
+
+        # string kernels do not align junctions, all pairs cost alike
+        kernel = isinstance(self.junction_sim, StringKernel)
+        costs = estimate_pair_costs(
+            unique_lengths, junc_rows[per_pair], junc_cols[per_pair],
+            alignment=not kernel, kn_range=self.junction_sim.max_kn -
+            self.junction_sim.min_kn + 1 if kernel else 1)
+        data, pair_rows, pair_cols = sm_sparse(
+            uniques, self.junction_sim.pairwise, self.tol,
+            min_similarity=min_similarity,
+            pairs=(junc_rows[per_pair], junc_cols[per_pair]), costs=costs)
+        junction_similarities[np.searchsorted(
+            codes, pair_rows.astype(np.int64) * m + pair_cols)] = data
+
+        similarities = np.zeros(rows.shape[0])
+        similarities[valid] = junction_similarities[pair_inverse]
+        if self.correct and not raw:
+            return apply_correction(
+                similarities, rows, cols, [x.mut for x in records],
+                self.correct_by)
+        return np.maximum(similarities, 0)
+
 
 def is_similarity(estimator):
     """Returns True if the given estimator encode a distance."""
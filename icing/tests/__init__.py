@@ -0,0 +1,104 @@
+"""Tests for icing.
+
+Run them with ``python -m unittest discover -s icing/tests -t .``.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import csv
+import numpy as np
+import os
+import shutil
+import tempfile
+
+from icing.externals import IgRecord
+from icing.utils import io
+
+V_GENES = ('IGHV3-23*01', 'IGHV4-34*01', 'IGHV1-69*01', 'IGHV3-30*01')
+J_GENES = ('IGHJ4*02', 'IGHJ6*02', 'IGHJ3*01')
+
+
+def _make_rows(n_clones=12, max_clone_size=8, random_state=0):
+    """Generate a small synthetic repertoire, as database rows.
+
+    Each clone has a random junction, and its records carry a few point
+    mutations, some trimmed by a codon (so that junction lengths differ
+    within a clone) and some exact duplicates of the previous record, with
+    the same mutation level.
+
+    Returns
+    -------
+    rows : list of dict
+        Database rows, in order of clone.
+    clones : array
+        Clone of each row.
+    """
+    rng = np.random.RandomState(random_state)
+    records, clones = [], []
+    for clone in range(n_clones):
+        length = rng.choice(np.arange(30, 60, 3))
+        base = rng.choice(list('ACGT'), length)
+        v_gene = V_GENES[rng.randint(len(V_GENES))]
+        j_gene = J_GENES[rng.randint(len(J_GENES))]
+        for _ in range(rng.randint(1, max_clone_size + 1)):
+            if records and records[-1]['V_CALL'] == v_gene and \
+                    rng.rand() < .25:
+                records.append(dict(records[-1], SEQUENCE_ID='seq_%d' %
+                                    len(records)))
+                clones.append(clone)
+                continue
+            seq = base.copy()
+            for pos in rng.randint(0, length, rng.randint(0, 4)):
+                seq[pos] = rng.choice(list('ACGT'))
+            junction = ''.join(seq)
+            if rng.rand() < .3:
+                junction = junction[:-3]
+            records.append(dict(
+                SEQUENCE_ID='seq_%d' % len(records), V_CALL=v_gene,
+                J_CALL=j_gene, JUNCTION=junction,
+                JUNCTION_LENGTH=str(len(junction)),
+                MUT='%.2f' % rng.uniform(0, 15)))
+            clones.append(clone)
+    return records, np.array(clones)
+
+
+def make_records(n_clones=12, max_clone_size=8, random_state=0):
+    """Generate a small synthetic repertoire.
+
+    See `_make_rows` for the parameters.
+
+    Returns
+    -------
+    records : list of IgRecord
+        Records, in order of clone.
+    clones : array
+        Clone of each record.
+    """
+    rows, clones = _make_rows(n_clones, max_clone_size, random_state)
+    return [IgRecord(x) for x in rows], clones
+
+
+def make_dataframe(n_clones=12, max_clone_size=8, random_state=0):
+    """Generate a small synthetic repertoire, as a dataframe.
+
+    See `_make_rows` for the parameters.
+
+    Returns
+    -------
+    df : pandas.DataFrame
+        Records, as loaded by `icing.utils.io.load_dataframe`.
+    clones : array
+        Clone of each record.
+    """
+    rows, clones = _make_rows(n_clones, max_clone_size, random_state)
+    tmp = tempfile.mkdtemp()
+    try:
+        db_file = os.path.join(tmp, 'db.tab')
+        with open(db_file, 'w') as f:
+            writer = csv.DictWriter(f, sorted(rows[0]), dialect='excel-tab')
+            writer.writeheader()
+            writer.writerows(rows)
+        return io.load_dataframe(db_file), clones
+    finally:
+        shutil.rmtree(tmp)
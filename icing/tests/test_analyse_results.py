@@ -0,0 +1,79 @@
+"""Tests for icing.core.analyse_results.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import unittest
+import numpy as np
+
+from scipy import sparse
+from scipy.cluster import hierarchy
+from scipy.spatial.distance import squareform
+
+from icing.core.analyse_results import sparse_linkage
+
+
+def _similarity_matrix(sizes, high=1., random_state=0):
+    """Block diagonal similarity matrix, one dense block per component."""
+    rng = np.random.RandomState(random_state)
+    blocks = []
+    for size in sizes:
+        block = rng.uniform(.05, high, (size, size))
+        block = (block + block.T) / 2.
+        np.fill_diagonal(block, 1)
+        blocks.append(block)
+    return sparse.block_diag(blocks, format='csr')
+
+
+class TestSparseLinkage(unittest.TestCase):
+
+    def test_dense_component(self):
+        sm = _similarity_matrix([12])
+        distances = 1. - sm.toarray()
+        np.fill_diagonal(distances, 0)
+        for method in ('single', 'complete', 'average'):
+            expected = hierarchy.linkage(squareform(distances), method=method)
+            Z = sparse_linkage(sm, method=method)
+            self.assertTrue(hierarchy.is_valid_linkage(Z))
+            np.testing.assert_allclose(Z[:, 2], expected[:, 2])
+            np.testing.assert_allclose(
+                hierarchy.cophenet(Z), hierarchy.cophenet(expected))
+
+    def test_components(self):
+        sm = _similarity_matrix([6, 1, 9, 4])
+        labels = np.repeat(np.arange(4), [6, 1, 9, 4])
+        for method in ('single', 'complete', 'weighted'):
+            Z = sparse_linkage(sm, method=method)
+            self.assertTrue(hierarchy.is_valid_linkage(Z))
+            self.assertTrue(hierarchy.is_monotonic(Z))
+            clusters = hierarchy.fcluster(Z, .999, criterion='distance')
+            self.assertEqual(len(np.unique(clusters)), 4)
+            for label in range(4):
+                self.assertEqual(len(np.unique(clusters[labels == label])), 1)
+
+    def test_ward(self):
+        # ward merges components higher than 1, which is where they are joined
+        sm = _similarity_matrix([6, 9, 4], high=.3)
+        Z = sparse_linkage(sm, method='ward')
+        self.assertTrue(np.any(Z[:, 2] > 1))
+        self.assertTrue(hierarchy.is_valid_linkage(Z))
+        self.assertEqual(Z[-1, 3], sm.shape[0])
+
+    def test_minimum_spanning_tree(self):
+        sm = _similarity_matrix([15, 10])
+        Z_dense = sparse_linkage(sm, method='single')
+        Z_tree = sparse_linkage(sm, method='single', max_dense_size=5)
+        self.assertTrue(hierarchy.is_valid_linkage(Z_tree))
+        np.testing.assert_allclose(Z_tree[:, 2], Z_dense[:, 2])
+        np.testing.assert_allclose(
+            hierarchy.cophenet(Z_tree), hierarchy.cophenet(Z_dense))
+
+    def test_not_monotonic(self):
+        sm = _similarity_matrix([5])
+        for method in ('centroid', 'median'):
+            self.assertRaises(ValueError, sparse_linkage, sm, method=method)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+"""Tests for icing.core.checkpoint.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from icing import similarity_
+from icing.core.checkpoint import ShardStore, params_digest, shard_pairs
+from icing.similarity_ import IgSimilarity, StringSimilarity
+from icing.similarity_ import compute_similarity_matrix
+from icing.tests import make_records
+
+
+class TestShardPairs(unittest.TestCase):
+
+    def test_shard_pairs(self):
+        rng = np.random.RandomState(0)
+        lengths = rng.randint(30, 40, 50)
+        rows, cols = np.triu_indices(50, 1)
+        shards = shard_pairs(lengths, rows, cols, shard_size=40)
+        positions = np.concatenate(shards)
+        np.testing.assert_array_equal(np.sort(positions),
+                                      np.arange(rows.shape[0]))
+        keys = np.minimum(lengths[rows], lengths[cols])
+        for shard in shards:
+            self.assertTrue(0 < shard.shape[0] <= 40)
+            self.assertEqual(len(np.unique(keys[shard])), 1)
+
+        # the order of the pairs does not change the shards
+        order = rng.permutation(rows.shape[0])
+        shuffled = shard_pairs(lengths, rows[order], cols[order], 40)
+        self.assertEqual(len(shuffled), len(shards))
+        for a, b in zip(shards, shuffled):
+            np.testing.assert_array_equal(order[b], a)
+
+        self.assertRaises(ValueError, shard_pairs, lengths, rows, cols, 0)
+
+    def test_params_digest(self):
+        sim = IgSimilarity(StringSimilarity(model='ham'))
+        self.assertEqual(params_digest(sim, np.arange(3)),
+                         params_digest(sim, np.arange(3)))
+        self.assertNotEqual(params_digest(sim, np.arange(3)),
+                            params_digest(sim.set_params(tol=6),
+                                          np.arange(3)))
+        self.assertNotEqual(params_digest(sim, np.arange(3)),
+                            params_digest(sim, np.arange(4)))
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.records, _ = make_records(random_state=0)
+        self.igsimilarity = IgSimilarity(
+            StringSimilarity(model='ham'), correct=True,
+            correct_by=np.poly1d([-1e-3, -0.02, 1.05]))
+        self.expected = compute_similarity_matrix(
+            self.records, igsimilarity=self.igsimilarity).toarray()
+
+        # count the shards which are computed
+        self.n_computed = 0
+        self._batch_similarities = similarity_._batch_similarities
+
+        def _counted(*args, **kwargs):
+            self.n_computed += 1
+            return self._batch_similarities(*args, **kwargs)
+        similarity_._batch_similarities = _counted
+
+    def tearDown(self):
+        similarity_._batch_similarities = self._batch_similarities
+        shutil.rmtree(self.work_dir)
+
+    def _compute(self, igsimilarity=None):
+        self.n_computed = 0
+        return compute_similarity_matrix(
+            self.records, igsimilarity=igsimilarity or self.igsimilarity,
+            work_dir=self.work_dir, shard_size=20).toarray()
+
+    def _shards(self):
+        return sorted(glob.glob(os.path.join(self.work_dir, 'shard_*.npz')))
+
+    def test_resume(self):
+        np.testing.assert_array_equal(self._compute(), self.expected)
+        shards = self._shards()
+        self.assertTrue(len(shards) > 2)
+        self.assertEqual(self.n_computed, len(shards))
+
+        # nothing to do on a complete run
+        np.testing.assert_array_equal(self._compute(), self.expected)
+        self.assertEqual(self.n_computed, 0)
+
+        # an interrupted run leaves some shards and temporary files
+        for path in shards[::2]:
+            os.remove(path)
+        open(os.path.join(self.work_dir, 'shard_000001.npz.tmp'), 'w').close()
+        np.testing.assert_array_equal(self._compute(), self.expected)
+        self.assertEqual(self.n_computed, len(shards[::2]))
+        self.assertEqual(self._shards(), shards)
+        self.assertEqual(
+            glob.glob(os.path.join(self.work_dir, '*.tmp')), [])
+
+    def test_invalidation(self):
+        self._compute()
+
+        # a new correction reuses the raw similarities
+        correct_by = np.poly1d([-0.03, 1.])
+        expected = compute_similarity_matrix(
+            self.records, igsimilarity=IgSimilarity(
+                StringSimilarity(model='ham'), correct=True,
+                correct_by=correct_by)).toarray()
+        result = self._compute(self.igsimilarity.set_params(
+            correct_by=correct_by))
+        np.testing.assert_array_equal(result, expected)
+        self.assertEqual(self.n_computed, 0)
+
+        # other parameters discard them
+        igsimilarity = IgSimilarity(
+            StringSimilarity(model='hs1f'), correct=False)
+        expected = compute_similarity_matrix(
+            self.records, igsimilarity=igsimilarity).toarray()
+        np.testing.assert_array_equal(self._compute(igsimilarity), expected)
+        self.assertEqual(self.n_computed, len(self._shards()))
+
+        # as does a corrupted manifest
+        with open(os.path.join(self.work_dir, 'manifest.json'), 'w') as f:
+            f.write('{')
+        self._compute(igsimilarity)
+        self.assertEqual(self.n_computed, len(self._shards()))
+
+    def test_store(self):
+        store = ShardStore(self.work_dir, 'digest', 3)
+        store.save(1, np.array([.5]), np.array([0]), np.array([2]))
+        self.assertEqual(ShardStore(self.work_dir, 'digest', 3).completed(),
+                         [1])
+        data, rows, cols = store.load(1)
+        np.testing.assert_array_equal(data, [.5])
+        self.assertEqual(ShardStore(self.work_dir, 'other', 3).completed(),
+                         [])
+
+
+if __name__ == '__main__':
+    unittest.main()
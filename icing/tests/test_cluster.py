@@ -0,0 +1,111 @@
+"""Tests for icing.core.cluster.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import unittest
+import numpy as np
+
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+from icing.core.cluster import louvain, threshold_clustering
+from icing.core.graphclustering import union_find
+
+
+def _first_occurrence(labels):
+    """Number the clusters by their first sample."""
+    _, first, inverse = np.unique(labels, return_index=True,
+                                  return_inverse=True)
+    return np.argsort(np.argsort(first))[inverse]
+
+
+def _modularity(graph, labels, resolution=1.):
+    """Modularity of a partition of a symmetric graph."""
+    graph = sparse.csr_matrix(graph)
+    degrees = np.asarray(graph.sum(axis=1)).ravel()
+    total = degrees.sum()
+    coo = graph.tocoo()
+    inside = coo.data[labels[coo.row] == labels[coo.col]].sum()
+    community_degrees = np.bincount(labels, weights=degrees)
+    return inside / total - resolution * np.sum(
+        (community_degrees / total) ** 2)
+
+
+def _ring_of_cliques(n_cliques, clique_size):
+    """Cliques of unit similarity, each joined to the next by one edge."""
+    n = n_cliques * clique_size
+    graph = np.zeros((n, n))
+    for k in range(n_cliques):
+        start = k * clique_size
+        graph[start:start + clique_size, start:start + clique_size] = 1
+        last, first = start + clique_size - 1, (start + clique_size) % n
+        graph[last, first] = graph[first, last] = 1
+    np.fill_diagonal(graph, 0)
+    return sparse.csr_matrix(graph), np.repeat(np.arange(n_cliques),
+                                               clique_size)
+
+
+class TestThresholdClustering(unittest.TestCase):
+
+    def test_connected_components(self):
+        rng = np.random.RandomState(0)
+        n = 300
+        similarity_matrix = sparse.random(
+            n, n, density=.01, random_state=rng, format='csr')
+        for threshold in (.01, .05, .2, .5):
+            labels = threshold_clustering(similarity_matrix, threshold)
+            graph = similarity_matrix.copy()
+            graph.data = (graph.data >= 1 - threshold).astype(float)
+            graph.eliminate_zeros()
+            _, expected = connected_components(graph, directed=False)
+            np.testing.assert_array_equal(
+                _first_occurrence(labels), _first_occurrence(expected))
+
+    def test_union_find(self):
+        labels = union_find(np.array([4, 1, 5], dtype=np.int32),
+                            np.array([2, 3, 4], dtype=np.int32), 7)
+        np.testing.assert_array_equal(labels, [0, 1, 2, 1, 2, 2, 3])
+        np.testing.assert_array_equal(
+            union_find(np.empty(0, dtype=np.int32),
+                       np.empty(0, dtype=np.int32), 3), [0, 1, 2])
+
+
+class TestLouvain(unittest.TestCase):
+
+    def test_ring_of_cliques(self):
+        graph, cliques = _ring_of_cliques(6, 5)
+        labels = louvain(graph, random_state=0)
+        np.testing.assert_array_equal(
+            _first_occurrence(labels), _first_occurrence(cliques))
+        self.assertAlmostEqual(_modularity(graph, labels),
+                               _modularity(graph, cliques))
+        self.assertTrue(_modularity(graph, labels) >
+                        _modularity(graph, np.zeros_like(labels)))
+
+    def test_triangular(self):
+        graph, cliques = _ring_of_cliques(4, 6)
+        labels = louvain(sparse.triu(graph), random_state=0)
+        np.testing.assert_array_equal(
+            _first_occurrence(labels), _first_occurrence(cliques))
+
+    def test_sample_weight(self):
+        # a sample with weight w is equivalent to w identical samples
+        graph = _ring_of_cliques(5, 4)[0].toarray()
+        weights = np.ones(graph.shape[0], dtype=int)
+        weights[[0, 7, 13]] = 3
+        repeated = np.repeat(np.arange(graph.shape[0]), weights)
+        expanded = graph[repeated][:, repeated]
+        expanded[repeated[:, None] == repeated[None, :]] = 1
+        np.fill_diagonal(expanded, 0)
+
+        labels = louvain(sparse.csr_matrix(graph), random_state=0,
+                         sample_weight=weights)
+        expected = louvain(sparse.csr_matrix(expanded), random_state=0)
+        np.testing.assert_array_equal(
+            _first_occurrence(labels[repeated]), _first_occurrence(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
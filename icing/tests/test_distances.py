@@ -0,0 +1,222 @@
+"""Tests for icing.core.distances.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import math
+import pickle
+import unittest
+import numpy as np
+
+from icing.core.distances import DataFrameDistance, StringDistance
+from icing.core.distances import apply_correction, distance_dataframe
+from icing.core.distances import block_weights, char_distance_table
+from icing.core.junctiondistance import weighted_mismatches
+from icing.similarity_ import IgSimilarity, StringSimilarity
+from icing.similarity_ import compute_similarity_matrix
+from icing.tests import make_dataframe, make_records
+from icing.tests.test_similarity import _per_pair_matrix
+
+
+def _all_pairs(n):
+    rows, cols = np.triu_indices(n, 1)
+    return rows, cols
+
+
+class TestStringDistancePairs(unittest.TestCase):
+
+    def setUp(self):
+        records, _ = make_records(n_clones=15, random_state=1)
+        self.strings = np.array([x.junc for x in records], dtype=object)
+        self.rows, self.cols = _all_pairs(len(self.strings))
+
+    def _check(self, model, max_distance=None):
+        distance = StringDistance(model=model, max_distance=max_distance)
+        expected = np.array([
+            distance.pairwise(self.strings[i], self.strings[j])
+            for i, j in zip(self.rows, self.cols)])
+        result = distance.batch_pairwise(self.strings, self.rows, self.cols)
+        np.testing.assert_array_equal(result, expected)
+
+    def test_exact_weights(self):
+        self.assertIsNotNone(block_weights(StringDistance('ham').dist_mat))
+        self._check('ham')
+        self._check('ham', max_distance=.2)
+
+    def test_inexact_weights(self):
+        # 'hs1f' is computed one pair at a time
+        self.assertIsNone(block_weights(StringDistance('hs1f').dist_mat))
+        self._check('hs1f')
+        self._check('hs1f', max_distance=.2)
+
+
+class TestBlockSimilarities(unittest.TestCase):
+
+    def setUp(self):
+        self.records, _ = make_records(n_clones=20, random_state=0)
+
+    def _check(self, model, min_similarity):
+        expected = _per_pair_matrix(self.records, IgSimilarity(
+            StringSimilarity(model=model), correct=False, cache_size=0))
+        expected[expected < min_similarity] = 0
+        result = compute_similarity_matrix(
+            self.records, igsimilarity=IgSimilarity(
+                StringSimilarity(model=model), correct=False),
+            min_similarity=min_similarity).toarray()
+        np.testing.assert_array_equal(result, expected)
+
+    def test_ham(self):
+        self._check('ham', 0.)
+        self._check('ham', .7)
+
+    def test_hs1f(self):
+        self._check('hs1f', 0.)
+        self._check('hs1f', .7)
+
+
+class TestEarlyAbandon(unittest.TestCase):
+
+    def setUp(self):
+        records, _ = make_records(n_clones=10, random_state=4)
+        self.strings = np.array([x.junc for x in records], dtype=object)
+        self.rows, self.cols = _all_pairs(len(self.strings))
+
+    def test_weighted_mismatches(self):
+        for model in ('ham', 'hs1f'):
+            dist_mat = StringDistance(model=model).dist_mat
+            lookup, table, _ = char_distance_table(dist_mat)
+            for i, j in zip(self.rows, self.cols):
+                x1, x2 = self.strings[i], self.strings[j]
+                expected = 0.
+                for a, b in zip(x1, x2):
+                    expected += table[lookup[ord(a)], lookup[ord(b)]]
+                self.assertEqual(
+                    weighted_mismatches(x1, x2, lookup, table), expected)
+
+                # the partial sum is returned as soon as it exceeds max_sum
+                max_sum = expected / 2.
+                partial = weighted_mismatches(x1, x2, lookup, table, max_sum)
+                if expected > 0:
+                    self.assertTrue(max_sum < partial <= expected)
+
+    def test_unknown_character(self):
+        lookup, table, _ = char_distance_table(StringDistance().dist_mat)
+        self.assertRaises(ValueError, weighted_mismatches, 'ACGT', 'ACG#',
+                          lookup, table)
+
+    def test_max_distance(self):
+        for model in ('ham', 'hs1f'):
+            distance = StringDistance(model=model)
+            expected = np.array([
+                distance.pairwise(self.strings[i], self.strings[j])
+                for i, j in zip(self.rows, self.cols)])
+            for max_distance in (.05, .2, .5):
+                cutoff = StringDistance(model=model,
+                                        max_distance=max_distance)
+                result = np.array([
+                    cutoff.pairwise(self.strings[i], self.strings[j])
+                    for i, j in zip(self.rows, self.cols)])
+                within = expected <= max_distance
+                self.assertTrue(np.any(within) and not np.all(within))
+                np.testing.assert_array_equal(
+                    result[within], expected[within])
+                np.testing.assert_array_equal(result[~within], 1.)
+
+
+class TestDataFrameDistance(unittest.TestCase):
+
+    def setUp(self):
+        self.df, _ = make_dataframe(n_clones=10, random_state=5)
+        self.n = self.df.shape[0]
+
+    def _params(self):
+        for rm_duplicates in (False, True):
+            for correct in (False, True):
+                for model in ('ham', 'hs1f'):
+                    yield dict(rm_duplicates=rm_duplicates, correct=correct,
+                               junction_dist=StringDistance(model=model))
+
+    def _dense(self, metric):
+        return np.array([[metric([i], [j]) if i != j else 0
+                          for j in range(self.n)] for i in range(self.n)])
+
+    def test_distance_dataframe(self):
+        for params in self._params():
+            metric = DataFrameDistance(self.df, **params)
+            expected = np.array([[distance_dataframe(self.df, [i], [j],
+                                                     **params)
+                                  for j in range(self.n)]
+                                 for i in range(self.n)])
+            np.fill_diagonal(expected, 0)
+            np.testing.assert_array_equal(self._dense(metric), expected)
+
+    def test_graph(self):
+        idxs = np.arange(0, self.n, 2)
+        for params in self._params():
+            metric = DataFrameDistance(self.df, **params)
+            expected = self._dense(metric)[idxs][:, idxs]
+            for max_distance in (1., .3):
+                graph = metric.graph(idxs, max_distance=max_distance)
+                result = np.ones(graph.shape)
+                coo = graph.tocoo()
+                result[coo.row, coo.col] = coo.data
+                np.fill_diagonal(result, 0)
+                within = expected < max_distance
+                np.testing.assert_allclose(result[within], expected[within],
+                                           rtol=1e-12)
+                np.testing.assert_array_equal(result[~within], 1)
+
+    def test_pickle(self):
+        metric = DataFrameDistance(
+            self.df, junction_dist=StringDistance(model='ham'))
+        unpickled = pickle.loads(pickle.dumps(metric))
+        np.testing.assert_array_equal(self._dense(unpickled),
+                                      self._dense(metric))
+
+
+def _scalar_correction(x):
+    """Correction which only accepts scalars."""
+    return 1 - math.sqrt(x) / 5.
+
+
+class TestApplyCorrection(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        n = 30
+        self.mut = rng.uniform(0, 30, n).round(1)
+        self.rows, self.cols = _all_pairs(n)
+        self.values = rng.uniform(-.2, 1, self.rows.shape[0])
+
+    def _check(self, correct_by, combine):
+        expected = np.zeros(self.values.shape[0])
+        for k, (i, j) in enumerate(zip(self.rows, self.cols)):
+            if self.values[k] <= 0:
+                continue
+            level = max(self.mut[i], self.mut[j]) if combine == 'max' else \
+                (self.mut[i] + self.mut[j]) / 2.
+            expected[k] = self.values[k] * min(max(
+                float(correct_by(level)), 0), 1)
+        values = self.values.copy()
+        result = apply_correction(values, self.rows, self.cols, self.mut,
+                                  correct_by, combine=combine)
+        np.testing.assert_array_equal(values, self.values)
+        np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+    def test_poly1d(self):
+        for combine in ('mean', 'max'):
+            self._check(np.poly1d([-1e-3, -0.01, 1.1]), combine)
+
+    def test_scalar_function(self):
+        for combine in ('mean', 'max'):
+            self._check(_scalar_correction, combine)
+
+    def test_combine(self):
+        self.assertRaises(ValueError, apply_correction, self.values,
+                          self.rows, self.cols, self.mut, _scalar_correction,
+                          combine='min')
+
+
+if __name__ == '__main__':
+    unittest.main()
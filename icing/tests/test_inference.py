@@ -0,0 +1,219 @@
+"""Tests for icing.inference.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import unittest
+import numpy as np
+
+from sklearn.cluster import DBSCAN
+from sklearn.metrics import adjusted_rand_score
+
+from icing.core.distances import DataFrameDistance, StringDistance
+from icing.externals import IgRecord
+from icing.inference import DefineClones, ICINGTwoStep, _cluster_block
+from icing.inference import _collapse_duplicates, _length_blocks
+from icing.inference import _merge_blocks
+from icing.similarity_ import IgSimilarity, StringSimilarity
+from icing.tests import make_dataframe, make_records
+
+
+class TestCollapseDuplicates(unittest.TestCase):
+
+    def setUp(self):
+        self.records, _ = make_records(random_state=1)
+        unique_idx, _, _ = _collapse_duplicates(self.records)
+        # the data must contain duplicates
+        assert unique_idx.shape[0] < len(self.records)
+
+    def _labels(self, cluster, collapse_duplicates, threshold=.2):
+        igsimilarity = IgSimilarity(StringSimilarity(model='ham'),
+                                    correct=False)
+        clones = DefineClones(
+            cluster=cluster, igsimilarity=igsimilarity, threshold=threshold,
+            collapse_duplicates=collapse_duplicates).fit(self.records)
+        return np.array([clones.clone_dict_[x.id] for x in self.records])
+
+    def test_default(self):
+        self.assertFalse(DefineClones().collapse_duplicates)
+
+    def test_dbscan(self):
+        self.assertEqual(adjusted_rand_score(
+            self._labels('dbscan', False), self._labels('dbscan', True)), 1)
+
+    def test_hc(self):
+        self.assertEqual(adjusted_rand_score(
+            self._labels('hc', False), self._labels('hc', True)), 1)
+
+    def test_mutation_correction(self):
+        # duplicates whose similarity is lowered by the correction are not
+        # collapsed
+        igsimilarity = IgSimilarity(
+            StringSimilarity(model='ham'), correct=True,
+            correct_by=lambda mut: 1 - mut / 100.)
+        assert all(x.mut > 0 for x in self.records)
+        unique_idx, _, _ = _collapse_duplicates(self.records, igsimilarity)
+        self.assertEqual(unique_idx.shape[0], len(self.records))
+
+
+def _record(name, junction, v_gene='IGHV3-23*01'):
+    return IgRecord(dict(
+        SEQUENCE_ID=name, V_CALL=v_gene, J_CALL='IGHJ4*02', JUNCTION=junction,
+        JUNCTION_LENGTH=str(len(junction)), MUT='0'))
+
+
+class TestPartialFit(unittest.TestCase):
+
+    def setUp(self):
+        self.records, _ = make_records(random_state=3)
+
+    def _estimator(self):
+        return DefineClones(
+            cluster='threshold', threshold=.3, igsimilarity=IgSimilarity(
+                StringSimilarity(model='ham'), correct=False))
+
+    def test_partial_fit(self):
+        records = np.array(self.records, dtype=object)
+        order = np.random.RandomState(0).permutation(len(records))
+        first, second = order[:len(order) // 2], order[len(order) // 2:]
+        expected = self._estimator().fit(self.records)
+        estimator = self._estimator().fit(list(records[first]))
+        estimator.partial_fit(list(records[second]))
+
+        ids = [x.id for x in self.records]
+        labels = [estimator.clone_dict_[x] for x in ids]
+        self.assertEqual(adjusted_rand_score(
+            [expected.clone_dict_[x] for x in ids], labels), 1)
+        self.assertEqual(
+            sorted(sum(estimator.clone_members_.values(), [])), sorted(ids))
+
+    def test_merge(self):
+        junction = 'ACGT' * 10 + 'AC'
+        first = _record('first', 'TTTTTT' + junction[6:])
+        second = _record('second', junction[:-6] + 'CCCCCC')
+        other = _record('other', 'G' * 42, v_gene='IGHV1-69*01')
+        estimator = self._estimator().set_params(threshold=.2).fit(
+            [first, second, other])
+        self.assertEqual(len(estimator.clone_members_), 3)
+
+        estimator.partial_fit([_record('bridge', junction)])
+        labels = estimator.clone_dict_
+        self.assertEqual(labels['first'], labels['second'])
+        self.assertEqual(labels['first'], labels['bridge'])
+        self.assertNotEqual(labels['first'], labels['other'])
+        self.assertEqual(len(estimator.clone_members_), 2)
+        for label, members in estimator.clone_members_.items():
+            self.assertTrue(all(labels[x] == label for x in members))
+        self.assertEqual(
+            set(estimator.representatives_labels_),
+            set(estimator.clone_members_))
+
+    def test_generator(self):
+        half = len(self.records) // 2
+        expected = self._estimator().fit(self.records[:half])
+        expected.partial_fit(self.records[half:])
+        estimator = self._estimator().fit(self.records[:half])
+        estimator.partial_fit(x for x in self.records[half:])
+        self.assertEqual(estimator.clone_dict_, expected.clone_dict_)
+        np.testing.assert_array_equal(
+            estimator.predict(iter(self.records)),
+            expected.predict(self.records))
+
+    def test_no_similarity(self):
+        estimator = self._estimator().fit(self.records)
+        estimator.set_params(igsimilarity=None)
+        self.assertRaises(ValueError, estimator.predict, self.records[:1])
+        self.assertRaises(ValueError, estimator.partial_fit,
+                          self.records[:1])
+
+
+class TestICINGTwoStep(unittest.TestCase):
+
+    def setUp(self):
+        self.df, _ = make_dataframe(random_state=2)
+        self.distance_params = dict(
+            junction_dist=StringDistance(), correct=False, tol=3)
+
+    def _fit(self, **params):
+        return ICINGTwoStep(
+            eps=.1, model='nt', distance_params=self.distance_params,
+            n_jobs=1, **params).fit_predict(self.df)
+
+    def test_precomputed_graph(self):
+        # DBSCAN on the sparse graph, with noise records, gives the clones of
+        # the callable metric
+        dbscan_params = dict(min_samples=4, n_jobs=1)
+        metric = DataFrameDistance(self.df, **self.distance_params)
+        expected = self._fit(dbscan_params=dict(
+            dbscan_params, algorithm='brute', metric=metric))
+        labels = self._fit(dbscan_params=dict(
+            dbscan_params, metric='precomputed'))
+        self.assertEqual(adjusted_rand_score(expected, labels), 1)
+
+    def test_noise_radius(self):
+        metric = DataFrameDistance(self.df, **self.distance_params)
+        idxs = np.arange(self.df.shape[0])
+        dbscan = DBSCAN(eps=.1, min_samples=4, metric='precomputed')
+        noise = dbscan.fit_predict(metric.graph(
+            idxs, max_distance=np.nextafter(.1, 1))) == -1
+        # the data must contain noise records
+        assert noise.any()
+        labels, _ = _cluster_block(dbscan, metric, idxs, None, True)
+        self.assertTrue(np.all(labels >= 0))
+
+        # noise records have no core record within eps, so each forms its
+        # own cluster
+        labels, _ = _cluster_block(
+            dbscan, metric, idxs, None, True, noise_radius=.1)
+        self.assertEqual(np.unique(labels[noise]).shape[0], noise.sum())
+        self.assertFalse(np.in1d(labels[noise], labels[~noise]).any())
+
+
+class TestLengthBlocks(unittest.TestCase):
+
+    def test_length_blocks(self):
+        rng = np.random.RandomState(0)
+        lengths = rng.choice(np.arange(30, 60, 3), 200)
+        lengths[:40] = 45
+        for max_block_size in (10, 50, 1000):
+            blocks = _length_blocks(lengths, max_block_size, overlap=3)
+            owners = np.zeros(lengths.shape[0], dtype=int)
+            for members, owned in blocks:
+                owners[members[owned]] += 1
+                own_lengths = np.unique(lengths[members[owned]])
+                # a length is never split, other blocks are not too large
+                self.assertTrue(owned.sum() <= max_block_size or
+                                own_lengths.shape[0] == 1)
+                # all the records within the overlap are in the block
+                near = np.abs(lengths[:, None] - own_lengths).min(axis=1) <= 3
+                np.testing.assert_array_equal(
+                    np.sort(members), np.flatnonzero(near))
+            np.testing.assert_array_equal(owners, 1)
+        self.assertEqual(len(_length_blocks(lengths, 1000)), 1)
+
+    def test_merge_blocks(self):
+        # record 2 is core in both blocks, record 4 only in the second one
+        blocks = [(np.array([0, 1, 2, 3]), np.array([1, 1, 0, 0], bool)),
+                  (np.array([2, 3, 4, 5]), np.array([1, 1, 1, 1], bool))]
+        results = [(np.array([0, 0, 0, 1]), np.array([1, 0, 1, 0], bool)),
+                   (np.array([0, 1, 0, 1]), np.array([1, 0, 1, 1], bool))]
+        labels = _merge_blocks(blocks, results, 6)
+        np.testing.assert_array_equal(labels, [0, 0, 0, 1, 0, 1])
+
+    def test_fit_blocks(self):
+        df, _ = make_dataframe(n_clones=25, random_state=1)
+        params = dict(
+            eps=.1, model='nt', n_jobs=1, distance_params=dict(
+                junction_dist=StringDistance(), correct=False, tol=3),
+            dbscan_params=dict(min_samples=3, metric='precomputed'))
+        expected = ICINGTwoStep(max_block_size=10000, **params).fit_predict(df)
+        labels = ICINGTwoStep(max_block_size=15, **params).fit_predict(df)
+        self.assertTrue(np.all(labels >= 0))
+        np.testing.assert_array_equal(np.unique(labels),
+                                      np.arange(labels.max() + 1))
+        self.assertTrue(adjusted_rand_score(expected, labels) > .9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""Tests for icing.core.metric_tree.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import unittest
+import numpy as np
+
+from icing.core.distances import StringDistance
+from icing.core.metric_tree import JunctionIndex, VPTree
+from icing.core.parallel_distance import candidate_pairs
+from icing.tests import make_records
+
+
+class TestVPTree(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        base = rng.choice(list('ACGT'), 30)
+        strings = []
+        for _ in range(300):
+            seq = base.copy()
+            pos = rng.randint(0, 30, rng.randint(0, 12))
+            seq[pos] = rng.choice(list('ACGT'), pos.shape[0])
+            strings.append(''.join(seq))
+        self.strings = np.array(strings, dtype=object)
+        self.distance = StringDistance(model='ham')
+
+    def test_query_radius(self):
+        tree = VPTree(self.strings, self.distance, leaf_size=8,
+                      random_state=0)
+        for query in self.strings[:20]:
+            expected = np.array([self.distance.pairwise(query, x)
+                                 for x in self.strings])
+            for radius in (0., .1, .2):
+                idx, distances, n_evaluations = tree.query_radius(
+                    query, radius)
+                order = np.argsort(idx)
+                np.testing.assert_array_equal(
+                    idx[order], np.flatnonzero(expected <= radius))
+                np.testing.assert_array_equal(distances[order],
+                                              expected[idx[order]])
+                if radius == 0:
+                    self.assertTrue(n_evaluations < self.strings.shape[0])
+
+            idx, _, _ = tree.query_radius(query, .2, start=150)
+            np.testing.assert_array_equal(
+                np.sort(idx), 150 + np.flatnonzero(expected[150:] <= .2))
+
+
+class TestJunctionIndex(unittest.TestCase):
+
+    def setUp(self):
+        records, _ = make_records(n_clones=20, random_state=6)
+        self.junctions = np.array([x.junc for x in records], dtype=object)
+        self.v_genes = [x.setV for x in records]
+        self.distance = StringDistance(model='ham')
+
+    def _expected(self, radius):
+        lengths = np.array([len(x) for x in self.junctions])
+        rows, cols = candidate_pairs(self.v_genes, lengths, 3)
+        distances = np.array([self.distance.pairwise(
+            *sorted((self.junctions[i], self.junctions[j]), key=len))
+            for i, j in zip(rows, cols)])
+        keep = distances <= radius
+        return rows[keep], cols[keep], distances[keep]
+
+    def test_radius_graph(self):
+        index = JunctionIndex(self.junctions, self.v_genes, random_state=0)
+        for radius in (0., .05, .2):
+            rows, cols, distances = index.radius_graph(radius)
+            expected = self._expected(radius)
+            np.testing.assert_array_equal(rows, expected[0])
+            np.testing.assert_array_equal(cols, expected[1])
+            np.testing.assert_array_equal(distances, expected[2])
+        self.assertTrue(index.n_candidates_ > 0)
+
+    def test_query(self):
+        index = JunctionIndex(self.junctions, self.v_genes, random_state=0)
+        rows, cols, _ = self._expected(.1)
+        junction, v_genes = self.junctions[0], self.v_genes[0]
+        idx, _ = index.query(junction, v_genes, .1,
+                             lengths=[len(junction)])
+        same_length = np.array([len(x) == len(junction)
+                                for x in self.junctions])
+        expected = np.union1d(cols[rows == 0], [0])
+        np.testing.assert_array_equal(idx, expected[same_length[expected]])
+
+
+if __name__ == '__main__':
+    unittest.main()
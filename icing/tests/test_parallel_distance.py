@@ -0,0 +1,208 @@
+"""Tests for icing.core.parallel_distance.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import os
+import unittest
+import numpy as np
+
+from icing.core.distances import StringDistance
+from icing.core.parallel_distance import candidate_pairs, cost_chunks
+from icing.core.parallel_distance import dm_dense_intra_padding
+from icing.core.parallel_distance import dnearest_intra_padding
+from icing.core.parallel_distance import hamming_candidate_pairs, sm_sparse
+from icing.core.parallel_distance import minhash_candidate_pairs, schedule
+from icing.similarity_ import IgSimilarity, StringSimilarity
+from icing.similarity_ import compute_similarity_matrix
+from icing.tests import make_records
+
+
+def _distance(x, y):
+    """Asymmetric distance, so that swapped pairs are detected."""
+    return abs(x - y) + .5 * (x < y)
+
+
+def _similarity(x, y):
+    return 1. / (1 + _distance(x, y))
+
+
+def _failing(start, end):
+    if start > 0:
+        raise ValueError("chunk %d" % start)
+    return start
+
+
+def _dying(start, end):
+    if start > 0:
+        os._exit(3)
+    return start
+
+
+class TestSchedule(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.X = rng.permutation(60).astype(float)
+
+    def test_cost_chunks(self):
+        costs = np.random.RandomState(1).rand(100)
+        order, chunks = cost_chunks(costs, 8)
+        self.assertTrue(np.all(np.diff(costs[order]) <= 0))
+        covered = np.concatenate([order[a:b] for a, b in chunks])
+        np.testing.assert_array_equal(np.sort(covered), np.arange(100))
+
+    def test_schedule(self):
+        chunks = [(i, i + 1) for i in range(20)]
+        outputs, stats = schedule(lambda start, end: start, chunks, 4)
+        self.assertEqual(sorted(outputs), list(range(20)))
+        self.assertEqual(sum(x['n_chunks'] for x in stats), 20)
+
+        # errors in the workers are raised instead of hanging
+        self.assertRaises(ValueError, schedule, _failing, chunks, 4, .1)
+        self.assertRaises(RuntimeError, schedule, _dying, chunks, 4, .1)
+
+    def test_dnearest_intra_padding(self):
+        n = self.X.shape[0]
+        expected = [min(_distance(self.X[i], self.X[j])
+                        for j in range(n) if j != i) for i in range(n)]
+        result = dnearest_intra_padding(self.X, _distance)
+        np.testing.assert_array_equal(np.array(result), expected)
+
+    def test_dm_dense_intra_padding(self):
+        n = self.X.shape[0]
+        expected = np.zeros((n, n))
+        for i in range(n):
+            for j in range(i + 1, n):
+                expected[i, j] = expected[j, i] = _distance(
+                    self.X[i], self.X[j])
+        result = dm_dense_intra_padding(self.X, _distance)
+        np.testing.assert_array_equal(result, expected)
+
+    def test_sm_sparse(self):
+        rng = np.random.RandomState(2)
+        n = self.X.shape[0]
+        rows, cols = np.nonzero(rng.rand(n, n) < .3)
+        expected = np.array([_similarity(self.X[i], self.X[j])
+                             for i, j in zip(rows, cols)])
+        keep = expected >= .1
+        # random costs shuffle the order in which pairs are computed
+        data, res_rows, res_cols = sm_sparse(
+            self.X, _similarity, tol=0, min_similarity=.1,
+            pairs=(rows, cols), costs=rng.rand(rows.shape[0]))
+        np.testing.assert_array_equal(res_rows, rows[keep])
+        np.testing.assert_array_equal(res_cols, cols[keep])
+        np.testing.assert_array_equal(data, expected[keep])
+
+
+class TestCandidatePairs(unittest.TestCase):
+
+    def setUp(self):
+        records, _ = make_records(n_clones=25, random_state=3)
+        self.v_genes = [x.setV for x in records]
+        self.junctions = np.array([x.junc for x in records], dtype=object)
+        self.lengths = np.array([x.junction_length for x in records])
+        self.distance = StringDistance(model='ham')
+
+    def _filtered_pairs(self, max_distance):
+        """Pairs of `candidate_pairs` within the distance cutoff."""
+        rows, cols = candidate_pairs(self.v_genes, self.lengths, 3)
+        keep = np.array([
+            len(self.junctions[i]) != len(self.junctions[j]) or
+            self.distance.pairwise(self.junctions[i], self.junctions[j]) <=
+            max_distance for i, j in zip(rows, cols)], dtype=bool)
+        return rows[keep], cols[keep]
+
+    def test_hamming_candidate_pairs(self):
+        for max_distance in (0., .05, .1, .3, 1.):
+            rows, cols = hamming_candidate_pairs(
+                self.v_genes, self.junctions, self.lengths, 3, max_distance,
+                self.distance.dist_mat)
+            expected = self._filtered_pairs(max_distance)
+            np.testing.assert_array_equal(rows, expected[0])
+            np.testing.assert_array_equal(cols, expected[1])
+
+    def test_wildcards(self):
+        # a junction with 'N' is compared with all the same-length ones
+        self.junctions[0] = 'N' * len(self.junctions[0])
+        rows, cols = hamming_candidate_pairs(
+            self.v_genes, self.junctions, self.lengths, 3, .1,
+            self.distance.dist_mat)
+        all_rows, all_cols = candidate_pairs(self.v_genes, self.lengths, 3)
+        np.testing.assert_array_equal(
+            rows[rows == 0], all_rows[all_rows == 0])
+        np.testing.assert_array_equal(
+            cols[rows == 0], all_cols[all_rows == 0])
+        expected = self._filtered_pairs(.1)
+        codes = set(zip(rows, cols))
+        self.assertTrue(set(zip(*expected)) <= codes)
+        self.assertTrue(codes <= set(zip(all_rows, all_cols)))
+
+    def test_not_hamming(self):
+        self.assertRaises(
+            ValueError, hamming_candidate_pairs, self.v_genes,
+            self.junctions, self.lengths, 3, .1,
+            StringDistance(model='hs1f').dist_mat)
+
+
+class TestMinHash(unittest.TestCase):
+
+    def setUp(self):
+        self.records, _ = make_records(n_clones=25, random_state=3)
+        self.v_genes = [x.setV for x in self.records]
+        self.junctions = np.array([x.junc for x in self.records],
+                                  dtype=object)
+        self.lengths = np.array([x.junction_length for x in self.records])
+
+    def _pairs(self, **kwargs):
+        return minhash_candidate_pairs(self.v_genes, self.junctions,
+                                       self.lengths, 3, **kwargs)
+
+    def test_candidate_pairs(self):
+        rows, cols = self._pairs(random_state=0)
+        all_rows, all_cols = candidate_pairs(self.v_genes, self.lengths, 3)
+        codes = set(zip(rows, cols))
+        self.assertTrue(0 < len(codes) < all_rows.shape[0])
+        self.assertTrue(codes <= set(zip(all_rows, all_cols)))
+        order = np.lexsort((cols, rows))
+        np.testing.assert_array_equal(order, np.arange(rows.shape[0]))
+
+        # identical junctions share all the bands
+        for i, j in zip(all_rows, all_cols):
+            if self.junctions[i] == self.junctions[j]:
+                self.assertTrue((i, j) in codes)
+
+        # more bands never lose pairs for the same first hash functions
+        self.assertTrue(codes <= set(zip(*self._pairs(
+            n_bands=32, random_state=0))))
+
+    def test_random_state(self):
+        expected = self._pairs(random_state=0)
+        for result in (self._pairs(random_state=0),
+                       self._pairs(random_state=np.random.RandomState(0))):
+            np.testing.assert_array_equal(result[0], expected[0])
+            np.testing.assert_array_equal(result[1], expected[1])
+
+    def test_no_shared_genes(self):
+        rows, cols = minhash_candidate_pairs(
+            [['a'], ['b'], None], ['CAR', 'CAR', 'CAR'], [3, 3, 3], 3)
+        self.assertEqual((rows.shape[0], cols.shape[0]), (0, 0))
+
+    def test_similarity_matrix(self):
+        igsimilarity = IgSimilarity(StringSimilarity(model='ham'),
+                                    correct=False)
+        expected = compute_similarity_matrix(
+            self.records, igsimilarity=igsimilarity).toarray()
+        result = compute_similarity_matrix(
+            self.records, igsimilarity=igsimilarity,
+            lsh_params=dict(random_state=0)).toarray()
+        rows, cols = self._pairs(random_state=0)
+        kept = np.zeros(expected.shape, dtype=bool)
+        kept[rows, cols] = kept[cols, rows] = True
+        np.fill_diagonal(kept, True)
+        np.testing.assert_array_equal(result, np.where(kept, expected, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
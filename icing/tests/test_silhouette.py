@@ -0,0 +1,135 @@
+"""Tests for icing.plotting.silhouette.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import unittest
+import warnings
+import numpy as np
+
+from scipy import sparse
+from scipy.cluster.hierarchy import fcluster, linkage
+from scipy.spatial.distance import squareform
+from sklearn.metrics import adjusted_rand_score, silhouette_samples
+
+from icing.plotting.silhouette import dendrogram_silhouette_sweep
+from icing.plotting.silhouette import multi_cut_dendrogram
+from icing.plotting.silhouette import sparse_silhouette_samples
+from icing.plotting.silhouette import sparse_silhouette_score
+
+
+def _similarity_matrix(n=60, random_state=0):
+    """Sparse similarities, higher inside groups of 10 samples."""
+    rng = np.random.RandomState(random_state)
+    groups = np.arange(n) // 10
+    similarity = rng.uniform(0, .6, (n, n))
+    similarity[groups[:, None] == groups[None, :]] += .4
+    similarity[rng.rand(n, n) < .5] = 0
+    similarity = np.triu(similarity, 1)
+    similarity = similarity + similarity.T
+    np.fill_diagonal(similarity, 1)
+    return sparse.csr_matrix(similarity), groups
+
+
+def _distances(similarity_matrix):
+    distances = 1. - similarity_matrix.toarray()
+    np.fill_diagonal(distances, 0)
+    return distances
+
+
+class TestSparseSilhouette(unittest.TestCase):
+
+    def setUp(self):
+        self.similarity_matrix, self.groups = _similarity_matrix()
+        self.distances = _distances(self.similarity_matrix)
+
+    def test_silhouette_samples(self):
+        rng = np.random.RandomState(1)
+        labels = self.groups.copy()
+        # a singleton, and a cluster far from a sample of another one
+        labels[5] = 10
+        labels[rng.rand(labels.shape[0]) < .1] = 11
+        for cluster_labels in (self.groups, labels,
+                               rng.randint(0, 4, labels.shape[0])):
+            expected = silhouette_samples(
+                self.distances, cluster_labels, metric='precomputed')
+            result = sparse_silhouette_samples(
+                self.similarity_matrix, cluster_labels, chunk_size=7)
+            np.testing.assert_allclose(result, expected, atol=1e-12)
+
+            # triangular matrices and subsets of samples
+            samples = rng.choice(labels.shape[0], 20, replace=False)
+            result = sparse_silhouette_samples(
+                sparse.triu(self.similarity_matrix), cluster_labels,
+                samples=samples)
+            np.testing.assert_allclose(result, expected[samples], atol=1e-12)
+
+        self.assertRaises(ValueError, sparse_silhouette_samples,
+                          self.similarity_matrix, np.zeros(60))
+
+    def test_silhouette_score(self):
+        expected = np.mean(silhouette_samples(
+            self.distances, self.groups, metric='precomputed'))
+        mean, lower, upper = sparse_silhouette_score(
+            self.similarity_matrix, self.groups)
+        self.assertAlmostEqual(mean, expected)
+        self.assertEqual((lower, upper), (mean, mean))
+
+        mean, lower, upper = sparse_silhouette_score(
+            self.similarity_matrix, self.groups, sample_size=30,
+            random_state=0)
+        self.assertTrue(lower <= mean <= upper)
+
+
+class TestDendrogramSweep(unittest.TestCase):
+
+    def setUp(self):
+        similarity_matrix, _ = _similarity_matrix(random_state=2)
+        self.distances = _distances(similarity_matrix)
+        self.thresholds = np.array([.9, .2, .5, .7, .6, .4, 1.5])
+
+    def _check(self, method):
+        Z = linkage(squareform(self.distances), method=method)
+        results = dendrogram_silhouette_sweep(
+            self.distances, Z, self.thresholds)
+        for threshold, (n_clusters, silhouette, labels) in zip(
+                self.thresholds, results):
+            expected_labels = fcluster(Z, threshold, 'distance')
+            self.assertEqual(
+                adjusted_rand_score(labels, expected_labels), 1)
+            self.assertEqual(n_clusters, len(np.unique(expected_labels)))
+            if 1 < n_clusters < self.distances.shape[0]:
+                expected = np.mean(silhouette_samples(
+                    self.distances, expected_labels, metric='precomputed'))
+                self.assertAlmostEqual(silhouette, expected)
+            else:
+                self.assertEqual(silhouette, 0)
+
+    def test_monotonic(self):
+        for method in ('single', 'complete', 'average'):
+            self._check(method)
+
+    def test_not_monotonic(self):
+        Z = linkage(squareform(self.distances), method='centroid')
+        # the data must give inversions
+        assert np.any(np.diff(Z[:, 2]) < 0)
+        self._check('centroid')
+
+    def test_n_jobs(self):
+        Z = linkage(squareform(self.distances), method='average')
+        n = self.thresholds.shape[0]
+        expected = multi_cut_dendrogram(self.distances, Z, self.thresholds,
+                                        n, save_csv=False)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            result = multi_cut_dendrogram(self.distances, Z, self.thresholds,
+                                          n, n_jobs=2, save_csv=False)
+        self.assertTrue(any(issubclass(x.category, DeprecationWarning)
+                            for x in w))
+        np.testing.assert_array_equal(result[0], expected[0])
+        np.testing.assert_array_equal(result[1], expected[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
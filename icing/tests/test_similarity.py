@@ -0,0 +1,155 @@
+"""Tests for icing.similarity_.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import unittest
+import numpy as np
+
+from scipy import sparse
+
+from icing.core.parallel_distance import index_dtype_for, sm_sparse
+from icing.similarity_ import FeatureMapStringKernel, StringKernel
+from icing.similarity_ import IgSimilarity, Similarity, StringSimilarity
+from icing.similarity_ import compute_similarity_matrix
+from icing.similarity_ import correct_similarity_matrix
+from icing.tests import make_records
+
+
+class PrefixSimilarity(Similarity):
+    """Fraction of the characters of the first string matched in place.
+
+    Not symmetric for strings with different lengths.
+    """
+
+    def pairwise(self, x1, x2):
+        return sum(a == b for a, b in zip(x1, x2)) / float(len(x1))
+
+
+def _per_pair_matrix(records, igsimilarity):
+    """Similarity matrix computed one pair at a time, without cache."""
+    n = len(records)
+    data, rows, cols = sm_sparse(
+        np.array(records), igsimilarity.pairwise, igsimilarity.tol)
+    return sparse.csr_matrix((data, (rows, cols)), shape=(n, n)).toarray()
+
+
+class TestJunctionCache(unittest.TestCase):
+
+    def setUp(self):
+        self.records, _ = make_records(random_state=0)
+        lengths = np.array([x.junction_length for x in self.records])
+        # the data must contain pairs with different lengths
+        assert len(np.unique(lengths)) > 1
+
+    def test_asymmetric_junction_similarity(self):
+        igsimilarity = IgSimilarity(PrefixSimilarity(), correct=False)
+        expected = _per_pair_matrix(
+            self.records, igsimilarity.set_params(cache_size=0))
+        igsimilarity.set_params(cache_size=65536)
+        result = compute_similarity_matrix(
+            self.records, igsimilarity=igsimilarity).toarray()
+        np.testing.assert_array_equal(result, expected)
+
+        # the cache of `pairwise` keeps the order of the arguments too
+        cached = _per_pair_matrix(self.records, igsimilarity)
+        np.testing.assert_array_equal(cached, expected)
+
+    def test_string_similarity(self):
+        igsimilarity = IgSimilarity(
+            StringSimilarity(model='ham'), correct=True,
+            correct_by=np.poly1d([-1e-4, -0.01, 1.02]), cache_size=0)
+        expected = _per_pair_matrix(self.records, igsimilarity)
+        result = compute_similarity_matrix(
+            self.records,
+            igsimilarity=igsimilarity.set_params(cache_size=65536)).toarray()
+        np.testing.assert_array_equal(result, expected)
+
+
+class TestCorrection(unittest.TestCase):
+
+    def setUp(self):
+        self.records, _ = make_records(random_state=2)
+        self.correct_by = np.poly1d([-1e-3, -0.02, 1.05])
+
+    def test_correct_similarity_matrix(self):
+        igsimilarity = IgSimilarity(
+            StringSimilarity(model='ham'), correct=True,
+            correct_by=self.correct_by, cache_size=0)
+        expected = _per_pair_matrix(self.records, igsimilarity)
+        raw = compute_similarity_matrix(
+            self.records, igsimilarity=igsimilarity.set_params(correct=False))
+        result = correct_similarity_matrix(
+            raw, self.records, self.correct_by).toarray()
+        np.testing.assert_allclose(result, expected, rtol=1e-12)
+
+
+class TestPrecision(unittest.TestCase):
+
+    def setUp(self):
+        self.records, _ = make_records(random_state=3)
+
+    def test_float32(self):
+        igsimilarity = IgSimilarity(
+            StringSimilarity(model='ham'), correct=True,
+            correct_by=np.poly1d([-1e-3, -0.02, 1.05]))
+        expected = compute_similarity_matrix(
+            self.records, igsimilarity=igsimilarity)
+        result = compute_similarity_matrix(
+            self.records, igsimilarity=igsimilarity, dtype=np.float32)
+        self.assertEqual(result.dtype, np.float32)
+        self.assertEqual(result.indices.dtype, np.int32)
+        self.assertEqual(result.indptr.dtype, np.int32)
+        np.testing.assert_array_equal(
+            result.toarray(), expected.toarray().astype(np.float32))
+
+        data, rows, cols = sm_sparse(
+            np.array(self.records), igsimilarity.pairwise, igsimilarity.tol,
+            dtype=np.float32)
+        self.assertEqual(data.dtype, np.float32)
+        self.assertEqual(rows.dtype, np.int32)
+        self.assertEqual(cols.dtype, np.int32)
+
+    def test_index_dtype_for(self):
+        self.assertEqual(index_dtype_for(np.float64, 10), np.intp)
+        self.assertEqual(index_dtype_for(np.float32, 10), np.int32)
+        self.assertRaises(ValueError, index_dtype_for, np.float32, 2 ** 31)
+
+
+class TestFeatureMapStringKernel(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.strings = np.array([''.join(rng.choice(list('ACGT'), length))
+                                 for length in rng.randint(6, 12, 15)] +
+                                ['ACGTACGT', 'ACGTACGT'], dtype=object)
+        self.params = dict(min_kn=1, max_kn=3, lamda=.5)
+
+    def test_exact_kernel(self):
+        # with gaps as long as the strings, the map is the exact kernel
+        exact = StringKernel(hard_matching=1, **self.params)
+        kernel = FeatureMapStringKernel(max_gap=12, **self.params)
+        for x1, x2 in zip(self.strings[:-1], self.strings[1:]):
+            self.assertAlmostEqual(kernel.pairwise(x1, x2),
+                                   exact.pairwise(x1, x2), places=5)
+        report = kernel.approximation_error(self.strings, n_pairs=50,
+                                            random_state=0)
+        self.assertEqual(report['n_pairs'], 50)
+        self.assertTrue(report['max_error'] < 1e-5)
+
+    def test_batch_pairwise(self):
+        kernel = FeatureMapStringKernel(max_gap=2, **self.params)
+        rows, cols = np.triu_indices(self.strings.shape[0])
+        expected = np.array([kernel.pairwise(self.strings[i], self.strings[j])
+                             for i, j in zip(rows, cols)])
+        result = kernel.batch_pairwise(self.strings, rows, cols)
+        np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+        matrix = kernel.pairwise_matrix(self.strings).toarray()
+        np.testing.assert_allclose(matrix[rows, cols], expected, rtol=1e-6)
+        np.testing.assert_allclose(np.diag(matrix), 1, rtol=1e-6)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+"""Tests for icing.externals.sparse_affinity_propagation.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import unittest
+import numpy as np
+
+from scipy import sparse
+from sklearn.metrics import silhouette_score
+
+from icing.externals import AffinityPropagation
+from icing.externals._sparse_affinity_propagation import remove_single_samples
+from icing.externals.sparse_affinity_propagation import _sparse_ap_setup
+from icing.externals.sparse_affinity_propagation import sparse_ap
+from icing.plotting.silhouette import multi_cut_ap
+
+
+def _blobs(random_state=0):
+    """Sparse similarities of three well separated groups of points."""
+    rng = np.random.RandomState(random_state)
+    X = np.vstack([rng.randn(10, 2) + c for c in ((0, 0), (6, 0), (0, 6))])
+    similarity = np.exp(-((X[:, None] - X[None]) ** 2).sum(axis=-1) / 4.)
+    similarity[similarity < .2] = 0
+    return sparse.coo_matrix(similarity), np.repeat(np.arange(3), 10)
+
+
+class TestPreferencePath(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        X = np.vstack([rng.randn(10, 2) + c for c in ((0, 0), (6, 0), (0, 6))])
+        self.similarity = np.exp(
+            -((X[:, None] - X[None]) ** 2).sum(axis=-1) / 4.)
+        # null similarities are part of the problem
+        self.similarity[self.similarity < .2] = 0
+        self.preferences = [-2., -1., .05, .2, .5]
+
+    def test_null_similarities(self):
+        n = self.similarity.shape[0]
+        rows, cols = np.indices((n, n))
+        explicit = sparse.csr_matrix((self.similarity.ravel(), (
+            rows.ravel(), cols.ravel())), shape=(n, n))
+        self.assertEqual(explicit.nnz, n * n)
+
+        ap = AffinityPropagation(affinity='precomputed', max_iter=500)
+        expected = ap.fit_path(explicit, self.preferences)[0]
+        result = ap.fit_path(self.similarity, self.preferences)[0]
+        self.assertEqual(ap.affinity_matrix_.nnz, n * n)
+        np.testing.assert_array_equal(result, expected)
+
+    def test_multi_cut_ap(self):
+        ap = AffinityPropagation(affinity='precomputed', max_iter=500)
+        labels_path = ap.fit_path(self.similarity, sorted(self.preferences))[0]
+        distances = 1. - self.similarity
+        expected = [silhouette_score(distances, x, metric='precomputed')
+                    for x in labels_path]
+        # preferences are sorted inside
+        result = multi_cut_ap(self.preferences[::-1], self.similarity,
+                              distances, n_jobs=2, save_csv=False)
+        np.testing.assert_allclose(list(result), expected[::-1])
+
+
+class TestSingleSamples(unittest.TestCase):
+
+    def test_remove_single_samples(self):
+        # sample 1 only has its diagonal, sample 0 only similarities from
+        # others
+        rows = np.array([0, 1, 2, 2, 2, 3, 3, 3])
+        cols = np.array([0, 1, 0, 2, 3, 0, 2, 3])
+        data = np.array([-1, -1, .3, -1, .8, .5, .8, -1])
+        rows, cols, data, left_ori, single_samples, n_samples = \
+            remove_single_samples(rows, cols, data, 4)
+        np.testing.assert_array_equal(single_samples, [1])
+        np.testing.assert_array_equal(left_ori, [0, 2, 3])
+        self.assertEqual(n_samples, 3)
+        # the minimum of column 0 is copied in row 0
+        np.testing.assert_array_equal(rows, [0, 0, 1, 1, 1, 2, 2, 2])
+        np.testing.assert_array_equal(cols, [0, 1, 0, 1, 2, 0, 1, 2])
+        np.testing.assert_array_equal(data, [-1, .3, .3, -1, .8, .5, .8, -1])
+
+    def test_isolated_samples(self):
+        similarity, _ = _blobs()
+        n = similarity.shape[0]
+        isolated = np.zeros(n + 3, dtype=bool)
+        isolated[[0, 11, 32]] = True
+        # isolated samples only have their preference
+        positions = np.flatnonzero(~isolated)
+        S = sparse.coo_matrix((similarity.data, (
+            positions[similarity.row], positions[similarity.col])),
+            shape=(n + 3, n + 3))
+        centers, labels = sparse_ap(S, preference=.1)
+        expected_centers, expected = sparse_ap(similarity, preference=.1)
+        np.testing.assert_array_equal(centers[isolated],
+                                      np.flatnonzero(isolated))
+        np.testing.assert_array_equal(centers[~isolated],
+                                      positions[expected_centers])
+        self.assertEqual(len(np.unique(labels)),
+                         len(np.unique(expected)) + 3)
+
+
+class TestIterations(unittest.TestCase):
+
+    def setUp(self):
+        self.similarity, _ = _blobs()
+
+    def test_trace(self):
+        centers, _, n_iter, trace = sparse_ap(
+            self.similarity, preference=0., return_n_iter=True,
+            return_trace=True)
+        self.assertEqual(trace.shape[0], n_iter)
+        self.assertEqual(trace['n_exemplars'][-1], len(np.unique(centers)))
+        self.assertEqual(trace['label_change'][-1], 0)
+        self.assertTrue(np.all(np.diff(trace['time']) >= 0))
+
+    def test_callback(self):
+        records = []
+
+        def _stop(record):
+            records.append(record)
+            return len(records) == 3
+        _, _, n_iter = sparse_ap(self.similarity, preference=0.,
+                                 return_n_iter=True, callback=_stop)
+        self.assertEqual(n_iter, 3)
+        self.assertEqual(len(records), 3)
+
+    def test_convergence(self):
+        expected = sparse_ap(self.similarity, preference=0.)[1]
+        labels = sparse_ap(self.similarity, preference=0.,
+                           convergence='exemplars')[1]
+        np.testing.assert_array_equal(labels, expected)
+        self.assertRaises(ValueError, sparse_ap, self.similarity,
+                          preference=0., convergence='other')
+
+    def test_float32(self):
+        expected = sparse_ap(self.similarity, preference=0.)
+        similarity = self.similarity.astype(np.float32)
+        ap = AffinityPropagation(affinity='precomputed', preference=0.)
+        ap.fit(similarity)
+        self.assertEqual(ap.affinity_matrix_.dtype, np.float32)
+        # messages keep the type of the similarities
+        problem = _sparse_ap_setup(similarity)
+        self.assertEqual(problem['s_data'].dtype, np.float32)
+        self.assertEqual(problem['row_to_col_idx'].dtype, np.int32)
+        np.testing.assert_array_equal(ap.cluster_centers_indices_,
+                                      expected[0])
+        np.testing.assert_array_equal(ap.labels_, expected[1])
+
+    def test_adaptive_damping(self):
+        trace = sparse_ap(self.similarity, preference=0.,
+                          adaptive_damping=True, return_trace=True)[-1]
+        self.assertTrue(np.all(np.diff(trace['damping']) >= 0))
+        self.assertTrue(np.all(trace['damping'] <= .95))
+
+
+if __name__ == '__main__':
+    unittest.main()
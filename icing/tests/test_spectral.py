@@ -0,0 +1,76 @@
+"""Tests for icing.externals.spectral.
+
+Author: Federico Tomasi
+Copyright (c) 2016, Federico Tomasi.
+Licensed under the FreeBSD license (see LICENSE.txt).
+"""
+import unittest
+import numpy as np
+
+from scipy import sparse
+from sklearn.metrics import adjusted_rand_score
+
+from icing.externals.spectral import component_spectral_clustering
+
+
+def _components(sizes, random_state=0):
+    """Components made of two dense groups, weakly joined.
+
+    Components with less than 4 samples are a single dense group. Returns
+    the affinity matrix, the component and the group of each sample.
+    """
+    rng = np.random.RandomState(random_state)
+    blocks, groups = [], []
+    for size in sizes:
+        block = rng.uniform(.7, 1, (size, size))
+        group = np.zeros(size, dtype=bool)
+        if size >= 4:
+            group = np.arange(size) >= size // 2
+            block[group[:, None] != group[None, :]] = 0
+            # a few weak edges between the two groups
+            block[0, size - 1] = block[size - 1, 0] = .05
+            block[1, size - 2] = block[size - 2, 1] = .05
+        block = np.triu(block, 1)
+        blocks.append(block + block.T)
+        groups.append(group)
+    components = np.repeat(np.arange(len(sizes)), sizes)
+    groups = components * 2 + np.concatenate(groups)
+    return sparse.block_diag(blocks, format='csr'), components, groups
+
+
+class TestComponentSpectralClustering(unittest.TestCase):
+
+    def test_components(self):
+        affinity, components, groups = _components([20, 30, 2, 1, 24])
+        labels = component_spectral_clustering(affinity, random_state=0)
+        small = np.in1d(components, [2, 3])
+        self.assertEqual(adjusted_rand_score(labels[~small], groups[~small]),
+                         1)
+        # small components are a cluster each, and no cluster is shared
+        # between components
+        self.assertEqual(len(np.unique(labels[small])), 2)
+        for label in np.unique(labels):
+            self.assertEqual(len(np.unique(components[labels == label])), 1)
+        np.testing.assert_array_equal(np.unique(labels),
+                                      np.arange(labels.max() + 1))
+
+    def test_lobpcg(self):
+        affinity, _, groups = _components([60, 80], random_state=1)
+        expected = component_spectral_clustering(affinity, random_state=0)
+        labels = component_spectral_clustering(
+            sparse.triu(affinity).astype(np.float32), random_state=0,
+            max_dense_size=50)
+        self.assertEqual(adjusted_rand_score(labels, expected), 1)
+        self.assertEqual(adjusted_rand_score(labels, groups), 1)
+
+    def test_n_clusters(self):
+        affinity, components, _ = _components([20, 30])
+        labels = component_spectral_clustering(
+            affinity, n_clusters=3, random_state=0)
+        for component in range(2):
+            self.assertEqual(len(np.unique(labels[components == component])),
+                             3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -15,6 +15,7 @@ import sys
 import termios
 import time
 
+from collections import OrderedDict
 from datetime import datetime
 
 # class Counter(object):
@@ -59,6 +60,32 @@ def ensure_symmetry(X):
     return (X.T + X) / 2. if not np.array_equal(X, X.T) else X
 
 
+def symmetric_similarity_matrix(similarity_matrix):
+    """Symmetric sparse similarity matrix, without the diagonal.
+
+    Parameters
+    -----------
+    similarity_matrix : scipy.sparse matrix
+        Similarity matrix. Triangular matrices, as computed by
+        `compute_similarity_matrix`, are completed with their transpose.
+
+    Returns
+    -----------
+    similarity_matrix : scipy.sparse.csr_matrix
+        Symmetric similarity matrix, with an empty diagonal.
+    """
+    from scipy import sparse
+    similarity_matrix = sparse.csr_matrix(similarity_matrix)
+    if sparse.tril(similarity_matrix, -1).nnz == 0 or \
+            sparse.triu(similarity_matrix, 1).nnz == 0:
+        similarity_matrix = similarity_matrix + similarity_matrix.T
+    coo = similarity_matrix.tocoo()
+    mask = (coo.row != coo.col) & (coo.data != 0)
+    return sparse.csr_matrix(
+        (coo.data[mask], (coo.row[mask], coo.col[mask])),
+        shape=similarity_matrix.shape)
+
+
 def distance_to_affinity_matrix(X, delta=.2, minimum_value=0):
     """Convert the distance matrix into an affinity matrix.
 
@@ -146,6 +173,50 @@ def flatten(x):
         if type(x) in (list, np.ndarray) else [x]
 
 
+class LRUCache(object):
+    """Mapping which keeps only the `maxsize` most recently used items.
+
+    Lookups with `get` are counted in `hits` and `misses`.
+    """
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Return the value of key, marking it as recently used."""
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        """Fraction of lookups which found their key."""
+        lookups = self.hits + self.misses
+        return self.hits / float(lookups) if lookups > 0 else 0.
+
+    def clear(self):
+        """Remove all items and reset the counters."""
+        self._items.clear()
+        self.hits = self.misses = 0
+
+
 def term_processes(ps, e=''):
     """Terminate processes in ps and exit the program."""
     sys.stderr.write(e + '\nTerminating processes ...')
@@ -0,0 +1,76 @@
+"""Validation of clonal inference with reduced numerical precision.
+
+Similarities lie in [0, 1], so they can be stored as np.float32, together
+with np.int32 indices. This halves the memory and the bandwidth of the
+similarity matrix and of affinity propagation messages. The functions in this
+module check, on a reference dataset, that the clones obtained in this way are
+the same obtained with np.float64.
+"""
+import numpy as np
+
+from sklearn.metrics import adjusted_rand_score
+
+from icing.core.cluster import define_clusts
+from icing.similarity_ import compute_similarity_matrix
+
+
+def _nbytes(matrix):
+    """Memory used by a sparse matrix."""
+    return matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+
+
+def compare_precision(records, igsimilarity, dtype=np.float32, method='ap',
+                      threshold=0.05, max_iter=200):
+    """Compare clones inferred with `dtype` against np.float64.
+
+    Similarities are computed once in np.float64 and then converted to
+    `dtype`, which gives the same values computed by
+    ``compute_similarity_matrix(..., dtype=dtype)``.
+
+    Parameters
+    ----------
+    records : list of IgRecord
+        Reference dataset.
+    igsimilarity : IgSimilarity
+        Similarity between records.
+    dtype : numpy dtype, optional, default: np.float32
+        Reduced precision type to validate.
+    method : ('ap', 'dbscan', 'hc'), optional, default: 'ap'
+        Clustering method, as in `define_clusts`.
+    threshold : float, optional, default: 0.05
+        Distance threshold, as in `define_clusts`.
+    max_iter : int, optional, default: 200
+        Maximum number of iterations for affinity propagation.
+
+    Returns
+    -------
+    report : dict
+        Adjusted rand score between the two assignments
+        (``adjusted_rand_score``), whether they define the same clones
+        (``identical``), the number of clones (``n_clones``), the maximum
+        absolute difference between similarities (``max_similarity_error``)
+        and the memory of the two similarity matrices in bytes
+        (``nbytes``). Tuples refer to np.float64 and `dtype`, respectively.
+    """
+    similarity_matrix = compute_similarity_matrix(
+        list(records), sparse_mode=True, igsimilarity=igsimilarity,
+        dtype=np.float64)
+    reduced_matrix = similarity_matrix.astype(dtype)
+    reduced_matrix.indices = reduced_matrix.indices.astype(np.int32)
+    reduced_matrix.indptr = reduced_matrix.indptr.astype(np.int32)
+
+    labels = define_clusts(similarity_matrix, threshold=threshold,
+                           max_iter=max_iter, method=method)
+    reduced_labels = define_clusts(reduced_matrix, threshold=threshold,
+                                   max_iter=max_iter, method=method)
+
+    score = adjusted_rand_score(labels, reduced_labels)
+    return dict(
+        adjusted_rand_score=score,
+        identical=score == 1,
+        n_clones=(np.unique(labels).shape[0],
+                  np.unique(reduced_labels).shape[0]),
+        max_similarity_error=np.max(np.abs(
+            similarity_matrix.data - reduced_matrix.data)) if
+        similarity_matrix.nnz > 0 else 0.,
+        nbytes=(_nbytes(similarity_matrix), _nbytes(reduced_matrix)))
@@ -0,0 +1,201 @@
+"""Validation of the pruning of junction comparisons.
+
+`JunctionIndex` skips the distances which the triangle inequality proves to
+be above the query radius. The distance between junctions of different
+lengths is computed on their alignment and normalised by its length, so the
+triangle inequality does not hold and, with a finite slack, some neighbours
+may be lost. The functions in this module measure, on a reference dataset,
+how many distance evaluations are pruned and how many neighbours are
+recovered, against an exhaustive evaluation of all the pairs which share a V
+gene.
+
+`minhash_candidate_pairs` keeps only pairs of junctions with similar k-mer
+sets, so it may miss pairs with a high string kernel similarity. Its recall
+is measured in the same way.
+
+`StringDistance` with a `max_distance` cutoff abandons the distance of a
+pair as soon as it exceeds the cutoff. This is exact for the pairs within
+the cutoff; `compare_early_abandon` measures the time saved.
+"""
+import time
+import numpy as np
+
+from sklearn.base import clone
+
+from icing.core.distances import StringDistance
+from icing.core.metric_tree import JunctionIndex
+from icing.core.parallel_distance import candidate_pairs
+from icing.core.parallel_distance import minhash_candidate_pairs
+
+
+def compare_metric_tree(records, radius, junction_dist=None, tol=3,
+                        leaf_size=16, slack=np.inf, random_state=None):
+    """Compare the radius graph of `JunctionIndex` with exhaustive search.
+
+    Parameters
+    ----------
+    records : list of IgRecord
+        Reference dataset.
+    radius : float
+        Maximum distance between the junctions of a pair.
+    junction_dist : Distance, optional
+        Distance between junctions. Default is `StringDistance()`.
+    tol : int, optional, default: 3
+        Tolerance in the length of the junctions.
+    leaf_size : int, optional, default: 16
+        Maximum number of junctions in a leaf of the trees.
+    slack : float, optional, default: np.inf
+        Margin added to the pruning bounds of junctions with different
+        lengths, as in `JunctionIndex`.
+    random_state : int, RandomState instance or None, optional
+        Used to choose the vantage points.
+
+    Returns
+    -------
+    report : dict
+        Number of distances computed by exhaustive search
+        (``n_candidates``) and by the index, including the construction of
+        the trees (``n_evaluations``), the fraction of distances saved
+        (``pruned_fraction``), the number of pairs within `radius` found by
+        exhaustive search (``n_pairs``), the fraction of them found by the
+        index (``recall``) and the same fraction only for pairs of junctions
+        with different lengths (``recall_unequal_lengths``).
+    """
+    records = list(records)
+    junction_dist = junction_dist or StringDistance()
+    junctions = np.empty(len(records), dtype=object)
+    junctions[:] = [x.junc for x in records]
+    v_genes = [x.setV for x in records]
+    lengths = np.array([len(x) for x in junctions], dtype=int)
+
+    rows, cols = candidate_pairs(v_genes, lengths, tol)
+    distances = junction_dist.batch_pairwise(junctions, rows, cols)
+    within = distances <= radius
+    rows, cols = rows[within], cols[within]
+
+    index = JunctionIndex(junctions, v_genes, junction_dist=junction_dist,
+                          tol=tol, leaf_size=leaf_size, slack=slack,
+                          random_state=random_state)
+    found_rows, found_cols, _ = index.radius_graph(radius)
+
+    n = len(records)
+    found = np.in1d(rows.astype(np.int64) * n + cols,
+                    found_rows.astype(np.int64) * n + found_cols)
+    unequal = lengths[rows] != lengths[cols]
+    n_candidates = distances.shape[0]
+    return dict(
+        n_candidates=n_candidates,
+        n_evaluations=index.n_evaluations_,
+        pruned_fraction=1. - index.n_evaluations_ / float(n_candidates) if
+        n_candidates > 0 else 0.,
+        n_pairs=rows.shape[0],
+        recall=found.mean() if found.shape[0] > 0 else 1.,
+        recall_unequal_lengths=found[unequal].mean() if
+        unequal.any() else 1.)
+
+
+def compare_minhash(records, junction_sim, min_similarity, tol=3, k=3,
+                    n_bands=16, n_rows=4, random_state=None):
+    """Compare the pairs kept by `minhash_candidate_pairs` with all pairs.
+
+    Parameters
+    ----------
+    records : list of IgRecord
+        Reference dataset.
+    junction_sim : Similarity
+        Similarity between junctions, such as `StringKernel`.
+    min_similarity : float
+        Similarity floor. Pairs with a lower similarity are not relevant.
+    tol : int, optional, default: 3
+        Tolerance in the length of the junctions.
+    k, n_bands, n_rows, random_state : optional
+        Parameters of `minhash_candidate_pairs`.
+
+    Returns
+    -------
+    report : dict
+        Number of pairs which share a V gene (``n_possible``), number of
+        pairs kept by the prefilter (``n_evaluated``) and their ratio
+        (``evaluated_fraction``), the number of pairs with similarity at
+        least `min_similarity` (``n_pairs``) and the fraction of them kept
+        by the prefilter (``recall``).
+    """
+    records = list(records)
+    junctions = np.empty(len(records), dtype=object)
+    junctions[:] = [x.junc for x in records]
+    v_genes = [x.setV for x in records]
+    lengths = [x.junction_length for x in records]
+
+    rows, cols = candidate_pairs(v_genes, lengths, tol)
+    if hasattr(junction_sim, 'batch_pairwise'):
+        similarities = junction_sim.batch_pairwise(junctions, rows, cols)
+    else:
+        similarities = np.array([junction_sim.pairwise(
+            junctions[i], junctions[j]) for i, j in zip(rows, cols)])
+    relevant = similarities >= min_similarity
+
+    kept_rows, kept_cols = minhash_candidate_pairs(
+        v_genes, junctions, lengths, tol, k=k, n_bands=n_bands,
+        n_rows=n_rows, random_state=random_state)
+    n = len(records)
+    kept = np.in1d(rows[relevant].astype(np.int64) * n + cols[relevant],
+                   kept_rows.astype(np.int64) * n + kept_cols)
+    n_possible = rows.shape[0]
+    return dict(
+        n_possible=n_possible,
+        n_evaluated=kept_rows.shape[0],
+        evaluated_fraction=kept_rows.shape[0] / float(n_possible) if
+        n_possible > 0 else 0.,
+        n_pairs=kept.shape[0],
+        recall=kept.mean() if kept.shape[0] > 0 else 1.)
+
+
+def compare_early_abandon(records, max_distance, junction_dist=None, tol=3):
+    """Compare junction distances with and without a distance cutoff.
+
+    Parameters
+    ----------
+    records : list of IgRecord
+        Reference dataset.
+    max_distance : float
+        Distance cutoff.
+    junction_dist : StringDistance, optional
+        Distance between junctions. Default is `StringDistance()`.
+    tol : int, optional, default: 3
+        Tolerance in the length of the junctions.
+
+    Returns
+    -------
+    report : dict
+        Number of pairs which share a V gene (``n_candidates``), the
+        fraction of them farther than `max_distance` (``abandoned_fraction``),
+        the time in seconds to compute all the distances one pair at a time
+        without and with the cutoff (``time``), their ratio (``speedup``) and
+        whether the distances within the cutoff are the same
+        (``identical``).
+    """
+    records = list(records)
+    junction_dist = junction_dist or StringDistance()
+    full_dist = clone(junction_dist).set_params(max_distance=None)
+    cutoff_dist = clone(junction_dist).set_params(max_distance=max_distance)
+    junctions = [x.junc for x in records]
+    rows, cols = candidate_pairs(
+        [x.setV for x in records], [len(x) for x in junctions], tol)
+
+    def _timed_distances(distance):
+        tic = time.time()
+        distances = np.array([distance.pairwise(junctions[i], junctions[j])
+                              for i, j in zip(rows, cols)])
+        return distances, time.time() - tic
+
+    full, full_time = _timed_distances(full_dist)
+    distances, cutoff_time = _timed_distances(cutoff_dist)
+    times = (full_time, cutoff_time)
+    within = full <= max_distance
+    return dict(
+        n_candidates=rows.shape[0],
+        abandoned_fraction=1. - within.mean() if rows.shape[0] > 0 else 0.,
+        time=times,
+        speedup=times[0] / times[1] if times[1] > 0 else 1.,
+        identical=bool(np.all(full[within] == distances[within]) and
+                       np.all(distances[~within] == 1)))
@@ -68,7 +68,7 @@ def main(config_file):
         'igsimilarity': None,
         'clustering': 'ap', 'clustering_method': None,
         'compute_similarity': True,
-        'correct_by': None})
+        'correct_by': None, 'checkpoint_dir': None})
 
     # Define logging file
     root = config.output_root_folder
@@ -125,11 +125,15 @@ def main(config_file):
         #     method=clustering,
         #     sim_func_args=local_sim_func_args,
         #     threshold=threshold, db_file=db_file)
+        # completed shards of the similarity matrix are kept across runs
+        # with the same exp_tag, and reused if the inputs did not change
+        work_dir = None if config.checkpoint_dir is None else \
+            os.path.join(config.checkpoint_dir, exp_tag)
         clones = DefineClones(
             tag=filename, root=root, cluster=config.clustering,
             igsimilarity=igsimilarity_local, threshold=threshold,
             compute_similarity=config.compute_similarity,
-            clustering=config.clustering_method).fit(
+            clustering=config.clustering_method, work_dir=work_dir).fit(
                 db_iter, db_name=db_file)
         outfolder, clone_dict = clones.output_folder_, clones.clone_dict_
 
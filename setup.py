@@ -17,6 +17,14 @@ ssk_module = Extension(
     'icing.kernel.stringkernel',
     sources=['icing/kernel/sum_string_kernel.cpp'],
     include_dirs=[np.get_include()])
+graph_module = Extension(
+    'icing.core.graphclustering',
+    sources=['icing/core/graph_clustering.cpp'],
+    include_dirs=[np.get_include()])
+junction_module = Extension(
+    'icing.core.junctiondistance',
+    sources=['icing/core/junction_distance.cpp'],
+    include_dirs=[np.get_include()])
 setup(
     name='icing',
     version=version,
@@ -53,6 +61,6 @@ setup(
               'matplotlib (>=1.5.1)',
               'seaborn (>=0.7.0)'],
     scripts=['scripts/ici_run.py', 'scripts/ici_analysis.py'],
-    ext_modules=[ssk_module],
+    ext_modules=[ssk_module, graph_module, junction_module],
     include_dirs=[np.get_include()]
 )